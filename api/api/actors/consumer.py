@@ -1,5 +1,6 @@
 from django.conf import settings
 from threading import Thread
+from metrics.decoder import BATCH_CONTENT_TYPES
 import logging
 import pika
 
@@ -8,6 +9,21 @@ logger = logging.getLogger(__name__)
 
 
 class Consumer(object):
+    """
+    Consumes the messages of a RabbitMQ queue and forwards them to the parent
+    actor. If CONSUMER_BATCH_SIZE is greater than 1, the messages are buffered
+    and delivered as a list through parent.notify_batch() when the batch is
+    full or CONSUMER_BATCH_TIMEOUT expires. The batch is acknowledged once the
+    parent has processed it, so unprocessed messages are redelivered if the
+    controller restarts. A batch that the parent fails to process is rejected
+    without requeueing: the parent may have processed part of it (or all of
+    it, if only the reply was lost), and a message it can not process would
+    be redelivered forever. The rejected messages are dead-lettered if the
+    queue has a dead letter exchange (a RabbitMQ policy), or dropped.
+
+    The content type of the messages with a batch of metrics (see
+    metrics.decoder.BATCH_CONTENT_TYPES) is forwarded to the parent.
+    """
     _tell = ['start_consuming', 'stop_consuming']
 
     def __init__(self, queue, routing_key, parent):
@@ -22,27 +38,84 @@ class Consumer(object):
         parameters = pika.ConnectionParameters(host=rmq_host,
                                                port=rmq_port,
                                                credentials=credentials)
-        self._channel = pika.BlockingConnection(parameters).channel()
+        self._connection = pika.BlockingConnection(parameters)
+        self._channel = self._connection.channel()
 
         self.parent = parent
         self.queue = queue
         self.routing_key = routing_key
 
+        self.batch_size = settings.CONSUMER_BATCH_SIZE
+        self.batch_timeout = settings.CONSUMER_BATCH_TIMEOUT
+        self._bodies = list()
+        self._content_types = None
+        self._last_delivery_tag = None
+        self._timer = None
+
         self._channel.queue_declare(queue=queue)
 
         if routing_key:
             self._channel.queue_bind(exchange=exchange,
                                      queue=queue,
                                      routing_key=routing_key)
-            self.consumer = self._channel.basic_consume(self.callback,
-                                                        queue=queue,
-                                                        no_ack=True)
+            if self.batch_size > 1:
+                self._channel.basic_qos(prefetch_count=max(settings.CONSUMER_PREFETCH, self.batch_size))
+                self.consumer = self._channel.basic_consume(self.batch_callback,
+                                                            queue=queue,
+                                                            no_ack=False)
+            else:
+                self.consumer = self._channel.basic_consume(self.callback,
+                                                            queue=queue,
+                                                            no_ack=True)
         else:
             logger.error("Consumer: You must entry a routing key")
             print "You must entry a routing key"
 
     def callback(self, ch, method, properties, body):
-        self.parent.notify(body)
+        if properties.content_type in BATCH_CONTENT_TYPES:
+            self.parent.notify(body, properties.content_type)
+        else:
+            self.parent.notify(body)
+
+    def batch_callback(self, ch, method, properties, body):
+        if properties.content_type in BATCH_CONTENT_TYPES and self._content_types is None:
+            self._content_types = [None] * len(self._bodies)
+        if self._content_types is not None:
+            self._content_types.append(properties.content_type)
+        self._bodies.append(body)
+        self._last_delivery_tag = method.delivery_tag
+        if len(self._bodies) >= self.batch_size:
+            self._flush_batch()
+        elif self._timer is None:
+            self._timer = self._connection.add_timeout(self.batch_timeout, self._flush_batch)
+
+    def _flush_batch(self):
+        """
+        Delivers the buffered messages to the parent and acknowledges them.
+        If the parent fails, the messages are rejected. It runs in the
+        consuming thread (message and timer callbacks), which owns the channel.
+        """
+        if self._timer is not None:
+            self._connection.remove_timeout(self._timer)
+            self._timer = None
+        if not self._bodies:
+            return
+
+        bodies = self._bodies
+        content_types = self._content_types
+        delivery_tag = self._last_delivery_tag
+        self._bodies = list()
+        self._content_types = None
+        try:
+            if content_types is None:
+                self.parent.notify_batch(bodies)
+            else:
+                self.parent.notify_batch(bodies, content_types)
+        except Exception as e:
+            logger.error("Consumer: Error delivering a batch of " + str(len(bodies)) + " messages, rejected: " + str(e))
+            self._channel.basic_nack(delivery_tag=delivery_tag, multiple=True, requeue=False)
+            return
+        self._channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
 
     def start_consuming(self):
         logger.info('Start to consume from RabbitMQ: '+self.routing_key)
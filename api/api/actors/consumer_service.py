@@ -0,0 +1,285 @@
+from django.conf import settings
+from functools import partial
+from threading import Thread, Lock
+from metrics.decoder import BATCH_CONTENT_TYPES
+import logging
+import pika
+import time
+import Queue
+
+logging.getLogger("pika").propagate = False
+logger = logging.getLogger(__name__)
+
+# Service shared by all the actors of this process
+_service = None
+_service_lock = Lock()
+
+
+class QueueSubscription(object):
+    """
+    Consumption of a RabbitMQ queue through the consumer service, with its
+    own channel. It has the interface of the Consumer actor (start_consuming
+    and stop_consuming), so the actors use either of them. The messages are
+    batched as in the Consumer actor; the batches are delivered to the parent
+    by the delivery workers of the service, and acknowledged (or rejected,
+    see Consumer) in the I/O loop when the parent has processed them. When
+    the consumption is stopped, the channel is closed once the batches in
+    flight are acknowledged, so they are not redelivered.
+
+    The methods prefixed with _on, and _open, _close, _flush_batch and
+    _acknowledge, run in the I/O loop thread, which owns the connection.
+    """
+
+    def __init__(self, service, queue, routing_key, parent):
+        self.service = service
+        self.queue = queue
+        self.routing_key = routing_key
+        self.parent = parent
+        self.batch_size = settings.CONSUMER_BATCH_SIZE
+        self.batch_timeout = settings.CONSUMER_BATCH_TIMEOUT
+        self.started = False
+
+        self._channel = None
+        self._consumer_tag = None
+        self._bodies = list()
+        self._content_types = None
+        self._last_delivery_tag = None
+        self._timer = None
+        self._in_flight = 0  # batches of the channel not acknowledged yet
+        self._closing = False
+
+    def start_consuming(self):
+        logger.info('Start to consume from RabbitMQ: ' + self.routing_key)
+        self.started = True
+        self.service._call_soon(self._open)
+
+    def stop_consuming(self):
+        logger.info('Stopping to consume from RabbitMQ: ' + self.routing_key)
+        self.started = False
+        self.service._remove(self)
+        self.service._call_soon(self._close)
+
+    def _open(self):
+        connection = self.service._connection
+        if not self.started or self._channel is not None or connection is None or not connection.is_open:
+            return
+        self._channel = connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.queue_declare(self._on_queue_declared, queue=self.queue)
+
+    def _on_queue_declared(self, frame):
+        self._channel.queue_bind(self._on_queue_bound, self.queue, settings.RABBITMQ_EXCHANGE, self.routing_key)
+
+    def _on_queue_bound(self, frame):
+        if self.batch_size > 1:
+            self._channel.basic_qos(self._on_qos, prefetch_count=max(settings.CONSUMER_PREFETCH, self.batch_size))
+        else:
+            self._on_qos(None)
+
+    def _on_qos(self, frame):
+        self._consumer_tag = self._channel.basic_consume(self._on_message, queue=self.queue,
+                                                         no_ack=self.batch_size <= 1)
+
+    def _on_channel_closed(self, channel, reply_code, reply_text):
+        if channel is self._channel:
+            self._channel = None
+            self._bodies = list()
+            self._content_types = None
+            self._timer = None
+            self._in_flight = 0
+            self._closing = False
+            if self.started and reply_code != 0:
+                logger.error("Consumer service: Channel of " + self.queue + " closed: " + str(reply_text))
+
+    def _on_message(self, channel, method, properties, body):
+        batch_content = properties.content_type in BATCH_CONTENT_TYPES
+        if self.batch_size <= 1:
+            # Asynchronous (tell) delivery, as in the Consumer actor
+            if batch_content:
+                self.parent.notify(body, properties.content_type)
+            else:
+                self.parent.notify(body)
+            return
+        if batch_content and self._content_types is None:
+            self._content_types = [None] * len(self._bodies)
+        if self._content_types is not None:
+            self._content_types.append(properties.content_type)
+        self._bodies.append(body)
+        self._last_delivery_tag = method.delivery_tag
+        if len(self._bodies) >= self.batch_size:
+            self._flush_batch()
+        elif self._timer is None:
+            self._timer = self.service._connection.add_timeout(self.batch_timeout, self._flush_batch)
+
+    def _flush_batch(self):
+        if self._timer is not None:
+            self.service._connection.remove_timeout(self._timer)
+            self._timer = None
+        if not self._bodies:
+            return
+        bodies = self._bodies
+        content_types = self._content_types
+        self._bodies = list()
+        self._content_types = None
+        self._in_flight += 1
+        self.service._dispatch(self, bodies, content_types, self._channel, self._last_delivery_tag)
+
+    def _acknowledge(self, channel, delivery_tag, processed):
+        if channel is not self._channel or not channel.is_open:
+            # The channel was closed: the broker redelivers the batch
+            return
+        if processed:
+            channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+        else:
+            channel.basic_nack(delivery_tag=delivery_tag, multiple=True, requeue=False)
+        self._in_flight -= 1
+        if self._closing and self._in_flight <= 0:
+            channel.close()
+
+    def _close(self):
+        channel = self._channel
+        if channel is not None and channel.is_open and not self._closing:
+            self._flush_batch()
+            channel.basic_cancel(consumer_tag=self._consumer_tag)
+            # With batches in flight, the channel is closed by _acknowledge
+            self._closing = True
+            if self._in_flight <= 0:
+                channel.close()
+
+
+class ConsumerService(object):
+    """
+    Consumes the queues of all the actors of this process over a single
+    RabbitMQ connection, with one channel per queue. The connection is driven
+    by the pika I/O loop (SelectConnection) in one thread, and the batches are
+    delivered to the actors by a fixed pool of delivery workers, so the number
+    of threads and connections does not depend on the number of metrics and
+    controllers. All the batches of a queue are delivered by the same worker,
+    in order, so they are acknowledged in order. If the connection is lost,
+    it is reopened and the queues are consumed again.
+    """
+
+    def __init__(self, workers, reconnect_delay=5):
+        self.reconnect_delay = reconnect_delay
+        self._subscriptions = list()
+        self._lock = Lock()
+        self._connection = None
+        self._thread = None
+        self._workers = [Queue.Queue() for _ in range(max(workers, 1))]
+
+    def subscribe(self, queue, routing_key, parent):
+        """
+        Returns the subscription of the parent actor to a queue. The queue is
+        consumed once start_consuming() is called.
+
+        :param queue: The queue name.
+        :type queue: str
+        :param routing_key: The routing key bound to the queue.
+        :type routing_key: str
+        :param parent: The PyActor proxy that receives the messages (notify or
+                       notify_batch).
+        :rtype: QueueSubscription
+        """
+        subscription = QueueSubscription(self, queue, routing_key, parent)
+        with self._lock:
+            self._subscriptions.append(subscription)
+            if self._thread is None:
+                for worker in self._workers:
+                    thread = Thread(target=self._deliver, args=(worker,))
+                    thread.daemon = True
+                    thread.start()
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return subscription
+
+    def _remove(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def _call_soon(self, callback):
+        """
+        Runs the callback in the I/O loop thread. It does nothing if there is
+        no connection: the subscriptions are reopened when it is connected.
+        """
+        connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(callback)
+
+    def _connect(self):
+        credentials = pika.PlainCredentials(settings.RABBITMQ_USERNAME, settings.RABBITMQ_PASSWORD)
+        parameters = pika.ConnectionParameters(host=settings.RABBITMQ_HOST,
+                                               port=settings.RABBITMQ_PORT,
+                                               credentials=credentials)
+        return pika.SelectConnection(parameters,
+                                     on_open_callback=self._on_connection_open,
+                                     on_open_error_callback=self._on_connection_error,
+                                     on_close_callback=self._on_connection_closed)
+
+    def _run(self):
+        while True:
+            try:
+                self._connection = self._connect()
+                self._connection.ioloop.start()
+            except Exception as e:
+                logger.error("Consumer service: " + str(e))
+            self._connection = None
+            time.sleep(self.reconnect_delay)
+
+    def _on_connection_open(self, connection):
+        logger.info('Consumer service: Connected to RabbitMQ')
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription._open()
+
+    def _on_connection_error(self, connection, error):
+        logger.error("Consumer service: Error connecting to RabbitMQ: " + str(error))
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reply_code, reply_text):
+        logger.error("Consumer service: Connection closed: " + str(reply_text))
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription._channel = None
+            subscription._bodies = list()
+            subscription._content_types = None
+            subscription._timer = None
+            subscription._in_flight = 0
+            subscription._closing = False
+
+    def _dispatch(self, subscription, bodies, content_types, channel, delivery_tag):
+        worker = self._workers[hash(subscription.queue) % len(self._workers)]
+        worker.put((subscription, bodies, content_types, channel, delivery_tag))
+
+    def _deliver(self, worker):
+        while True:
+            self._deliver_batch(*worker.get())
+
+    def _deliver_batch(self, subscription, bodies, content_types, channel, delivery_tag):
+        try:
+            if content_types is None:
+                subscription.parent.notify_batch(bodies)
+            else:
+                subscription.parent.notify_batch(bodies, content_types)
+            processed = True
+        except Exception as e:
+            logger.error("Consumer service: Error delivering a batch of " + str(len(bodies)) +
+                         " messages: " + str(e))
+            processed = False
+        self._call_soon(partial(subscription._acknowledge, channel, delivery_tag, processed))
+
+
+def get_consumer_service():
+    """
+    Returns the consumer service of this process.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ConsumerService(settings.CONSUMER_SERVICE_WORKERS, settings.CONSUMER_RECONNECT_DELAY)
+        return _service
@@ -15,11 +15,16 @@ import logging
 import redis
 import os
 import sys
+import uuid
 
 logger = logging.getLogger(__name__)
 host = None
 NODE_STATUS_THRESHOLD = 15  # seconds
 
+# Generation of the workload metrics and filters known by the DSL grammars
+# (policies.dsl_parser), which are cached per process until it changes
+DSL_GENERATION_KEY = 'dsl:generation'
+
 controller_actors = dict()
 metric_actors = dict()
 rule_actors = dict()
@@ -86,6 +91,23 @@ def get_redis_connection():
     return redis.Redis(connection_pool=settings.REDIS_CON_POOL)
 
 
+def bump_dsl_generation(r=None):
+    """
+    Invalidates the DSL grammars of all the processes. It must be called when
+    a workload metric or a filter is added or removed.
+
+    :param r: The redis connection.
+    :return: The new generation.
+    :rtype: str
+    """
+    r = r or get_redis_connection()
+    # Unique, not a counter: a counter would repeat a cached generation after
+    # the database is flushed
+    generation = uuid.uuid4().hex
+    r.set(DSL_GENERATION_KEY, generation)
+    return generation
+
+
 def get_token_connection(request):
     return request.META['HTTP_X_AUTH_TOKEN'] if 'HTTP_X_AUTH_TOKEN' in request.META else False
 
@@ -31,3 +31,8 @@ class ProjectNotFound(CrystalControllerException):
 class ProjectNotCrystalEnabled(CrystalControllerException):
     """Exception to be raised when a dynamic policy is created with a Non-crystal-enabled project."""
     pass
+
+
+class MetricDecodeError(CrystalControllerException):
+    """Exception to be raised when a workload metric message can not be decoded."""
+    pass
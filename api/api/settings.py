@@ -174,16 +174,62 @@ PYACTOR_URL = PYACTOR_TRANSPORT + '://' + PYACTOR_IP + ':' + str(PYACTOR_PORT)
 
 # Generic Consumer Actor
 CONSUMER_MODULE = 'api.actors.consumer/Consumer'
+CONSUMER_BATCH_SIZE = 1  # messages per notify_batch call, acknowledged once processed (1 delivers each message with notify)
+CONSUMER_BATCH_TIMEOUT = 0.1  # seconds
+CONSUMER_PREFETCH = 2000  # unacknowledged messages
+CONSUMER_SERVICE_ENABLED = False  # consume all the queues of the process over one connection (one I/O loop)
+CONSUMER_SERVICE_WORKERS = 2  # threads delivering the batches to the actors
+CONSUMER_RECONNECT_DELAY = 5  # seconds
 
 # Swift Metric Actor
 METRIC_MODULE = 'metrics.actors.swift_metric/SwiftMetric'
+METRIC_AGGREGATION_INTERVAL = 1  # seconds
+METRIC_AGGREGATION_INTERVALS = {}  # per metric actor, e.g. {'get_bandwidth': 5}
+METRIC_SKETCH_ACCURACY = 0.01  # relative error of the quantiles (None disables the sketches)
+METRIC_SKETCH_WINDOW = 60  # seconds
+METRIC_DELTA_KEYFRAME = 60  # intervals between full updates to delta observers
+METRIC_BUFFER_SIZE = 200000  # metrics per interval
+METRIC_BUFFER_POLICY = 'drop_oldest'  # when the buffer is full: drop_oldest, sample or block
+METRIC_BUFFER_BLOCK_TIMEOUT = 5  # seconds
+METRIC_BUFFERS = {}  # per metric actor, e.g. {'get_bandwidth': {'size': 50000, 'policy': 'sample'}}
+METRIC_TOP_CAPACITY = 1000  # heavy-hitter counters per dimension (projects, containers and hosts, 0 disables them)
+METRIC_TOP_WINDOW = 300  # seconds
+METRIC_EVENT_TIME = False  # aggregate the metrics by their @timestamp instead of their arrival time
+METRIC_WINDOW_LENGTH = 1  # seconds (event time)
+METRIC_ALLOWED_LATENESS = 2  # seconds (event time)
+METRIC_SERIES_ENABLED = False  # short-term history of the aggregates in redis (written at every interval)
+METRIC_SERIES_CONTAINERS = False  # also keep the series of each container
+METRIC_COLUMNAR_BATCHES = False  # send a MetricBatch instead of a list of dicts to the observers of ALL
+METRIC_INGESTION_WORKERS = 0  # consumer processes per metric (0 consumes in the actor process); not with the block buffer policy
+METRIC_PROJECT_RATE = None  # metrics per second admitted per project (the rest are folded into sums)
+METRIC_PROJECT_BURST = 10000  # metrics
+METRIC_PROJECT_QUOTAS = {}  # per project (rate, burst), e.g. {'0123456789abcdef': (5000, 50000)}
+METRIC_INGESTION_ADDRESS = None  # receive metrics without RabbitMQ, e.g. 'unix:///var/run/crystal/metrics.sock' or 'udp://127.0.0.1:9191'
+METRIC_INGESTION_RECEIVE_BUFFER = 4194304  # bytes (socket receive buffer)
+METRIC_BUS_ENABLED = False  # publish the aggregates in a shared-memory bus for the actors of the same host
+METRIC_BUS_DIR = '/dev/shm/crystal'
+METRIC_BUS_SLOTS = 16  # aggregates kept in the ring of each metric
+METRIC_BUS_SLOT_SIZE = 262144  # bytes per aggregate (~5000 targets)
+METRIC_BUS_POLL_INTERVAL = 0.1  # seconds
 
 # Rule Actor
 RULE_MODULE = 'policies.actors.rule/Rule'
+RULE_METRIC_EPSILON = None  # relative change notified to the rules (None notifies every interval)
+RULE_METRIC_BUS = False  # read the metrics from the shared-memory bus of a live metric actor in the host (METRIC_BUS_ENABLED)
+RULE_ACTION_MODE = 'local'  # deploy the filters of the rules in-process (local) or through the controller API (http)
 
 # Transient Rule Actor
 RULE_TRANSIENT_MODULE = 'policies.actors.rule_transient/TransientRule'
 
+# Rule Engine Actor
+RULE_ENGINE_ENABLED = False  # host all the dynamic policies in one actor instead of an actor per policy
+RULE_ENGINE_MODULE = 'policies.actors.rule_engine/RuleEngine'
+
+# Bulk DSL policies (POST /policies/dynamic?bulk=true)
+POLICY_BULK_PARSE_PROCESSES = 4  # processes parsing the rules of a large upload
+POLICY_BULK_PARSE_MIN_RULES = 500  # rules to parse them in the process pool
+POLICY_BULK_START_WORKERS = 16  # threads starting the rule actors
+
 # Global controllers
 GLOBAL_CONTROLLERS_BASE_MODULE = 'controller.dynamic_policies.rules'
 METRICS_BASE_MODULE = 'controller.dynamic_policies.metrics'
@@ -198,3 +244,7 @@ RABBITMQ_EXCHANGE = 'amq.topic'
 # Logstash
 LOGSTASH_HOST = 'localhost'
 LOGSTASH_PORT = 5400
+LOGSTASH_PROTOCOL = 'udp'  # udp or tcp
+LOGSTASH_QUEUE_SIZE = 100000  # metrics buffered before dropping
+LOGSTASH_BATCH_SIZE = 500  # metrics per batch
+LOGSTASH_FLUSH_INTERVAL = 0.5  # seconds
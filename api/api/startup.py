@@ -1,6 +1,7 @@
 import redis
 import sys
 import settings
+from api.common import bump_dsl_generation
 
 
 def run():
@@ -21,6 +22,8 @@ def run():
     # Workload metric Actors
     for key in r.keys('metric:*'):
         r.delete(key)
+    # Rebuild the DSL grammars without them (policies.dsl_parser)
+    bump_dsl_generation(r)
 
     # Dynamic policies
     for key in r.keys('policy:*'):
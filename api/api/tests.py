@@ -15,6 +15,8 @@ from .common import get_all_registered_nodes, remove_extra_whitespaces, to_json_
 from .exceptions import FileSynchronizationException
 from .startup import run as startup_run
 from .middleware import CrystalMiddleware
+from .actors.consumer import Consumer
+from .actors.consumer_service import ConsumerService
 
 
 # Tests use database=10 instead of 0.
@@ -146,6 +148,122 @@ class MainTestCase(TestCase):
         self.assertEquals(self.r.hget('policy:1', 'status'), 'Stopped')
         self.assertEquals(self.r.hget('policy:2', 'status'), 'Stopped')
 
+    #
+    # Consumer tests
+    #
+
+    @override_settings(CONSUMER_BATCH_SIZE=3, CONSUMER_PREFETCH=10)
+    @mock.patch('api.actors.consumer.pika.BlockingConnection')
+    def test_consumer_batches_and_acks(self, mock_connection):
+        channel = mock_connection.return_value.channel.return_value
+        parent = mock.MagicMock()
+        consumer = Consumer('get_bandwidth', 'metric.get_bandwidth', parent)
+        channel.basic_qos.assert_called_with(prefetch_count=10)
+        self.assertEqual(channel.basic_consume.call_args[1]['no_ack'], False)
+
+        for tag in range(1, 5):
+            consumer.batch_callback(channel, mock.Mock(delivery_tag=tag), mock.Mock(content_type=None), 'body' + str(tag))
+        parent.notify_batch.assert_called_once_with(['body1', 'body2', 'body3'])
+        channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+        self.assertFalse(parent.notify.called)
+
+        # The last message is delivered when the batch timeout expires
+        timer_callback = mock_connection.return_value.add_timeout.call_args[0][1]
+        timer_callback()
+        parent.notify_batch.assert_called_with(['body4'])
+        channel.basic_ack.assert_called_with(delivery_tag=4, multiple=True)
+
+    @override_settings(CONSUMER_BATCH_SIZE=2)
+    @mock.patch('api.actors.consumer.pika.BlockingConnection')
+    def test_consumer_forwards_batch_content_types(self, mock_connection):
+        channel = mock_connection.return_value.channel.return_value
+        parent = mock.MagicMock()
+        consumer = Consumer('get_bandwidth', 'metric.get_bandwidth', parent)
+        consumer.batch_callback(channel, mock.Mock(delivery_tag=1), mock.Mock(content_type='application/json'), 'body1')
+        consumer.batch_callback(channel, mock.Mock(delivery_tag=2),
+                                mock.Mock(content_type='application/vnd.crystal.metrics+msgpack'), 'body2')
+        parent.notify_batch.assert_called_once_with(['body1', 'body2'],
+                                                    [None, 'application/vnd.crystal.metrics+msgpack'])
+
+    @override_settings(CONSUMER_BATCH_SIZE=2)
+    @mock.patch('api.actors.consumer.pika.BlockingConnection')
+    def test_consumer_rejects_failed_batch(self, mock_connection):
+        channel = mock_connection.return_value.channel.return_value
+        parent = mock.MagicMock()
+        parent.notify_batch.side_effect = Exception('timeout')
+        consumer = Consumer('get_bandwidth', 'metric.get_bandwidth', parent)
+        consumer.batch_callback(channel, mock.Mock(delivery_tag=1), mock.Mock(content_type=None), 'body1')
+        consumer.batch_callback(channel, mock.Mock(delivery_tag=2), mock.Mock(content_type=None), 'body2')
+        channel.basic_nack.assert_called_once_with(delivery_tag=2, multiple=True, requeue=False)
+        self.assertFalse(channel.basic_ack.called)
+
+    @override_settings(CONSUMER_BATCH_SIZE=1)
+    @mock.patch('api.actors.consumer.pika.BlockingConnection')
+    def test_consumer_without_batches(self, mock_connection):
+        channel = mock_connection.return_value.channel.return_value
+        parent = mock.MagicMock()
+        consumer = Consumer('get_bandwidth', 'metric.get_bandwidth', parent)
+        self.assertEqual(channel.basic_consume.call_args[1]['no_ack'], True)
+        consumer.callback(channel, mock.Mock(), mock.Mock(content_type=None), 'body1')
+        parent.notify.assert_called_once_with('body1')
+
+    @override_settings(CONSUMER_BATCH_SIZE=2, CONSUMER_PREFETCH=10)
+    @mock.patch('api.actors.consumer_service.Thread')
+    def test_consumer_service(self, mock_thread):
+        service = ConsumerService(2)
+        connection = service._connection = mock.MagicMock()
+        parents = [mock.MagicMock(), mock.MagicMock()]
+        subscriptions = [service.subscribe('get_bandwidth', 'metric.get_bandwidth', parents[0]),
+                         service.subscribe('put_bandwidth', 'metric.put_bandwidth', parents[1])]
+        # One I/O loop thread and the delivery workers, whatever the number of queues
+        self.assertEqual(mock_thread.call_count, 3)
+
+        subscription = subscriptions[0]
+        subscription.start_consuming()
+        connection.ioloop.add_callback_threadsafe.assert_called_with(subscription._open)
+        subscription._open()
+        channel = connection.channel.return_value
+        subscription._on_channel_open(channel)
+        channel.queue_declare.assert_called_once_with(subscription._on_queue_declared, queue='get_bandwidth')
+        subscription._on_queue_declared(None)
+        subscription._on_queue_bound(None)
+        channel.basic_qos.assert_called_once_with(subscription._on_qos, prefetch_count=10)
+        subscription._on_qos(None)
+        self.assertEqual(channel.basic_consume.call_args[1], {'queue': 'get_bandwidth', 'no_ack': False})
+
+        for tag in range(1, 4):
+            subscription._on_message(channel, mock.Mock(delivery_tag=tag), mock.Mock(content_type=None), 'body' + str(tag))
+        worker = service._workers[hash('get_bandwidth') % 2]
+        batch = worker.get_nowait()
+        self.assertEqual(batch, (subscription, ['body1', 'body2'], None, channel, 2))
+        self.assertTrue(worker.empty())
+
+        # The batch is acknowledged in the I/O loop once the parent processed it
+        service._deliver_batch(*batch)
+        parents[0].notify_batch.assert_called_once_with(['body1', 'body2'])
+        connection.ioloop.add_callback_threadsafe.call_args[0][0]()
+        channel.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+
+        parents[0].notify_batch.side_effect = Exception('timeout')
+        subscription._flush_batch()
+        service._deliver_batch(*worker.get_nowait())
+        connection.ioloop.add_callback_threadsafe.call_args[0][0]()
+        channel.basic_nack.assert_called_once_with(delivery_tag=3, multiple=True, requeue=False)
+
+        # The channel is closed once the last batch is acknowledged
+        parents[0].notify_batch.side_effect = None
+        subscription._on_message(channel, mock.Mock(delivery_tag=4), mock.Mock(content_type=None), 'body4')
+        subscription.stop_consuming()
+        self.assertEqual(service._subscriptions, [subscriptions[1]])
+        connection.ioloop.add_callback_threadsafe.assert_called_with(subscription._close)
+        subscription._close()
+        channel.basic_cancel.assert_called_once_with(consumer_tag=subscription._consumer_tag)
+        self.assertFalse(channel.close.called)
+        service._deliver_batch(*worker.get_nowait())
+        connection.ioloop.add_callback_threadsafe.call_args[0][0]()
+        channel.basic_ack.assert_called_with(delivery_tag=4, multiple=True)
+        channel.close.assert_called_once_with()
+
     #
     # URL tests
     #
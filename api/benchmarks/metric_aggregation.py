@@ -0,0 +1,92 @@
+"""
+Benchmark of the per-interval aggregation of SwiftMetric. The former path
+(Queue.Queue filled by notify() and drained item by item into a dictionary
+loop) is compared with the current one (lock-protected list swapped at every
+tick and metrics.aggregation.ColumnarAggregator).
+
+Run it from the api directory:
+
+    python -m benchmarks.metric_aggregation [messages_per_interval ...]
+"""
+from threading import Lock
+import sys
+import time
+import Queue
+
+from metrics.aggregation import ColumnarAggregator
+from metrics.decoder import MetricRecord
+
+MESSAGES_PER_INTERVAL = [10000, 100000]
+NUM_CONTAINERS = 5000
+REPEAT = 5
+
+
+def generate_records(num_messages):
+    records = []
+    for i in range(num_messages):
+        project = 'project%d' % (i % 100)
+        container = project + '/container%d' % (i % NUM_CONTAINERS)
+        records.append(MetricRecord('bandwidth', None, 16.4375, project, container,
+                                    'proxy%d' % (i % 40), 'GET', 'proxy', None))
+    return records
+
+
+def queue_dict_loop(records):
+    metrics = Queue.Queue()
+    for metric in records:
+        metrics.put(metric)
+
+    aggregate = dict()
+    while not metrics.empty():
+        metric = metrics.get()
+        project = metric.project
+        container = metric.container
+        value = metric.value
+
+        if project not in aggregate:
+            aggregate[project] = 0
+        if container not in aggregate:
+            aggregate[container] = 0
+
+        aggregate[project] += value
+        aggregate[container] += value
+    return aggregate
+
+
+def list_columnar(aggregator, records):
+    metrics = list()
+    lock = Lock()
+    for metric in records:
+        with lock:
+            metrics.append(metric)
+
+    with lock:
+        metric_list = metrics
+        metrics = list()
+    aggregator.add_records(metric_list)
+    return aggregator.flush().as_dict()
+
+
+def timeit(function, *args):
+    best = None
+    for _ in range(REPEAT):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or MESSAGES_PER_INTERVAL
+    aggregator = ColumnarAggregator()
+    for size in sizes:
+        records = generate_records(size)
+        assert queue_dict_loop(records) == list_columnar(aggregator, records)
+        before = timeit(queue_dict_loop, records)
+        after = timeit(list_columnar, aggregator, records)
+        print '%7d messages/interval: Queue + dict loop %8.2f ms, list + columnar %8.2f ms (x%.1f)' % (
+            size, before * 1000, after * 1000, before / after)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of the payload sent every interval to the observers subscribed to
+ALL (global controllers): the former list of dictionaries is compared with
+metrics.batch.MetricBatch. It reports the build time, the size and time of
+the pickling done by PyActor for remote actors (cPickle, protocol 0 and 2),
+and the time to compute the bandwidth per (project, storage policy).
+
+Run it from the api directory:
+
+    python -m benchmarks.metric_batch [messages_per_interval ...]
+"""
+import cPickle
+import sys
+import time
+
+from metrics.batch import MetricBatch
+from metrics.decoder import MetricRecord
+
+MESSAGES_PER_INTERVAL = [10000, 100000]
+NUM_CONTAINERS = 5000
+
+
+def generate_records(num_messages):
+    records = []
+    for i in range(num_messages):
+        project = 'project%d' % (i % 100)
+        container = project + '/container%d' % (i % NUM_CONTAINERS)
+        records.append(MetricRecord('bandwidth', '2017-09-09T18:00:18.%06d+02:00' % i, 16.4375, project, container,
+                                    'proxy%d' % (i % 40), 'GET', 'proxy', {'storage_policy': str(i % 3)}))
+    return records
+
+
+def group_dicts(metric_list):
+    groups = dict()
+    for metric in metric_list:
+        key = (metric['project'], metric['storage_policy'])
+        groups[key] = groups.get(key, 0) + metric['value']
+    return groups
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, (time.time() - start) * 1000
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or MESSAGES_PER_INTERVAL
+    for size in sizes:
+        records = generate_records(size)
+        dicts, dicts_build = timed(lambda: [metric.as_dict() for metric in records])
+        batch, batch_build = timed(MetricBatch.from_records, records)
+        print '%d messages/interval' % size
+        print '  build:          dicts %8.2f ms, batch %8.2f ms' % (dicts_build, batch_build)
+        for protocol in (0, 2):
+            dicts_data, dicts_time = timed(cPickle.dumps, dicts, protocol)
+            batch_data, batch_time = timed(cPickle.dumps, batch, protocol)
+            _, dicts_load = timed(cPickle.loads, dicts_data)
+            _, batch_load = timed(cPickle.loads, batch_data)
+            print '  pickle (p%d):    dicts %8.2f ms %8d KB, batch %8.2f ms %8d KB' % (
+                protocol, dicts_time + dicts_load, len(dicts_data) / 1024,
+                batch_time + batch_load, len(batch_data) / 1024)
+        expected, dicts_group = timed(group_dicts, dicts)
+        groups, batch_group = timed(batch.group_sum, 'project', 'storage_policy')
+        assert groups == expected
+        print '  group by:       dicts %8.2f ms, batch %8.2f ms' % (dicts_group, batch_group)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of the workload metric decoding done in SwiftMetric.notify().
+
+Compares the former eval() based decoding with metrics.decoder (JSON and
+msgpack) and reports if each one sustains the target input rate.
+
+Run it from the api directory:
+
+    python -m benchmarks.metric_decoding [num_messages] [target_rate]
+"""
+import json
+import sys
+import time
+
+from metrics.decoder import decode, encode_msgpack, msgpack
+
+TARGET_RATE = 50000  # messages/second
+NUM_MESSAGES = 50000
+
+
+def generate_metrics(num_messages):
+    metrics = []
+    for i in range(num_messages):
+        project = 'project%d' % (i % 50)
+        metrics.append({'container': project + '/container%d' % (i % 500), 'metric_name': 'bandwidth',
+                        '@timestamp': '2017-09-09T18:00:18.331492+02:00', 'value': 16.4375,
+                        'project': project, 'host': 'proxy%d' % (i % 40), 'method': 'GET', 'server_type': 'proxy'})
+    return metrics
+
+
+def eval_decoding(bodies):
+    for body in bodies:
+        metric = eval(body)
+        if metric['server_type'] == 'proxy':
+            metric['project'], metric['container'], metric['value']
+
+
+def record_decoding(bodies):
+    for body in bodies:
+        metric = decode(body)
+        if metric.server_type == 'proxy':
+            metric.project, metric.container, metric.value
+
+
+def run(name, function, bodies, target_rate):
+    start = time.time()
+    function(bodies)
+    elapsed = time.time() - start
+    rate = len(bodies) / elapsed
+    print '%-24s %10.0f msg/s  %s' % (name, rate, 'OK' if rate >= target_rate else 'BELOW TARGET')
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_MESSAGES
+    target_rate = int(sys.argv[2]) if len(sys.argv) > 2 else TARGET_RATE
+
+    metrics = generate_metrics(num_messages)
+    json_bodies = [json.dumps(metric) for metric in metrics]
+
+    print 'Decoding %d messages (target: %d msg/s)' % (num_messages, target_rate)
+    run('eval (before)', eval_decoding, json_bodies, target_rate)
+    run('decoder, JSON', record_decoding, json_bodies, target_rate)
+    if msgpack is not None:
+        msgpack_bodies = [encode_msgpack(metric) for metric in metrics]
+        run('decoder, msgpack', record_decoding, msgpack_bodies, target_rate)
+    else:
+        print 'decoder, msgpack: msgpack is not installed'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark of the evaluation of dynamic policy conditions: the recursive walk
+of the parsed condition (the former Rule._check_conditions) is compared with
+the function compiled by policies.conditions.compile_condition. It reports
+evaluations per second for conditions of 1, 5 and 20 terms.
+
+Run it from the api directory:
+
+    python -m benchmarks.rule_conditions [evaluations]
+"""
+import operator
+import sys
+import time
+
+from policies.conditions import compile_condition
+
+EVALUATIONS = 200000
+TERMS = [1, 5, 20]
+
+mappings = {'>': operator.gt, '>=': operator.ge,
+            '==': operator.eq, '<=': operator.le, '<': operator.lt,
+            '!=': operator.ne, "OR": operator.or_, "AND": operator.and_}
+
+
+def generate_condition(terms):
+    """
+    Returns a condition with the given number of terms, as parsed by
+    dsl_parser.parse_condition(): ANDs of two terms joined by ORs.
+    """
+    conditions = [['metric%d' % i, '>' if i % 2 else '<', str(i + 10)] for i in range(terms)]
+    if terms == 1:
+        return conditions[0]
+    groups = list()
+    for i in range(0, terms, 2):
+        if i + 1 < terms:
+            groups.append([conditions[i], 'AND', conditions[i + 1]])
+        else:
+            groups.append(conditions[i])
+    if len(groups) == 1:
+        return groups[0]
+    condition = [groups[0]]
+    for group in groups[1:]:
+        condition.extend(['OR', group])
+    return condition
+
+
+def check_conditions(condition_list, values):
+    # The recursive walk of the parsed condition, per update
+    if not isinstance(condition_list[0], list):
+        return mappings[condition_list[1]](float(values[condition_list[0].lower()]), float(condition_list[2]))
+    result = check_conditions(condition_list[0], values)
+    for i in range(1, len(condition_list) - 1, 2):
+        result = mappings[condition_list[i]](result, check_conditions(condition_list[i + 1], values))
+    return result
+
+
+def run(function, evaluations):
+    start = time.time()
+    for _ in xrange(evaluations):
+        function()
+    return evaluations / (time.time() - start)
+
+
+def main():
+    evaluations = int(sys.argv[1]) if len(sys.argv) > 1 else EVALUATIONS
+    print "%-6s %18s %18s %8s" % ('terms', 'walk (evals/s)', 'compiled (evals/s)', 'speedup')
+    for terms in TERMS:
+        condition = generate_condition(terms)
+        values = dict(('metric%d' % i, str(i + 10)) for i in range(terms))
+        slots, evaluate = compile_condition(condition)
+        slot_values = [None] * len(slots)
+        for metric, slot in slots.items():
+            slot_values[slot] = float(values[metric])
+        assert evaluate(slot_values) == bool(check_conditions(condition, values))
+
+        walk = run(lambda: check_conditions(condition, values), evaluations)
+        compiled = run(lambda: evaluate(slot_values), evaluations)
+        print "%-6d %18.0f %18.0f %7.1fx" % (terms, walk, compiled, compiled / walk)
+
+
+if __name__ == '__main__':
+    main()
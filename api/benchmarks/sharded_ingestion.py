@@ -0,0 +1,64 @@
+"""
+Benchmark of the sharded ingestion of workload metrics. The same messages are
+decoded and pre-aggregated by 1, 2, ... worker processes (as the workers of
+metrics.sharding.ShardedIngestion do, without RabbitMQ) and the partial
+aggregates are merged. Throughput should grow with the number of cores.
+
+Run it from the api directory:
+
+    python -m benchmarks.sharded_ingestion [num_messages] [max_workers]
+"""
+import os
+import sys
+import time
+import multiprocessing
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings")
+
+from benchmarks.metric_decoding import generate_metrics
+from metrics.sharding import IngestionShard, merge_partials
+import json
+
+NUM_MESSAGES = 200000
+
+
+class NullExporter(object):
+    def export(self, metric):
+        pass
+
+
+def run_shard(args):
+    worker, bodies = args
+    shard = IngestionShard(worker)
+    shard.exporter = NullExporter()
+    for body in bodies:
+        shard.add(body)
+    return shard.flush(0)
+
+
+def ingest(pool, workers, bodies):
+    shards = [(worker, bodies[worker::workers]) for worker in range(workers)]
+    sums = dict()
+    merge_partials(pool.map(run_shard, shards), sums, dict(), list())
+    return sums
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_MESSAGES
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    bodies = [json.dumps(metric) for metric in generate_metrics(num_messages)]
+    expected = None
+    for workers in range(1, max_workers + 1):
+        pool = multiprocessing.Pool(workers)
+        start = time.time()
+        sums = ingest(pool, workers, bodies)
+        elapsed = time.time() - start
+        pool.close()
+        pool.join()
+        if expected is None:
+            expected = sums
+        assert sorted(sums) == sorted(expected)
+        print '%2d workers: %9.0f messages/s' % (workers, num_messages / elapsed)
+
+if __name__ == '__main__':
+    main()
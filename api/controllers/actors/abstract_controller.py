@@ -1,6 +1,7 @@
 from redis.exceptions import RedisError
 from pyactor.exceptions import NotFoundError
 from django.conf import settings
+from api.actors.consumer_service import get_consumer_service
 import logging
 import pika
 import redis
@@ -11,8 +12,8 @@ logger = logging.getLogger(__name__)
 
 class AbstractController(object):
 
-    _ask = ['get_target', 'run']
-    _tell = ['update', 'stop_actor', 'notify']
+    _ask = ['get_target', 'run', 'notify_batch']
+    _tell = ['update', 'update_devices', 'stop_actor', 'notify']
 
     def __init__(self):
         self.rmq_user = settings.RABBITMQ_USERNAME
@@ -31,12 +32,17 @@ class AbstractController(object):
             logger.error('"Error connecting with Redis DB"')
 
         self.metrics = dict()
+        # Metrics whose object-server stream (per host, storage policy and device) is consumed
+        self.device_metrics = list()
 
     def _subscribe_metrics(self):
         try:
             for metric in self.metrics:
                 metric_actor = self.host.lookup(metric)
                 metric_actor.attach(self.proxy)
+            for metric in self.device_metrics:
+                metric_actor = self.host.lookup(metric)
+                metric_actor.attach(self.proxy, devices=True)
         except NotFoundError as e:
             logger.error(str(e))
             raise e
@@ -65,14 +71,17 @@ class AbstractController(object):
 
     def _init_consum(self, queue, routing_key):
         try:
-            self.consumer = self.host.spawn(self.id + "_consumer", settings.CONSUMER_MODULE,
-                                            [queue, routing_key, self.proxy])
+            if settings.CONSUMER_SERVICE_ENABLED:
+                self.consumer = get_consumer_service().subscribe(queue, routing_key, self.proxy)
+            else:
+                self.consumer = self.host.spawn(self.id + "_consumer", settings.CONSUMER_MODULE,
+                                                queue, routing_key, self.proxy)
             self.consumer.start_consuming()
         except Exception as e:
             logger.error(str(e))
             raise e
 
-    def notify(self, body):
+    def notify(self, body, content_type=None):
         """
         Method called from the consumer to indicate the value consumed from the
         RabbitMQ queue. After receive the value, this value is communicated to
@@ -80,6 +89,15 @@ class AbstractController(object):
         """
         self.compute_rmq_message(body)
 
+    def notify_batch(self, bodies, content_types=None):
+        """
+        Method called from the consumer with a batch of messages consumed from
+        the RabbitMQ queue. The consumer acknowledges the batch when this
+        method returns.
+        """
+        for body in bodies:
+            self.compute_rmq_message(body)
+
     def get_target(self):
         """
         This controller will be subscribed to all Projects
@@ -88,10 +106,22 @@ class AbstractController(object):
 
     def update(self, metric_name, metric_data):
         """
-        Method called from the Swift Metric to indicate the new metric data
+        Method called from the Swift Metric to indicate the new metric data.
+        The data is a list with a dictionary per metric, or a
+        metrics.batch.MetricBatch if METRIC_COLUMNAR_BATCHES is enabled:
+        iterating it returns the same dictionaries, and its column helpers
+        (column(), values, group_sum()) avoid building them.
         """
         self.compute_data(metric_data)
 
+    def update_devices(self, metric_name, devices):
+        """
+        Method called from the Swift Metric with the object-server data of an
+        interval, for the metrics in device_metrics: a dictionary with the
+        value of each (host, storage_policy, device).
+        """
+        self.compute_device_data(metric_name, devices)
+
     def run(self):
         """
         Entry Method
@@ -109,6 +139,9 @@ class AbstractController(object):
                 for metric in self.metrics:
                     metric_actor = self.host.lookup(metric)
                     metric_actor.detach(self.id, self.get_target())
+            for metric in self.device_metrics:
+                metric_actor = self.host.lookup(metric)
+                metric_actor.detach(self.id)
             if self.consumer:
                 self.consumer.stop_consuming()
         except:
@@ -118,5 +151,8 @@ class AbstractController(object):
     def compute_data(self, metric_data):
         raise NotImplementedError()
 
+    def compute_device_data(self, metric_name, devices):
+        raise NotImplementedError()
+
     def compute_rmq_message(self, body):
         raise NotImplementedError()
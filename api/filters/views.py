@@ -19,7 +19,7 @@ import os
 
 from api.common import rsync_dir_with_nodes, JSONResponse, \
     get_redis_connection, get_token_connection, make_sure_path_exists, save_file, md5,\
-    to_json_bools
+    to_json_bools, bump_dsl_generation
 from api.exceptions import SwiftClientError, StorletNotFoundException, FileSynchronizationException
 
 logger = logging.getLogger(__name__)
@@ -64,6 +64,7 @@ def filter_list(request):
             filter_id = r.incr("filters:id")
             data['id'] = filter_id
             r.hmset('filter:' + str(data['dsl_name']), data)
+            bump_dsl_generation(r)
 
             return JSONResponse(data, status=status.HTTP_201_CREATED)
 
@@ -110,6 +111,7 @@ def filter_detail(request, filter_id):
                 r.hmset('filter:' + str(data['dsl_name']), filter_data)
                 r.delete("filter:" + str(filter_id))
                 r.hmset('filter:' + str(data['dsl_name']), data)
+                bump_dsl_generation(r)
             else:
                 r.hmset('filter:' + str(filter_id), data)
 
@@ -120,6 +122,7 @@ def filter_detail(request, filter_id):
     elif request.method == 'DELETE':
         try:
             r.delete("filter:" + str(filter_id))
+            bump_dsl_generation(r)
 
             return JSONResponse('Filter has been deleted', status=status.HTTP_204_NO_CONTENT)
         except DataError:
@@ -243,46 +246,9 @@ def filter_deploy(request, filter_id, project_id, container=None, swift_object=N
         except ParseError:
             return JSONResponse("Invalid format or empty request params", status=status.HTTP_400_BAD_REQUEST)
 
-        # Get an identifier of this new policy
-        policy_id = r.incr("policies:id")
-
-        # Set the policy data
-        policy_data = {
-            "policy_id": policy_id,
-            "object_type": params['object_type'],
-            "object_size": params['object_size'],
-            "object_tag": params['object_tag'],
-            "object_name": ', '.join(r.lrange('object_type:' + params['object_type'], 0, -1)),
-            "execution_order": policy_id,
-            "params": params['params'],
-            "callable": False
-        }
-
-        if 'execution_server' in params:
-            if params['execution_server'] != 'default':
-                policy_data['execution_server'] = params['execution_server']
-
-        if 'execution_server_reverse' in params:
-            if params['execution_server_reverse'] != 'default':
-                policy_data['execution_server_reverse'] = params['execution_server_reverse']
-
-        if project_id.startswith('group:'):
-            projects_id = json.loads(r.hgetall('project_group:' + project_id.split(':')[1])['attached_projects'])
-        else:
-            projects_id = [project_id]
-
         try:
-            for project in projects_id:
-                if container and swift_object:
-                    target = ':'.join([project, container, swift_object])
-                elif container:
-                    target = ':'.join([project, container])
-                else:
-                    target = project
-
-                token = get_token_connection(request)
-                set_filter(r, target, filter_data.copy(), policy_data.copy(), token)
-
+            token = get_token_connection(request)
+            policy_id = deploy_filter(r, filter_data, project_id, container, swift_object, params, token)
             return JSONResponse(policy_id, status=status.HTTP_201_CREATED)
 
         except SwiftClientError:
@@ -503,6 +469,66 @@ def dependency_undeploy(request, dependency_id, project_id):
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
 
+def deploy_filter(r, filter_data, project_id, container, swift_object, params, token):
+    """
+    Deploys a filter to a project (or a group of projects), container or
+    object, as a new static policy. It is the deployment of PUT
+    /filters/<target>/deploy/<filter>, also called in-process by the actions
+    of the dynamic policies (policies.actions).
+
+    :param filter_data: The filter, as stored in redis.
+    :type filter_data: dict
+    :param params: object_type, object_size, object_tag and params of the
+                   policy, and optionally execution_server and
+                   execution_server_reverse.
+    :type params: dict
+    :param token: The token to upload the storlets to Swift.
+    :return: The id of the static policy.
+    :rtype: int
+    :raises SwiftClientError: If the storlet can not be uploaded to Swift.
+    :raises StorletNotFoundException: If the storlet file is not found.
+    """
+    # Get an identifier of this new policy
+    policy_id = r.incr("policies:id")
+
+    # Set the policy data
+    policy_data = {
+        "policy_id": policy_id,
+        "object_type": params['object_type'],
+        "object_size": params['object_size'],
+        "object_tag": params['object_tag'],
+        "object_name": ', '.join(r.lrange('object_type:' + params['object_type'], 0, -1)),
+        "execution_order": policy_id,
+        "params": params['params'],
+        "callable": False
+    }
+
+    if 'execution_server' in params:
+        if params['execution_server'] != 'default':
+            policy_data['execution_server'] = params['execution_server']
+
+    if 'execution_server_reverse' in params:
+        if params['execution_server_reverse'] != 'default':
+            policy_data['execution_server_reverse'] = params['execution_server_reverse']
+
+    if project_id.startswith('group:'):
+        projects_id = json.loads(r.hgetall('project_group:' + project_id.split(':')[1])['attached_projects'])
+    else:
+        projects_id = [project_id]
+
+    for project in projects_id:
+        if container and swift_object:
+            target = ':'.join([project, container, swift_object])
+        elif container:
+            target = ':'.join([project, container])
+        else:
+            target = project
+
+        set_filter(r, target, filter_data.copy(), policy_data.copy(), token)
+
+    return policy_id
+
+
 def set_filter(r, target, filter_data, parameters, token):
     if filter_data['filter_type'] == 'storlet':
 
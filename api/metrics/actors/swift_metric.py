@@ -1,14 +1,28 @@
 from django.conf import settings
 from redis.exceptions import RedisError
-from threading import Thread
+from api.actors.consumer_service import get_consumer_service
+from api.exceptions import MetricDecodeError
+from metrics.admission import ProjectAdmission
+from metrics.aggregation import ColumnarAggregator, DeviceAggregator
+from metrics.batch import MetricBatch
+from metrics.buffers import MetricBuffer
+from metrics.bus import MetricBusWriter, bus_path
+from metrics.decoder import decode_batch, MetricRecord
+from metrics.delta import DeltaFilter
+from metrics.exporters import get_logstash_exporter, release_logstash_exporter
+from metrics.ingestion import get_ingestion_server
+from metrics.scheduler import get_scheduler
+from metrics.series import SeriesWriter
+from metrics.sharding import ShardedIngestion, check_sharding_settings, merge_partials
+from metrics.sketches import DDSketch
+from metrics.topk import SpaceSaving
+from metrics.windows import EventTimeWindows
+from policies.actors.rule_engine import ENGINE_ID
+from threading import Lock
 import logging
 import redis
-import json
-import socket
 import time
-import Queue
 
-AGGREGATION_INTERVAL = 1
 logger = logging.getLogger(__name__)
 
 
@@ -21,27 +35,58 @@ class SwiftMetric(object):
     actor only sends the necessary information to each observer.
     """
     _tell = ['attach', 'detach', 'notify', 'start_consuming', 'stop_consuming']
-    _ask = ['init_consum', 'stop_actor']
+    _ask = ['init_consum', 'stop_actor', 'get_quantiles', 'get_stats', 'get_top', 'notify_batch']
     _ref = ['attach']
 
-    def __init__(self, metric_id, routing_key):
-        self._observers = {}
+    def __init__(self, metric_id, routing_key, interval=None):
+        self._observers = {}  # {target: {observer_id: proxy}}
+        self._observer_proxies = {}  # {observer_id: proxy}
+        self._batch_observers = set()
+        self._delta_observers = {}  # {observer_id: DeltaFilter}
+        self._bus_observers = set()
+        self._device_observers = {}  # {observer_id: proxy}
         self.value = None
         self.name = None
         self.consumer = None
-
-        self.logstash_host = settings.LOGSTASH_HOST
-        self.logstash_port = settings.LOGSTASH_PORT
+        self.shards = None
+        self.ingestion = None
 
         self.queue = metric_id
         self.name = metric_id
         self.routing_key = routing_key
-        self.logstash_server = (self.logstash_host, self.logstash_port)
-        self.metrics = Queue.Queue()
-
-        # Subprocess to aggregate collected metrics every time interval
-        self.notifier = Thread(target=self._aggregate_and_send_info)
-        self.notifier.start()
+        self.exporter = get_logstash_exporter()
+        if settings.METRIC_INGESTION_WORKERS > 0:
+            check_sharding_settings(metric_id)
+        buffer_settings = settings.METRIC_BUFFERS.get(metric_id, dict())
+        self.metrics = MetricBuffer(buffer_settings.get('size', settings.METRIC_BUFFER_SIZE),
+                                    buffer_settings.get('policy', settings.METRIC_BUFFER_POLICY),
+                                    settings.METRIC_BUFFER_BLOCK_TIMEOUT)
+        # The host sums are only needed by the heavy hitters
+        self.aggregator = ColumnarAggregator(with_hosts=settings.METRIC_TOP_CAPACITY > 0)
+        # Object-server metrics, only kept while there are device observers
+        self.object_metrics = MetricBuffer(buffer_settings.get('size', settings.METRIC_BUFFER_SIZE),
+                                           buffer_settings.get('policy', settings.METRIC_BUFFER_POLICY),
+                                           settings.METRIC_BUFFER_BLOCK_TIMEOUT)
+        self.device_aggregator = DeviceAggregator()
+        # Per-project quotas: the records over the quota are folded into summaries
+        self.admission = None
+        if settings.METRIC_PROJECT_RATE:
+            self.admission = ProjectAdmission(settings.METRIC_PROJECT_RATE, settings.METRIC_PROJECT_BURST,
+                                              settings.METRIC_PROJECT_QUOTAS)
+        if interval is None:
+            interval = settings.METRIC_AGGREGATION_INTERVALS.get(metric_id, settings.METRIC_AGGREGATION_INTERVAL)
+        self.interval = interval
+
+        # Quantile sketches per target: the current window and the previous one
+        self._summary_observers = set()
+        self._folded_observers = set()
+        self.sketch_accuracy = settings.METRIC_SKETCH_ACCURACY
+        self.sketch_window = settings.METRIC_SKETCH_WINDOW
+        self.sketches = dict()
+        self.previous_sketches = dict()
+        self.sketches_start = time.time()
+        self.previous_sketches_start = self.sketches_start
+        self.sketches_lock = Lock()
 
         try:
             self.redis = redis.Redis(connection_pool=settings.REDIS_CON_POOL)
@@ -49,7 +94,36 @@ class SwiftMetric(object):
             logger.info('"Error connecting with Redis DB"')
             print "Error connecting with Redis DB"
 
-    def attach(self, observer):
+        # Heavy hitters (projects, containers and hosts): the current window and the previous one
+        self.top_window = settings.METRIC_TOP_WINDOW
+        self.top_capacity = settings.METRIC_TOP_CAPACITY
+        self.top = self._new_top() if self.top_capacity > 0 else None
+        self.previous_top = self._new_top() if self.top_capacity > 0 else None
+        self.top_start = time.time()
+        self.top_lock = Lock()
+
+        # Aggregation by event time (@timestamp) instead of arrival time
+        self.windows = None
+        self.window_partials = list()  # partial aggregates of the workers waiting for a closed window
+        if settings.METRIC_EVENT_TIME:
+            self.windows = EventTimeWindows(settings.METRIC_WINDOW_LENGTH, settings.METRIC_ALLOWED_LATENESS)
+
+        # Short-term history of the aggregates
+        self.series = None
+        if settings.METRIC_SERIES_ENABLED:
+            self.series = SeriesWriter(self.redis, metric_id, settings.METRIC_SERIES_CONTAINERS, self.interval)
+
+        # Shared-memory bus for the observers in this host
+        self.bus = None
+        if settings.METRIC_BUS_ENABLED:
+            self.bus = MetricBusWriter(bus_path(metric_id), settings.METRIC_BUS_SLOTS, settings.METRIC_BUS_SLOT_SIZE)
+
+        # Aggregate collected metrics every time interval
+        self.scheduler = get_scheduler()
+        self.scheduler.register(self.name, self._process_interval, self.interval)
+
+    def attach(self, observer, summaries=False, targets=None, epsilon=None, relative=False, keyframe=None,
+               bus=False, devices=False, folded=False):
         """
         Asyncronous method. This method allows to be called remotely. It is
         called from observers in order to subscribe in this workload metric.
@@ -59,18 +133,68 @@ class SwiftMetric(object):
 
         :param observer: The PyActor proxy of the observer rule that calls this method.
         :type observer: **any** PyActor Proxy type
+        :param summaries: If True, the observer receives a summary dictionary
+                          (value, count, rate, sum, p50, p95, p99) instead of
+                          the aggregated value.
+        :type summaries: boolean
+        :param targets: The targets of the observer. If they are given, the
+                        observer receives one update_batch(metric_name,
+                        {target: value}) per interval with all of them,
+                        instead of update(metric_name, value).
+        :type targets: list
+        :param epsilon: Enables the delta mode: a target is only sent if its
+                        value moved more than epsilon since the last value
+                        sent to the observer.
+        :type epsilon: float
+        :param relative: If True, epsilon is a fraction of the last value.
+        :type relative: boolean
+        :param keyframe: In delta mode, all the values are sent every keyframe
+                         intervals (METRIC_DELTA_KEYFRAME by default).
+        :type keyframe: int
+        :param bus: If True, the observer reads the aggregates from the
+                    shared-memory bus of this host (metrics.bus), so no
+                    updates are sent to it. Ignored if the bus is disabled.
+        :type bus: boolean
+        :param devices: If True, the observer is subscribed to the object-server
+                        stream instead: it receives one
+                        update_devices(metric_name, {(host, storage_policy,
+                        device): value}) per interval.
+        :type devices: boolean
+        :param folded: If True, an observer of ALL also receives the summaries
+                       of the records folded by the project quotas: a record
+                       per project, without metric_name, with the sum as
+                       value and the number of records in the 'count' key.
+        :type folded: boolean
         """
 
         logger.info('Metric, Attaching observer: ' + str(observer))
-        target = observer.get_target(timeout=2)
         observer_id = observer.get_id()
-
-        if target not in self._observers.keys():
-            self._observers[target] = dict()
-        if observer_id not in self._observers[target].keys():
-            self._observers[target][observer_id] = observer
-
-    def detach(self, observer, target):
+        if devices:
+            self._device_observers[observer_id] = observer
+            self._observer_proxies[observer_id] = observer
+            return
+        if targets is None:
+            targets = [observer.get_target(timeout=2)]
+        else:
+            self._batch_observers.add(observer_id)
+
+        for target in targets:
+            if target not in self._observers.keys():
+                self._observers[target] = dict()
+            if observer_id not in self._observers[target].keys():
+                self._observers[target][observer_id] = observer
+        self._observer_proxies[observer_id] = observer
+        if summaries:
+            self._summary_observers.add(observer_id)
+        if folded:
+            self._folded_observers.add(observer_id)
+        if epsilon is not None:
+            self._delta_observers[observer_id] = DeltaFilter(epsilon, relative,
+                                                             keyframe or settings.METRIC_DELTA_KEYFRAME)
+        if bus and self.bus:
+            self._bus_observers.add(observer_id)
+
+    def detach(self, observer, target=None):
         """
         Asynchronous method. This method allows to be called remotely.
         It is called from observers in order to unsuscribe from this workload
@@ -78,14 +202,31 @@ class SwiftMetric(object):
 
         :param observer: The PyActor actor id of the observer rule that calls this method.
         :type observer: String
+        :param target: The target to unsubscribe from. If it is None, the
+                       observer is unsubscribed from all its targets and from
+                       the object-server stream.
+        :type target: String
         """
-        try:
-            del self._observers[target][observer]
-            if len(self._observers[target]) == 0:
-                del self._observers[target]
-            logger.info('Metric, observer detached: ' + str(observer))
-        except KeyError:
-            pass
+        if target is None:
+            self._device_observers.pop(observer, None)
+        targets = [target] if target is not None else list(self._observers.keys())
+        for target in targets:
+            observers = self._observers.get(target)
+            if observers and observer in observers:
+                del observers[observer]
+                if len(observers) == 0:
+                    del self._observers[target]
+                if observer in self._delta_observers:
+                    self._delta_observers[observer].forget(target)
+
+        if not any(observer in observers for observers in self._observers.values()):
+            if observer not in self._device_observers and self._observer_proxies.pop(observer, None):
+                logger.info('Metric, observer detached: ' + str(observer))
+            self._summary_observers.discard(observer)
+            self._folded_observers.discard(observer)
+            self._batch_observers.discard(observer)
+            self._delta_observers.pop(observer, None)
+            self._bus_observers.discard(observer)
 
     def init_consum(self):
         """
@@ -101,8 +242,18 @@ class SwiftMetric(object):
             self.redis.hmset("metric:" + self.name, {"network_location": self.proxy.actor.url,
                                                      "type": "integer"})
 
-            self.consumer = self.host.spawn(self.id + "_consumer", settings.CONSUMER_MODULE,
-                                            self.queue, self.routing_key, self.proxy)
+            if settings.METRIC_INGESTION_WORKERS > 0:
+                self.shards = ShardedIngestion(self.queue, self.routing_key, settings.METRIC_INGESTION_WORKERS,
+                                               self.interval, self.sketch_accuracy)
+            elif settings.CONSUMER_SERVICE_ENABLED:
+                self.consumer = get_consumer_service().subscribe(self.queue, self.routing_key, self.proxy)
+            else:
+                self.consumer = self.host.spawn(self.id + "_consumer", settings.CONSUMER_MODULE,
+                                                self.queue, self.routing_key, self.proxy)
+            # Metrics sent directly to this host, bypassing RabbitMQ
+            self.ingestion = get_ingestion_server()
+            if self.ingestion:
+                self.ingestion.register(self.routing_key, self._ingest_records)
             self.start_consuming()
         except Exception as e:
             raise ValueError(e.msg)
@@ -114,11 +265,20 @@ class SwiftMetric(object):
         """
         try:
             # Stop observers
-            for tenant in self._observers:
-                for observer in self._observers[tenant].values():
-                    observer.stop_actor()
-                    self.redis.hset(observer.get_id(), 'status', 'Stopped')
-
+            for observer_id, observer in self._observer_proxies.items():
+                if observer_id == ENGINE_ID:
+                    # The rule engine also hosts the policies of other metrics
+                    observer.remove_metric(self.name)
+                    continue
+                observer.stop_actor()
+                self.redis.hset(observer_id, 'status', 'Stopped')
+
+            self.scheduler.unregister(self.name)
+            if self.ingestion:
+                self.ingestion.unregister(self.routing_key)
+            if self.bus:
+                self.bus.close()
+            release_logstash_exporter(self.exporter)
             self.redis.delete("metric:" + self.name)
             self.stop_consuming()
             self.host.stop_actor(self.id)
@@ -131,7 +291,9 @@ class SwiftMetric(object):
         """
         Start the consumer.
         """
-        if self.consumer:
+        if self.shards:
+            self.shards.start()
+        elif self.consumer:
             self.consumer.start_consuming()
         else:
             logger.info('Metric, No consumer available to start')
@@ -140,67 +302,383 @@ class SwiftMetric(object):
         """
         Stop the consumer.
         """
-        if self.consumer:
+        if self.shards:
+            self.shards.stop()
+        elif self.consumer:
             self.consumer.stop_consuming()
         else:
             logger.info('Metric, No consumer available to stop')
 
-    def notify(self, body):
+    def notify(self, body, content_type=None):
         """
         Method called from the consumer to indicate the value consumed from the
         rabbitmq queue. After receive the value, this value is communicated to
-        all the observers subscribed to this metric.
+        all the observers subscribed to this metric. A message may also carry
+        a batch of metrics (see metrics.decoder.decode_batch).
 
         {'container': 'crystal/data', 'metric_name': 'bandwidth', '@timestamp': '2017-09-09T18:00:18.331492+02:00',
          'value': 16.4375, 'project': 'crystal', 'host': 'controller', 'method': 'GET', 'server_type': 'proxy'}
         """
-        metric = eval(body)
-        if metric['server_type'] == 'proxy':
-            self.metrics.put(metric)
-        self._send_data_to_logstash(metric)
+        self._ingest_records(self._decode(body, content_type))
 
-    def _send_data_to_logstash(self, metric):
+    def notify_batch(self, bodies, content_types=None):
+        """
+        Synchronous method. Called from the consumer with a batch of messages
+        consumed from the rabbitmq queue. The consumer acknowledges the batch
+        when this method returns.
+
+        :param bodies: The raw messages.
+        :type bodies: list of str
+        :param content_types: The content type of each message, if the
+                              consumer received any.
+        :type content_types: list of str
+        """
+        records = list()
+        for position, body in enumerate(bodies):
+            records.extend(self._decode(body, content_types[position] if content_types else None))
+        self._ingest_records(records)
+
+    @staticmethod
+    def _decode(body, content_type):
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            message = json.dumps(metric)+'\n'
-            sock.sendto(message, self.logstash_server)
-        except socket.error:
-            logger.info("Swift Metric: Error sending monitoring data to logstash.")
-
-    def _aggregate_and_send_info(self):
-        while True:
-            time.sleep(AGGREGATION_INTERVAL)
-            aggregate = dict()
-            metric_list = list()
-
-            while not self.metrics.empty():
-                metric = self.metrics.get()
-                metric_list.append(metric)
-                try:
-                    project = metric['project']
-                    container = metric['container']
-                    value = metric['value']
+            records, invalid = decode_batch(body, content_type)
+        except MetricDecodeError as e:
+            logger.info("Swift Metric, Error decoding metric: " + str(e))
+            return []
+        if invalid:
+            logger.info("Swift Metric, " + str(invalid) + " invalid metrics in a batch")
+        return records
+
+    def _ingest_records(self, records):
+        """
+        Buffers the proxy metrics of a batch and exports all of them. It is
+        also called from the thread of the ingestion server (metrics.ingestion)
+        with the records received from the datagram socket.
 
-                    if project not in aggregate:
-                        aggregate[project] = 0
-                    if container not in aggregate:
-                        aggregate[container] = 0
+        :param records: The decoded metrics.
+        :type records: list of metrics.decoder.MetricRecord
+        """
+        proxy_metrics = list()
+        object_metrics = list()
+        for metric in records:
+            if metric.server_type == 'proxy':
+                proxy_metrics.append(metric)
+            elif metric.server_type == 'object':
+                object_metrics.append(metric)
+            self._send_data_to_logstash(metric)
+
+        if self.admission and proxy_metrics:
+            proxy_metrics = self.admission.admit(proxy_metrics)
+        self.metrics.extend(proxy_metrics)
+        if object_metrics and self._device_observers:
+            self.object_metrics.extend(object_metrics)
 
-                    aggregate[project] += value
-                    aggregate[container] += value
+    def _send_data_to_logstash(self, metric):
+        self.exporter.export(metric)
 
-                except:
-                    logger.info("Swift Metric, Error parsing metric: " + str(metric))
+    def _drain_metrics(self):
+        """
+        Returns the metrics of the interval and the weight of each one.
+        """
+        return self.metrics.drain()
 
-            try:
-                for target in aggregate:
-                    if target in self._observers:
-                        for observer in self._observers[target].values():
-                            observer.update(self.name, aggregate[target])
+    def _process_interval(self, tick=None):
+        """
+        Aggregates the metrics collected during the last interval and sends
+        the data to the observers. It is called by the tick scheduler.
 
-                if "ALL" in self._observers and len(metric_list) > 0:
-                    for observer in self._observers["ALL"].values():
-                        observer.update(self.name, metric_list)
+        :param tick: The (aligned) time of the tick.
+        :type tick: float
+        """
+        now = tick or time.time()
+        metric_list, weight = self._drain_metrics()
+        partials = None
+        if self.shards:
+            self.shards.ship_records("ALL" in self._observers)
+            partials = self.shards.collect(now)
+        if self.windows is None:
+            folded = self.admission.drain() if self.admission else None
+            self._aggregate_and_notify(metric_list, weight, now, folded, partials)
+        else:
+            # Event time: aggregate the windows closed by the watermark. The
+            # folded records and the partial aggregates of the workers
+            # (arrival time) go with the last closed window, so they are kept
+            # until the watermark closes one.
+            if partials:
+                self.window_partials.extend(partials)
+            self.windows.add_records(metric_list, now, weight)
+            closed = self.windows.advance(now)
+            for position, (start, records, window_weight) in enumerate(closed):
+                if position == len(closed) - 1:
+                    folded = self.admission.drain() if self.admission else None
+                    partials, self.window_partials = self.window_partials, list()
+                    self._aggregate_and_notify(records, window_weight, start, folded, partials)
+                else:
+                    self._aggregate_and_notify(records, window_weight, start)
+        self._notify_devices()
+
+    def _notify_devices(self):
+        """
+        Aggregates the object-server metrics of the interval by host, storage
+        policy and device, and sends them to the device observers.
+        """
+        if not len(self.object_metrics):
+            return
+        records, weight = self.object_metrics.drain()
+        if not self._device_observers:
+            return
+        devices = self.device_aggregator.aggregate(records, weight)
+        for observer in self._device_observers.values():
+            try:
+                observer.update_devices(self.name, devices)
+            except Exception as e:
+                logger.info("Swift Metric: Error sending monitoring data to observer: "+str(e))
 
+    def _aggregate_and_notify(self, metric_list, weight, timestamp, folded=None, partials=None):
+        """
+        Aggregates the metrics of an interval (or event-time window) and sends
+        the data to the observers.
+
+        :param metric_list: The metric records.
+        :type metric_list: list of metrics.decoder.MetricRecord
+        :param weight: The number of received records each record represents.
+        :type weight: float
+        :param timestamp: The time of the interval, or the start of the window.
+        :type timestamp: float
+        :param folded: The summaries of the records over the project quotas.
+        :type folded: dict
+        :param partials: The partial aggregates of the ingestion workers.
+        :type partials: list of metrics.sharding.PartialAggregate
+        """
+        self.aggregator.add_records(metric_list)
+        aggregate = self.aggregator.flush(sketch_accuracy=self.sketch_accuracy)
+        if weight != 1.0:
+            aggregate.scale(weight)
+        sketches = aggregate.sketches or dict()
+        hosts = aggregate.hosts or dict()
+        aggregate = aggregate.as_dict()
+        if partials:
+            # The workers fold the records over their share of the project quotas
+            folded = dict(folded) if folded else dict()
+            merge_partials(partials, aggregate, sketches, metric_list, hosts, folded)
+        summaries = self._add_folded(folded, aggregate, sketches) if folded else []
+        if sketches:
+            self._update_sketches(sketches)
+        if self.top is not None:
+            self._update_top(aggregate, hosts)
+        if self.series:
+            self.series.write(timestamp, aggregate)
+        overflow = self.bus.publish(timestamp, aggregate) if self.bus else ()
+
+        updates = self._build_updates(aggregate, sketches)
+        for observer_id, values in updates.iteritems():
+            if observer_id in self._bus_observers:
+                # The targets that did not fit in the bus are sent as usual
+                values = dict((target, value) for target, value in values.iteritems() if target in overflow)
+                if not values:
+                    continue
+            if observer_id in self._delta_observers:
+                values = self._delta_observers[observer_id].filter(values)
+                if not values:
+                    continue
+            observer = self._observer_proxies[observer_id]
+            try:
+                if observer_id in self._batch_observers:
+                    observer.update_batch(self.name, values)
+                else:
+                    for value in values.itervalues():
+                        observer.update(self.name, value)
             except Exception as e:
                 logger.info("Swift Metric: Error sending monitoring data to observer: "+str(e))
+
+        if "ALL" in self._observers and (metric_list or summaries):
+            # The summaries are only sent to the observers that asked for them
+            payloads = dict()
+            for observer_id, observer in self._observers["ALL"].items():
+                with_folded = bool(summaries) and observer_id in self._folded_observers
+                if not with_folded and not metric_list:
+                    continue
+                if with_folded not in payloads:
+                    payloads[with_folded] = self._all_payload(metric_list + summaries if with_folded else metric_list)
+                try:
+                    observer.update(self.name, payloads[with_folded])
+                except Exception as e:
+                    logger.info("Swift Metric: Error sending monitoring data to observer: "+str(e))
+
+    @staticmethod
+    def _all_payload(records):
+        """
+        Returns the records of the interval as they are sent to the observers
+        of ALL: a MetricBatch, or a list of dictionaries.
+        """
+        if settings.METRIC_COLUMNAR_BATCHES:
+            return MetricBatch.from_records(records)
+        return [record.as_dict() for record in records]
+
+    def _add_folded(self, folded, aggregate, sketches):
+        """
+        Adds the summaries of the folded records to the aggregate and to the
+        sketches (count values at their mean).
+
+        :return: A record per project, with the sum as value and the number of
+                 folded records in the 'count' key, for the observers of ALL
+                 that receive them.
+        :rtype: list
+        """
+        summaries = list()
+        for project, (count, total) in folded.iteritems():
+            if project is not None:
+                aggregate[project] = aggregate.get(project, 0.0) + total
+                if self.sketch_accuracy:
+                    if project not in sketches:
+                        sketches[project] = DDSketch(self.sketch_accuracy)
+                    sketches[project].add(total / count, count)
+            summaries.append(MetricRecord(None, None, total, project, None, None, None, 'proxy',
+                                          {'count': count}))
+        return summaries
+
+    def _build_updates(self, aggregate, sketches):
+        """
+        Groups the values of the interval by observer, so each observer gets
+        a single message with all its targets.
+
+        :return: A {observer_id: {target: value}} dictionary.
+        """
+        updates = dict()
+        summaries = dict()
+        elapsed = self.windows.length if self.windows else self.interval
+        # Walk the shorter side of the target index and the aggregate
+        targets = self._observers if len(self._observers) < len(aggregate) else aggregate
+        for target in targets:
+            if target not in aggregate or target not in self._observers:
+                continue
+            for observer_id in self._observers[target]:
+                if observer_id in self._summary_observers and target in sketches:
+                    if target not in summaries:
+                        summaries[target] = self._summary(sketches[target], elapsed)
+                    value = summaries[target]
+                else:
+                    value = aggregate[target]
+                if observer_id in updates:
+                    updates[observer_id][target] = value
+                else:
+                    updates[observer_id] = {target: value}
+        return updates
+
+    @staticmethod
+    def _summary(sketch, elapsed):
+        summary = sketch.summary()
+        summary['value'] = summary['sum']
+        summary['rate'] = summary['count'] / float(elapsed)
+        return summary
+
+    def _update_sketches(self, sketches):
+        """
+        Merges the sketches of the last interval into the window sketches.
+        When the window expires, it becomes the previous window, so memory per
+        target is bounded by two sketches.
+        """
+        now = time.time()
+        with self.sketches_lock:
+            if now - self.sketches_start >= self.sketch_window:
+                self.previous_sketches = self.sketches
+                self.previous_sketches_start = self.sketches_start
+                self.sketches = dict()
+                self.sketches_start = now
+            for target, sketch in sketches.items():
+                if target in self.sketches:
+                    self.sketches[target].merge(sketch)
+                else:
+                    self.sketches[target] = sketch
+
+    def _new_top(self):
+        return dict((dimension, SpaceSaving(self.top_capacity)) for dimension in ('projects', 'containers', 'hosts'))
+
+    def _update_top(self, aggregate, hosts):
+        """
+        Adds the values of the interval to the heavy-hitter summaries. The
+        project and container sums come from the aggregate, and the host sums
+        from the columnar aggregator.
+        """
+        projects = dict()
+        containers = dict()
+        for target, value in aggregate.iteritems():
+            if target is None or target == 'ALL':
+                continue
+            if '/' in target:
+                containers[target] = value
+            else:
+                projects[target] = value
+        hosts = dict(hosts)
+        hosts.pop(None, None)
+
+        now = time.time()
+        with self.top_lock:
+            if now - self.top_start >= self.top_window:
+                self.previous_top = self.top
+                self.top = self._new_top()
+                self.top_start = now
+            self.top['projects'].update(projects)
+            self.top['containers'].update(containers)
+            self.top['hosts'].update(hosts)
+
+    def get_top(self, k=20):
+        """
+        Synchronous method. This method allows to be called remotely. Returns
+        the k projects, containers and hosts with the highest values, over the
+        current top window and the previous one.
+
+        :return: {dimension: [{'target', 'value', 'error'}, ...]}. The value
+                 overestimates the real one by at most error.
+        :rtype: dict
+        """
+        if self.top is None:
+            return dict()
+        with self.top_lock:
+            top = dict()
+            for dimension, summary in self.top.items():
+                merged = summary.merge(self.previous_top[dimension])
+                top[dimension] = [{'target': target, 'value': value, 'error': error}
+                                  for target, value, error in merged.top(k)]
+        return top
+
+    def get_stats(self):
+        """
+        Synchronous method. This method allows to be called remotely. Returns
+        the counters of the metric buffer (received, dropped, sampled and
+        blocked records), of the event-time windows (late records), of the
+        Logstash exporter, of the datagram ingestion server, of the ingestion
+        workers (late partial aggregates), of the project quotas (folded
+        records) and of the shared-memory bus (targets sent as messages
+        because they did not fit in a slot).
+        """
+        stats = {'buffer': self.metrics.stats(), 'logstash': self.exporter.stats()}
+        if self.windows:
+            stats['windows'] = self.windows.stats()
+        if self.ingestion:
+            stats['ingestion'] = self.ingestion.stats()
+        if self.shards:
+            stats['shards'] = self.shards.stats()
+        if self.admission:
+            stats['admission'] = self.admission.stats()
+        if self.bus:
+            stats['bus'] = {'overflow': self.bus.overflow}
+        return stats
+
+    def get_quantiles(self):
+        """
+        Synchronous method. This method allows to be called remotely. Returns
+        the summary (count, rate, sum, p50, p95, p99) of each target, computed
+        over the current sketch window and the previous one.
+        """
+        with self.sketches_lock:
+            elapsed = max(time.time() - self.previous_sketches_start, self.interval)
+            quantiles = dict()
+            for target in set(self.sketches) | set(self.previous_sketches):
+                sketch = DDSketch(self.sketch_accuracy)
+                if target in self.previous_sketches:
+                    sketch.merge(self.previous_sketches[target])
+                if target in self.sketches:
+                    sketch.merge(self.sketches[target])
+                quantiles[target] = self._summary(sketch, elapsed)
+        return quantiles
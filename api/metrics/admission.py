@@ -0,0 +1,95 @@
+from threading import Lock
+import time
+
+MAX_PROJECTS = 100000  # token buckets before resetting the table
+
+
+class ProjectAdmission(object):
+    """
+    Per-project token-bucket admission of the metric records of a workload
+    metric. Each project may send *rate* records per second, with bursts of
+    up to *burst* records. The records over the quota are not kept: they are
+    folded into a (count, sum) summary per project, so the cost of an
+    interval is bounded by the number of projects instead of the number of
+    requests (or of their containers and hosts), and the project sums are
+    still exact. The container and host sums do not include them.
+    """
+
+    def __init__(self, rate, burst, quotas=None):
+        """
+        :param rate: Records per second admitted for each project.
+        :type rate: float
+        :param burst: Size of the token bucket of each project.
+        :type burst: float
+        :param quotas: Per-project (rate, burst) overrides.
+        :type quotas: dict
+        """
+        self.rate = rate
+        self.burst = burst
+        self.quotas = quotas or dict()
+        self._buckets = dict()  # {project: [tokens, last refill, rate, burst]}
+        self._folded = dict()  # {project: [count, sum]}
+        self._lock = Lock()
+
+        self.admitted = 0
+        self.folded = 0
+
+    def admit(self, records, now=None):
+        """
+        Returns the records admitted by the quotas of their projects and folds
+        the rest.
+
+        :param records: The metric records.
+        :type records: list of metrics.decoder.MetricRecord
+        :rtype: list
+        """
+        now = now or time.time()
+        admitted = list()
+        buckets = self._buckets
+        folded = self._folded
+        with self._lock:
+            if len(buckets) > MAX_PROJECTS:
+                buckets.clear()
+            for record in records:
+                bucket = buckets.get(record.project)
+                if bucket is None:
+                    rate, burst = self.quotas.get(record.project, (self.rate, self.burst))
+                    bucket = buckets[record.project] = [burst, now, rate, burst]
+                elif bucket[1] != now:
+                    bucket[0] = min(bucket[3], bucket[0] + (now - bucket[1]) * bucket[2])
+                    bucket[1] = now
+                if bucket[0] >= 1:
+                    bucket[0] -= 1
+                    admitted.append(record)
+                    continue
+                try:
+                    value = float(record.value)
+                except (TypeError, ValueError):
+                    continue
+                summary = folded.get(record.project)
+                if summary is None:
+                    folded[record.project] = [1, value]
+                else:
+                    summary[0] += 1
+                    summary[1] += value
+            self.admitted += len(admitted)
+            self.folded += len(records) - len(admitted)
+        return admitted
+
+    def drain(self):
+        """
+        Returns the summaries of the folded records and resets them.
+
+        :return: {project: [count, sum]}
+        :rtype: dict
+        """
+        with self._lock:
+            folded = self._folded
+            self._folded = dict()
+        return folded
+
+    def stats(self):
+        """
+        Returns the admission counters.
+        """
+        return {'admitted': self.admitted, 'folded': self.folded, 'projects': len(self._buckets)}
@@ -0,0 +1,244 @@
+from operator import itemgetter
+from metrics.sketches import build_sketches
+import logging
+import numpy
+
+logger = logging.getLogger(__name__)
+
+INITIAL_CAPACITY = 4096  # messages
+MAX_TARGETS = 1000000  # interned targets before resetting the table
+
+# MetricRecord fields (records are tuples, itemgetter avoids the attribute lookup)
+_value = itemgetter(2)
+_project = itemgetter(3)
+_container = itemgetter(4)
+_host = itemgetter(5)
+
+
+class IntervalAggregate(object):
+    """
+    Result of an aggregation interval: parallel arrays with the targets that
+    received values and their sum, count and maximum, and optionally a
+    quantile sketch per target and the {host: sum} of the hosts.
+    """
+    __slots__ = ('targets', 'sums', 'counts', 'maxima', 'sketches', 'hosts')
+
+    def __init__(self, targets, sums, counts, maxima, sketches=None, hosts=None):
+        self.targets = targets
+        self.sums = sums
+        self.counts = counts
+        self.maxima = maxima
+        self.sketches = sketches
+        self.hosts = hosts
+
+    def __len__(self):
+        return len(self.targets)
+
+    def scale(self, weight):
+        """
+        Rescales the sums, the counts and the sketches by the weight of each
+        record (sampled intervals). The maxima are not changed.
+        """
+        self.sums = self.sums * weight
+        self.counts = self.counts * weight
+        if self.hosts:
+            self.hosts = dict((host, value * weight) for host, value in self.hosts.iteritems())
+        if self.sketches:
+            for sketch in self.sketches.values():
+                sketch.scale(weight)
+
+    def as_dict(self, column='sums'):
+        """
+        Returns a {target: value} dictionary of the given column.
+        """
+        return dict(zip(self.targets, getattr(self, column).tolist()))
+
+
+class ColumnarAggregator(object):
+    """
+    Aggregates workload metric records per target (project and container).
+    Targets are interned to integer ids and the values of an interval are
+    accumulated in preallocated NumPy arrays, so the group-by sums, counts
+    and maxima are computed in batch when the interval is flushed. With
+    with_hosts, the sum of each host is computed too (in its own table).
+    """
+
+    def __init__(self, capacity=INITIAL_CAPACITY, with_hosts=False):
+        self.with_hosts = with_hosts
+        self._target_ids = dict()
+        self._targets = list()
+        self._host_ids = dict()
+        self._hosts_list = list()
+        self._projects = numpy.empty(capacity, dtype=numpy.int64)
+        self._containers = numpy.empty(capacity, dtype=numpy.int64)
+        self._hosts = numpy.empty(capacity if with_hosts else 0, dtype=numpy.int64)
+        self._values = numpy.empty(capacity, dtype=numpy.float64)
+        self._size = 0
+
+    def _target_id(self, target):
+        target_id = self._target_ids.get(target)
+        if target_id is None:
+            target_id = len(self._targets)
+            self._target_ids[target] = target_id
+            self._targets.append(target)
+        return target_id
+
+    def _host_id(self, host):
+        host_id = self._host_ids.get(host)
+        if host_id is None:
+            host_id = len(self._hosts_list)
+            self._host_ids[host] = host_id
+            self._hosts_list.append(host)
+        return host_id
+
+    def _reserve(self, size):
+        capacity = len(self._values)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        columns = ('_projects', '_containers', '_hosts', '_values') if self.with_hosts else \
+            ('_projects', '_containers', '_values')
+        for column in columns:
+            old = getattr(self, column)
+            new = numpy.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, column, new)
+
+    def add(self, project, container, value, host=None):
+        """
+        Adds the value of one message to its project and container.
+        """
+        value = float(value)
+        self._reserve(self._size + 1)
+        n = self._size
+        self._projects[n] = self._target_id(project)
+        self._containers[n] = self._target_id(container)
+        if self.with_hosts:
+            self._hosts[n] = self._host_id(host)
+        self._values[n] = value
+        self._size = n + 1
+
+    def add_records(self, records):
+        """
+        Adds a list of metric records.
+
+        :param records: The metric records of the interval.
+        :type records: list of metrics.decoder.MetricRecord
+        """
+        count = len(records)
+        if not count:
+            return
+        target_ids = self._target_ids
+        projects = map(target_ids.get, map(_project, records))
+        containers = map(target_ids.get, map(_container, records))
+        if None in projects or None in containers:
+            projects = map(self._target_id, map(_project, records))
+            containers = map(self._target_id, map(_container, records))
+        try:
+            values = numpy.fromiter(map(_value, records), numpy.float64, count)
+        except (TypeError, ValueError):
+            # Slow path: skip the invalid records
+            for record in records:
+                try:
+                    self.add(record.project, record.container, record.value, record.host)
+                except (TypeError, ValueError):
+                    logger.info("Swift Metric, Error parsing metric: " + str(record))
+            return
+
+        start = self._size
+        self._reserve(start + count)
+        self._projects[start:start + count] = projects
+        self._containers[start:start + count] = containers
+        if self.with_hosts:
+            host_ids = self._host_ids
+            hosts = map(host_ids.get, map(_host, records))
+            if None in hosts:
+                hosts = map(self._host_id, map(_host, records))
+            self._hosts[start:start + count] = hosts
+        self._values[start:start + count] = values
+        self._size = start + count
+
+    def flush(self, with_maxima=False, sketch_accuracy=None):
+        """
+        Computes the aggregates of the interval and resets the accumulators.
+        The maxima and the quantile sketches (with the given relative
+        accuracy) are only computed if they are requested.
+
+        :return: The aggregates of the targets that received values.
+        :rtype: IntervalAggregate
+        """
+        n = self._size
+        num_targets = len(self._targets)
+        ids = numpy.concatenate((self._projects[:n], self._containers[:n]))
+        values = numpy.concatenate((self._values[:n], self._values[:n]))
+
+        counts = numpy.bincount(ids, minlength=num_targets)
+        sums = numpy.bincount(ids, weights=values, minlength=num_targets)
+        active = numpy.flatnonzero(counts)
+        targets = [self._targets[i] for i in active.tolist()]
+        maxima = None
+        if with_maxima:
+            maxima = numpy.full(num_targets, -numpy.inf)
+            numpy.maximum.at(maxima, ids, values)
+            maxima = maxima[active]
+        sketches = None
+        if sketch_accuracy:
+            sketches = build_sketches(ids, values, self._targets, sketch_accuracy)
+        hosts = None
+        if self.with_hosts:
+            host_sums = numpy.bincount(self._hosts[:n], weights=self._values[:n], minlength=len(self._hosts_list))
+            active_hosts = numpy.flatnonzero(numpy.bincount(self._hosts[:n], minlength=len(self._hosts_list)))
+            hosts = dict(zip([self._hosts_list[i] for i in active_hosts.tolist()], host_sums[active_hosts].tolist()))
+        aggregate = IntervalAggregate(targets, sums[active], counts[active], maxima, sketches, hosts)
+
+        self._size = 0
+        if num_targets > MAX_TARGETS:
+            self._target_ids = dict()
+            self._targets = list()
+        if len(self._hosts_list) > MAX_TARGETS:
+            self._host_ids = dict()
+            self._hosts_list = list()
+        return aggregate
+
+
+class DeviceAggregator(object):
+    """
+    Aggregates object-server metric records per (host, storage policy,
+    device). The storage policy and the device are the storage_policy and
+    device keys of the messages (None if they are absent).
+    """
+
+    def __init__(self, policy_key='storage_policy', device_key='device'):
+        self.policy_key = policy_key
+        self.device_key = device_key
+
+    def aggregate(self, records, weight=1.0):
+        """
+        Returns the sum of the values of each (host, storage policy, device).
+
+        :param records: The object-server metric records of the interval.
+        :type records: list of metrics.decoder.MetricRecord
+        :param weight: The number of received records each record represents.
+        :type weight: float
+        :rtype: dict
+        """
+        policy_key = self.policy_key
+        device_key = self.device_key
+        sums = dict()
+        for record in records:
+            try:
+                value = float(record.value)
+            except (TypeError, ValueError):
+                logger.info("Swift Metric, Error parsing metric: " + str(record))
+                continue
+            extra = record.extra
+            if extra:
+                key = (record.host, extra.get(policy_key), extra.get(device_key))
+            else:
+                key = (record.host, None, None)
+            sums[key] = sums.get(key, 0.0) + value
+        if weight != 1.0:
+            for key in sums:
+                sums[key] *= weight
+        return sums
@@ -0,0 +1,193 @@
+from operator import itemgetter
+from metrics.decoder import MetricRecord
+import numpy
+
+# Dictionary-encoded columns of a batch
+STRING_FIELDS = ('metric_name', 'project', 'container', 'host', 'method', 'server_type')
+MISSING = -1
+
+_value = itemgetter(2)
+
+
+class MetricBatch(object):
+    """
+    Columnar batch of workload metrics. SwiftMetric builds one per interval
+    for the observers subscribed to ALL when METRIC_COLUMNAR_BATCHES is
+    enabled, instead of a list of dictionaries.
+
+    The values are a float array, with NaN for the invalid ones. The strings
+    (project, container, host, ... and extra keys such as storage_policy)
+    are dictionary-encoded: each column is an array of codes into one table
+    of distinct strings. The timestamps and the original values are kept as
+    lists.
+
+    Iterating or indexing a batch returns a dictionary per metric, as the
+    former list did, and slicing it returns a smaller batch. Controllers of
+    large clusters should use column(), values and group_sum() instead.
+    """
+
+    def __init__(self, strings, codes, extra_codes, values, timestamps, raw_values):
+        self.strings = strings
+        self.codes = codes  # {field: numpy.ndarray of codes}
+        self.extra_codes = extra_codes  # {key: numpy.ndarray of codes, MISSING if absent}
+        self.values = values
+        self.timestamps = timestamps
+        self.raw_values = raw_values  # the values as decoded (int, float, ...)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Builds a batch from metric records.
+
+        :param records: The metric records.
+        :type records: list of metrics.decoder.MetricRecord
+        """
+        strings = list()
+        index = dict()
+
+        def encode_column(column):
+            # Codes are assigned to the distinct values first, so the column
+            # is encoded with C-level lookups
+            try:
+                for value in set(column):
+                    if value not in index:
+                        index[value] = len(strings)
+                        strings.append(value)
+                return map(index.__getitem__, column)
+            except TypeError:
+                # Unhashable values are stored without deduplication
+                codes = list()
+                for value in column:
+                    try:
+                        code = index.get(value)
+                        if code is None:
+                            code = index[value] = len(strings)
+                            strings.append(value)
+                    except TypeError:
+                        code = len(strings)
+                        strings.append(value)
+                    codes.append(code)
+                return codes
+
+        count = len(records)
+        codes = dict()
+        for position, field in enumerate(MetricRecord._fields):
+            if field in STRING_FIELDS:
+                codes[field] = numpy.array(encode_column(map(itemgetter(position), records)), dtype=numpy.int32)
+
+        extra_columns = dict()  # {key: (rows, values)}
+        for row, record in enumerate(records):
+            if record.extra:
+                for key, value in record.extra.iteritems():
+                    column = extra_columns.get(key)
+                    if column is None:
+                        column = extra_columns[key] = (list(), list())
+                    column[0].append(row)
+                    column[1].append(value)
+        extra_codes = dict()
+        for key, (rows, column) in extra_columns.iteritems():
+            extra_codes[key] = numpy.full(count, MISSING, dtype=numpy.int32)
+            extra_codes[key][rows] = encode_column(column)
+
+        raw_values = map(_value, records)
+        try:
+            values = numpy.fromiter(raw_values, numpy.float64, count)
+        except (TypeError, ValueError):
+            values = numpy.empty(count, dtype=numpy.float64)
+            for row, value in enumerate(raw_values):
+                try:
+                    values[row] = value
+                except (TypeError, ValueError):
+                    values[row] = numpy.nan
+        timestamps = [record.timestamp for record in records]
+        return cls(strings, codes, extra_codes, values, timestamps, raw_values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            # The string table is shared with the sliced batch
+            return MetricBatch(self.strings,
+                               dict((field, column[row]) for field, column in self.codes.iteritems()),
+                               dict((key, column[row]) for key, column in self.extra_codes.iteritems()),
+                               self.values[row], self.timestamps[row], self.raw_values[row])
+        metric = dict()
+        strings = self.strings
+        for key, column in self.extra_codes.iteritems():
+            code = column[row]
+            if code != MISSING:
+                metric[key] = strings[code]
+        for field, column in self.codes.iteritems():
+            metric[field] = strings[column[row]]
+        metric['@timestamp'] = self.timestamps[row]
+        metric['value'] = self.raw_values[row]
+        return metric
+
+    def __iter__(self):
+        for row in xrange(len(self.values)):
+            yield self[row]
+
+    def to_list(self):
+        """
+        Returns the batch as a list of dictionaries.
+        """
+        return list(self)
+
+    def column(self, field):
+        """
+        Returns the decoded values of a string field or extra key (None where
+        an extra key is absent).
+        """
+        if field in self.codes:
+            return [self.strings[code] for code in self.codes[field].tolist()]
+        if field in self.extra_codes:
+            strings = self.strings
+            return [strings[code] if code != MISSING else None for code in self.extra_codes[field].tolist()]
+        raise KeyError(field)
+
+    def _codes(self, field):
+        if field in self.codes:
+            return self.codes[field]
+        return self.extra_codes[field]
+
+    def group_sum(self, *fields):
+        """
+        Returns the sum of the values grouped by one or more fields (string
+        fields or extra keys). Rows with an absent extra key or an invalid
+        value are ignored.
+
+        :return: {value: sum} for one field, {(value, ...): sum} for more.
+        :rtype: dict
+        """
+        if not len(self.values):
+            return dict()
+        columns = [self._codes(field).astype(numpy.int64) for field in fields]
+        valid = ~numpy.isnan(self.values)
+        for column in columns:
+            valid &= column != MISSING
+        columns = [column[valid] for column in columns]
+        values = self.values[valid]
+        if not len(values):
+            return dict()
+
+        # Combine the codes of the fields into a single int64 key. If the key
+        # of all the fields could overflow, the key is renumbered (0..groups)
+        # after each field, so it stays below rows * distinct strings.
+        width = len(self.strings)
+        compact = width ** len(fields) > numpy.iinfo(numpy.int64).max
+        keys = numpy.zeros(len(values), dtype=numpy.int64)
+        for column in columns:
+            keys = keys * width + column
+            if compact:
+                keys = numpy.unique(keys, return_inverse=True)[1].astype(numpy.int64)
+        unique, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+        sums = numpy.bincount(inverse, weights=values)
+
+        # Each group is decoded from its first row
+        groups = dict()
+        strings = self.strings
+        decoded = [[strings[code] for code in column[first].tolist()] for column in columns]
+        for group, total in zip(zip(*decoded), sums.tolist()):
+            groups[group[0] if len(fields) == 1 else group] = total
+        return groups
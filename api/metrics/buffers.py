@@ -0,0 +1,116 @@
+from collections import deque
+from threading import Condition
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+SAMPLE = 'sample'
+BLOCK = 'block'
+
+
+class MetricBuffer(object):
+    """
+    Bounded buffer of the metric records received during an aggregation
+    interval. When it is full, the overflow policy decides what happens:
+
+    - drop_oldest: the oldest records are discarded.
+    - sample: a uniform sample (reservoir) of the interval is kept, and drain()
+      returns the weight that rescales the aggregates to the received volume.
+    - block: the producer (the consumer delivering the messages) waits until
+      the buffer is drained, up to block_timeout seconds per call. Then the
+      records that do not fit are dropped.
+    """
+
+    def __init__(self, capacity, policy=DROP_OLDEST, block_timeout=5):
+        if policy not in (DROP_OLDEST, SAMPLE, BLOCK):
+            raise ValueError("Invalid metric buffer policy: " + str(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._condition = Condition()
+        self._records = self._new_buffer()
+        self._seen = 0  # records received in the current interval
+
+        self.received = 0
+        self.dropped = 0
+        self.sampled = 0
+        self.blocked = 0
+
+    def _new_buffer(self):
+        if self.policy == DROP_OLDEST:
+            return deque(maxlen=self.capacity)
+        return list()
+
+    def __len__(self):
+        return len(self._records)
+
+    def append(self, record):
+        self.extend((record,))
+
+    def extend(self, records):
+        """
+        Adds the records, applying the overflow policy if the buffer is full.
+        With the block policy, the whole call waits up to block_timeout.
+        """
+        deadline = None
+        with self._condition:
+            buf = self._records
+            for record in records:
+                self.received += 1
+                self._seen += 1
+                if len(buf) < self.capacity:
+                    buf.append(record)
+                elif self.policy == DROP_OLDEST:
+                    buf.append(record)
+                    self.dropped += 1
+                elif self.policy == SAMPLE:
+                    # Reservoir sampling: every record of the interval is
+                    # kept with the same probability
+                    self.sampled += 1
+                    index = random.randint(0, self._seen - 1)
+                    if index < self.capacity:
+                        buf[index] = record
+                else:
+                    self.blocked += 1
+                    if deadline is None:
+                        deadline = time.time() + self.block_timeout
+                    while len(self._records) >= self.capacity and time.time() < deadline:
+                        self._condition.wait(deadline - time.time())
+                    buf = self._records
+                    if len(buf) < self.capacity:
+                        buf.append(record)
+                    else:
+                        self.dropped += 1
+
+    def drain(self):
+        """
+        Returns the buffered records and empties the buffer.
+
+        :return: The records and the weight of each record: the number of
+                 received records each one represents (1.0 unless sampled).
+        :rtype: (list, float)
+        """
+        with self._condition:
+            records = self._records
+            seen = self._seen
+            self._records = self._new_buffer()
+            self._seen = 0
+            self._condition.notify_all()
+
+        weight = 1.0
+        if records and seen > len(records) and self.policy == SAMPLE:
+            weight = seen / float(len(records))
+        if not isinstance(records, list):
+            records = list(records)
+        return records, weight
+
+    def stats(self):
+        """
+        Returns the buffer counters.
+        """
+        return {'policy': self.policy, 'capacity': self.capacity, 'queued': len(self._records),
+                'received': self.received, 'dropped': self.dropped, 'sampled': self.sampled,
+                'blocked': self.blocked}
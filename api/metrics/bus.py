@@ -0,0 +1,359 @@
+from django.conf import settings
+from threading import Thread, Event, Lock
+import errno
+import itertools
+import logging
+import mmap
+import os
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'CRYSBUS1'
+# magic, slots, slot size, generation, last written sequence, writer pid
+HEADER = struct.Struct('<8sIIQQI')
+WRITE_SEQ = struct.Struct('<Q')
+WRITE_SEQ_OFFSET = 24
+# sequence, tick, payload length, entries
+SLOT_HEADER = struct.Struct('<QdII')
+# value, target length (followed by the utf-8 target)
+ENTRY = struct.Struct('<dH')
+
+
+def bus_path(metric_id):
+    return os.path.join(settings.METRIC_BUS_DIR, metric_id + '.bus')
+
+
+def bus_alive(metric_id):
+    """
+    Returns True if the bus of a metric exists and the process that writes it
+    is running. The file of a writer that died (it is only removed when the
+    metric actor stops) is not a live bus.
+    """
+    try:
+        with open(bus_path(metric_id), 'rb') as bus_file:
+            header = bus_file.read(HEADER.size)
+    except IOError:
+        return False
+    if len(header) < HEADER.size:
+        return False
+    magic, _, _, _, _, pid = HEADER.unpack(header)
+    if magic != MAGIC or not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def encode_aggregate(aggregate, max_size):
+    """
+    Encodes a {target: value} aggregate as bus entries. The entries that do
+    not fit in max_size bytes are left out and returned, so they can be sent
+    by other means.
+
+    :return: The payload, the number of entries and the set of targets left
+             out.
+    """
+    parts = list()
+    overflow = set()
+    size = 0
+    for target, value in aggregate.iteritems():
+        if target is None:
+            continue
+        name = target.encode('utf-8') if isinstance(target, unicode) else target
+        entry = ENTRY.pack(value, len(name)) + name
+        if size + len(entry) > max_size:
+            overflow.add(target)
+            continue
+        parts.append(entry)
+        size += len(entry)
+    return ''.join(parts), len(parts), overflow
+
+
+def decode_aggregate(payload, entries, targets=None):
+    aggregate = dict()
+    offset = 0
+    for _ in xrange(entries):
+        value, length = ENTRY.unpack_from(payload, offset)
+        offset += ENTRY.size
+        target = payload[offset:offset + length]
+        offset += length
+        if targets is None or target in targets:
+            aggregate[target] = value
+    return aggregate
+
+
+class MetricBusWriter(object):
+    """
+    Publishes the per-interval aggregates of a metric actor in a memory-mapped
+    ring buffer (a file in METRIC_BUS_DIR, usually in /dev/shm), so actors
+    in the same host read them without PyActor messages. The buffer has a
+    fixed number of fixed-size slots. A slot is invalidated before it is
+    rewritten and its sequence number is written last, so readers detect
+    slots overwritten while they were reading them. The pid of the writer is
+    in the header, so a file left by a dead writer is not used (bus_alive()).
+    """
+
+    def __init__(self, path, slots, slot_size):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.seq = 0
+        self.overflow = 0  # targets that did not fit in a slot
+        size = HEADER.size + slots * slot_size
+
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(path) and os.path.getsize(path) != size:
+            os.unlink(path)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        # A new generation tells the readers of a reused file to start over
+        generation = int(time.time() * 1000000)
+        self._mm[HEADER.size:HEADER.size + SLOT_HEADER.size] = '\0' * SLOT_HEADER.size
+        HEADER.pack_into(self._mm, 0, MAGIC, slots, slot_size, generation, 0, os.getpid())
+
+    def publish(self, tick, aggregate):
+        """
+        Writes the aggregate of an interval in the next slot.
+
+        :param tick: The time of the interval.
+        :type tick: float
+        :param aggregate: The {target: value} aggregate.
+        :type aggregate: dict
+        :return: The targets that did not fit in the slot (METRIC_BUS_SLOT_SIZE),
+                 whose values must be sent to the observers by other means.
+        :rtype: set
+        """
+        payload, entries, overflow = encode_aggregate(aggregate, self.slot_size - SLOT_HEADER.size)
+        if overflow:
+            if not self.overflow:
+                logger.warning('Metric bus, ' + str(len(overflow)) + ' targets of ' + self.path +
+                               ' do not fit in a slot of ' + str(self.slot_size) + ' bytes')
+            self.overflow += len(overflow)
+        seq = self.seq + 1
+        offset = HEADER.size + (seq % self.slots) * self.slot_size
+        mm = self._mm
+        WRITE_SEQ.pack_into(mm, offset, 0)
+        start = offset + SLOT_HEADER.size
+        mm[start:start + len(payload)] = payload
+        SLOT_HEADER.pack_into(mm, offset, seq, tick, len(payload), entries)
+        WRITE_SEQ.pack_into(mm, WRITE_SEQ_OFFSET, seq)
+        self.seq = seq
+        return overflow
+
+    def close(self):
+        self._mm.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class MetricBusReader(object):
+    """
+    Reads the aggregates published in a metric bus, keeping a sequence
+    cursor. A reader that falls more than a full ring behind skips the
+    overwritten slots and counts them as lost.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mm = None
+        self._fd = None
+        self.generation = None
+        self.cursor = None
+        self.lost = 0
+
+    def _open(self):
+        self.close()
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            size = os.fstat(fd).st_size
+            if size < HEADER.size:
+                os.close(fd)
+                return False
+            self._mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            os.close(fd)
+            return False
+        self._fd = fd
+        magic, self.slots, self.slot_size, self.generation, write_seq, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            return False
+        # Only the aggregates published from now on are read
+        self.cursor = write_seq
+        return True
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            os.close(self._fd)
+        self._mm = None
+        self._fd = None
+
+    def poll(self, targets=None):
+        """
+        Returns the aggregates published since the last call.
+
+        :param targets: Only these targets are decoded (all if None).
+        :type targets: set
+        :return: A list of (sequence, tick, {target: value}).
+        :rtype: list
+        """
+        if self._mm is None or os.fstat(self._fd).st_nlink == 0:
+            # Not opened yet, or the writer replaced the file
+            if not self._open():
+                return list()
+        mm = self._mm
+        generation = HEADER.unpack_from(mm, 0)[3]
+        if generation != self.generation:
+            self.generation = generation
+            self.cursor = 0
+        write_seq = WRITE_SEQ.unpack_from(mm, WRITE_SEQ_OFFSET)[0]
+        if write_seq - self.cursor > self.slots:
+            self.lost += write_seq - self.cursor - self.slots
+            self.cursor = write_seq - self.slots
+
+        aggregates = list()
+        for seq in xrange(self.cursor + 1, write_seq + 1):
+            offset = HEADER.size + (seq % self.slots) * self.slot_size
+            slot_seq, tick, length, entries = SLOT_HEADER.unpack_from(mm, offset)
+            if slot_seq != seq:
+                self.lost += 1
+                continue
+            start = offset + SLOT_HEADER.size
+            aggregate = decode_aggregate(buffer(mm, start, length), entries, targets)
+            if WRITE_SEQ.unpack_from(mm, offset)[0] != seq:
+                # Overwritten while it was read
+                self.lost += 1
+                continue
+            aggregates.append((seq, tick, aggregate))
+        self.cursor = write_seq
+        return aggregates
+
+
+class BusSubscription(Thread):
+    """
+    Polls the bus of a metric for all the subscribers of this process, and
+    calls callback(metric_id, tick, aggregate) of each one with its targets
+    only. There is a subscription per metric and process, shared through
+    subscribe() and unsubscribe().
+    """
+
+    def __init__(self, metric_id, poll_interval=None):
+        super(BusSubscription, self).__init__()
+        self.daemon = True
+        self.metric_id = metric_id
+        self.poll_interval = poll_interval or settings.METRIC_BUS_POLL_INTERVAL
+        self.reader = MetricBusReader(bus_path(metric_id))
+        self._listeners = dict()  # {key: (callback, set of targets or None)}
+        self._keys = itertools.count(1)
+        self._lock = Lock()
+        self._stop_event = Event()
+
+    def add(self, callback, targets=None):
+        """
+        Adds a subscriber.
+
+        :return: The key to remove it.
+        """
+        if targets is not None:
+            targets = set(target.encode('utf-8') if isinstance(target, unicode) else target
+                          for target in targets)
+        with self._lock:
+            key = next(self._keys)
+            self._listeners[key] = (callback, targets)
+        return key
+
+    def remove(self, key):
+        """
+        Removes a subscriber.
+
+        :return: True if there are no subscribers left.
+        """
+        with self._lock:
+            self._listeners.pop(key, None)
+            return not self._listeners
+
+    def poll(self):
+        """
+        Reads the new aggregates once and delivers them to the subscribers.
+        """
+        with self._lock:
+            listeners = self._listeners.values()
+        if not listeners:
+            return
+        targets = set()
+        for _, listener_targets in listeners:
+            if listener_targets is None:
+                targets = None
+                break
+            targets |= listener_targets
+        for seq, tick, aggregate in self.reader.poll(targets):
+            for callback, listener_targets in listeners:
+                if listener_targets is None:
+                    values = aggregate
+                else:
+                    values = dict((target, value) for target, value in aggregate.iteritems()
+                                  if target in listener_targets)
+                if not values:
+                    continue
+                try:
+                    callback(self.metric_id, tick, values)
+                except Exception as e:
+                    logger.error("Metric bus, Error in the subscription to " + self.metric_id + ": " + str(e))
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.poll()
+            self._stop_event.wait(self.poll_interval)
+        self.reader.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_subscriptions = dict()  # {metric_id: BusSubscription}
+_subscriptions_lock = Lock()
+
+
+def subscribe(metric_id, callback, targets=None):
+    """
+    Subscribes a callback to the bus of a metric. The subscribers of the same
+    metric in this process share a reader thread.
+
+    :param targets: The targets delivered to the callback (all if None).
+    :type targets: list
+    :return: The key to unsubscribe.
+    """
+    with _subscriptions_lock:
+        subscription = _subscriptions.get(metric_id)
+        if subscription is None:
+            subscription = _subscriptions[metric_id] = BusSubscription(metric_id)
+            subscription.start()
+        return subscription.add(callback, targets)
+
+
+def unsubscribe(metric_id, key):
+    """
+    Removes a subscriber added with subscribe(). The reader thread of the
+    metric stops with its last subscriber.
+    """
+    with _subscriptions_lock:
+        subscription = _subscriptions.get(metric_id)
+        if subscription is not None and subscription.remove(key):
+            del _subscriptions[metric_id]
+            subscription.stop()
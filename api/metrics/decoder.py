@@ -0,0 +1,231 @@
+from collections import namedtuple
+from itertools import izip
+from api.exceptions import MetricDecodeError
+import ast
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Content types of the messages with a batch of metrics (a list of metrics or
+# a columnar blob). Batches are also detected without content type.
+BATCH_CONTENT_TYPE = 'application/vnd.crystal.metrics+json'
+MSGPACK_BATCH_CONTENT_TYPE = 'application/vnd.crystal.metrics+msgpack'
+BATCH_CONTENT_TYPES = (BATCH_CONTENT_TYPE, MSGPACK_BATCH_CONTENT_TYPE)
+
+# Interned strings are kept in a bounded table: project, container and host
+# names repeat in almost every message, so decoded records share them.
+MAX_INTERNED_STRINGS = 100000
+_interned = dict()
+
+
+def intern_string(value):
+    """
+    Returns the canonical instance of a string (str or unicode). The builtin
+    intern() does not accept unicode strings, and json.loads() returns
+    unicode in Python 2, so this table is used instead.
+    """
+    try:
+        return _interned[value]
+    except KeyError:
+        if len(_interned) >= MAX_INTERNED_STRINGS:
+            _interned.clear()
+        _interned[value] = value
+        return value
+    except TypeError:
+        # Unhashable value (not a string)
+        return value
+
+
+class MetricRecord(namedtuple('MetricRecord', ['metric_name', 'timestamp', 'value', 'project', 'container',
+                                               'host', 'method', 'server_type', 'extra'])):
+    """
+    Fixed-schema record of a workload metric message. It is tuple-backed, so
+    it is cheap to create, to keep in the metric queues and to pickle when it
+    is sent to a remote PyActor observer. Non-standard keys of the message are
+    kept in the *extra* dictionary (or None).
+    """
+    __slots__ = ()
+
+    def as_dict(self):
+        """
+        Returns the message as it was published by the metric middleware.
+        """
+        metric = dict(self.extra) if self.extra else dict()
+        metric['metric_name'] = self.metric_name
+        metric['@timestamp'] = self.timestamp
+        metric['value'] = self.value
+        metric['project'] = self.project
+        metric['container'] = self.container
+        metric['host'] = self.host
+        metric['method'] = self.method
+        metric['server_type'] = self.server_type
+        return metric
+
+
+def record_from_dict(metric):
+    """
+    Builds a MetricRecord from a decoded message. The dictionary is consumed.
+
+    :param metric: The decoded metric message.
+    :type metric: dict
+    :raises MetricDecodeError: If the message is not a valid metric.
+    """
+    if not isinstance(metric, dict):
+        raise MetricDecodeError("Metric message is not a dictionary")
+    pop = metric.pop
+    try:
+        value = pop('value')
+        server_type = pop('server_type')
+    except KeyError as e:
+        raise MetricDecodeError("Metric message without " + str(e))
+
+    return MetricRecord(pop('metric_name', None),
+                        pop('@timestamp', None),
+                        value,
+                        intern_string(pop('project', None)),
+                        intern_string(pop('container', None)),
+                        intern_string(pop('host', None)),
+                        intern_string(pop('method', None)),
+                        intern_string(server_type),
+                        metric or None)
+
+
+def decode(body):
+    """
+    Decodes a workload metric message into a MetricRecord. JSON messages are
+    the common case; messages written as Python literals are parsed with
+    ast.literal_eval (never evaluated), and msgpack encoded messages are
+    accepted if the msgpack package is installed.
+
+    {'container': 'crystal/data', 'metric_name': 'bandwidth', '@timestamp': '2017-09-09T18:00:18.331492+02:00',
+     'value': 16.4375, 'project': 'crystal', 'host': 'controller', 'method': 'GET', 'server_type': 'proxy'}
+
+    :param body: The raw message consumed from RabbitMQ.
+    :type body: str
+    :raises MetricDecodeError: If the message can not be decoded.
+    """
+    return record_from_dict(_load(body))
+
+
+def _load(body, binary=False):
+    if not binary and body[:1] in ('{', '['):
+        try:
+            return json.loads(body)
+        except ValueError:
+            try:
+                return ast.literal_eval(body)
+            except (ValueError, SyntaxError):
+                raise MetricDecodeError("Invalid metric message: " + body[:100])
+    if msgpack is not None:
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception:
+            raise MetricDecodeError("Invalid msgpack metric message")
+    raise MetricDecodeError("Unknown metric message encoding")
+
+
+def decode_batch(body, content_type=None):
+    """
+    Decodes a message with one or more workload metrics: a single metric (as
+    decode()), a list of metrics, or a columnar blob, where the fields shared
+    by all the metrics are sent once:
+
+    {'common': {'metric_name': 'bandwidth', 'host': 'proxy1', 'server_type': 'proxy'},
+     'columns': {'value': [16.4, 3.2], 'project': ['crystal', 'crystal'], 'method': ['GET', 'PUT'], ...}}
+
+    JSON and msgpack are detected as in decode(); the msgpack batch content
+    type forces msgpack.
+
+    :param body: The raw message.
+    :type body: str
+    :param content_type: The content type of the message, if any.
+    :type content_type: str
+    :return: The records and the number of invalid metrics in the batch.
+    :rtype: (list, int)
+    :raises MetricDecodeError: If the message can not be decoded.
+    """
+    payload = _load(body, content_type == MSGPACK_BATCH_CONTENT_TYPE)
+    if isinstance(payload, dict):
+        if 'columns' not in payload:
+            return [record_from_dict(payload)], 0
+        return records_from_columns(payload)
+    if not isinstance(payload, list):
+        raise MetricDecodeError("Metric message is not a dictionary or a list")
+
+    records = list()
+    invalid = 0
+    for metric in payload:
+        try:
+            records.append(record_from_dict(metric))
+        except MetricDecodeError:
+            invalid += 1
+    return records, invalid
+
+
+def records_from_columns(blob):
+    """
+    Builds the records of a columnar blob (see decode_batch()).
+
+    :return: The records and the number of invalid metrics.
+    :rtype: (list, int)
+    :raises MetricDecodeError: If the blob is not valid.
+    """
+    common = blob.get('common') or dict()
+    columns = blob.get('columns')
+    if not isinstance(common, dict) or not isinstance(columns, dict):
+        raise MetricDecodeError("Invalid columnar metric batch")
+    names = list(columns.keys())
+    values = [columns[name] for name in names]
+    try:
+        if len(set(map(len, values))) > 1:
+            raise MetricDecodeError("Columns of different length in a metric batch")
+    except TypeError:
+        raise MetricDecodeError("Invalid columnar metric batch")
+
+    records = list()
+    invalid = 0
+    for row in izip(*values):
+        metric = dict(common)
+        metric.update(izip(names, row))
+        try:
+            records.append(record_from_dict(metric))
+        except MetricDecodeError:
+            invalid += 1
+    return records, invalid
+
+
+def encode_columns(metrics):
+    """
+    Encodes a list of metric dictionaries as a columnar blob (a dictionary
+    to be serialized with JSON or msgpack). The fields with the same value in
+    all the metrics are sent once.
+    """
+    names = set()
+    for metric in metrics:
+        names.update(metric)
+    common = dict()
+    columns = dict()
+    for name in names:
+        column = [metric.get(name) for metric in metrics]
+        if all(value == column[0] for value in column):
+            common[name] = column[0]
+        else:
+            columns[name] = column
+    if not columns:
+        # At least one column gives the number of metrics
+        columns['value'] = [metric.get('value') for metric in metrics]
+        common.pop('value', None)
+    return {'common': common, 'columns': columns}
+
+
+def encode_msgpack(metric):
+    """
+    Encodes a metric dictionary with msgpack (the compact binary encoding
+    accepted by decode()).
+    """
+    if msgpack is None:
+        raise MetricDecodeError("msgpack is not installed")
+    return msgpack.packb(metric, use_bin_type=True)
@@ -0,0 +1,47 @@
+class DeltaFilter(object):
+    """
+    Change-only notification state of an observer. A target value is sent if
+    it moved more than epsilon from the last value sent to the observer
+    (an absolute difference, or a fraction of the last value if relative).
+    Every keyframe intervals (with values for the observer), all the values
+    are sent.
+    """
+
+    def __init__(self, epsilon, relative=False, keyframe=60):
+        self.epsilon = epsilon
+        self.relative = relative
+        self.keyframe = keyframe
+        self.last = dict()
+        self.intervals = 0
+
+    def _changed(self, last, value):
+        if last is None:
+            return True
+        difference = abs(value - last)
+        if self.relative:
+            return difference > self.epsilon * abs(last)
+        return difference > self.epsilon
+
+    def filter(self, values):
+        """
+        Returns the values that must be sent to the observer.
+
+        :param values: The {target: value} values of the interval. The values
+                       are numbers, or summary dictionaries (their 'value' is
+                       compared).
+        :type values: dict
+        :rtype: dict
+        """
+        keyframe = self.intervals % self.keyframe == 0
+        self.intervals += 1
+        changed = dict()
+        last = self.last
+        for target, value in values.iteritems():
+            number = value['value'] if isinstance(value, dict) else value
+            if keyframe or self._changed(last.get(target), number):
+                changed[target] = value
+                last[target] = number
+        return changed
+
+    def forget(self, target):
+        self.last.pop(target, None)
@@ -0,0 +1,247 @@
+from abc import ABCMeta, abstractmethod
+from django.conf import settings
+from threading import Event, Thread, Lock
+import atexit
+import logging
+import json
+import os
+import socket
+import time
+import Queue
+
+logger = logging.getLogger(__name__)
+
+# Maximum payload of a UDP datagram sent to Logstash
+MAX_DATAGRAM_SIZE = 60000
+
+# Seconds stop() waits for the flusher thread
+STOP_TIMEOUT = 5
+
+# Queued by stop() to wake the flusher thread
+_STOP = object()
+
+# Exporters shared by all the metric actors of this process, and their users
+_exporters = dict()
+_exporters_users = dict()
+_exporters_lock = Lock()
+
+
+class LogstashExporter(object):
+    """
+    Ships workload metric records to Logstash as NDJSON lines. Records are
+    buffered in a bounded queue and a background thread serializes and sends
+    them in batches (by size or by time), so the consumer threads never wait
+    for the network. When the queue is full, new records are dropped.
+    Subclasses implement _send() for a transport.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, host, port, queue_size, batch_size, flush_interval):
+        self.server = (host, port)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.sock = None
+
+        # The counters are updated by the caller and the flusher threads
+        self._counters_lock = Lock()
+        self.sent = 0
+        self.dropped = 0
+
+        self._stopping = Event()
+        self.flusher = Thread(target=self._flush_loop)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def export(self, metric):
+        """
+        Enqueues a metric record. It never blocks.
+
+        :param metric: The metric record.
+        :type metric: metrics.decoder.MetricRecord
+        """
+        try:
+            self.queue.put_nowait(metric)
+        except Queue.Full:
+            self._count(dropped=1)
+
+    def stats(self):
+        """
+        Returns the exporter counters.
+        """
+        with self._counters_lock:
+            return {'sent': self.sent, 'dropped': self.dropped, 'queued': self.queue.qsize()}
+
+    def stop(self):
+        """
+        Sends the queued records, stops the flusher thread and closes the
+        socket.
+        """
+        self._stopping.set()
+        try:
+            self.queue.put_nowait(_STOP)
+        except Queue.Full:
+            # The flusher is busy and sees the event after this batch
+            pass
+        if self.flusher.is_alive():
+            self.flusher.join(STOP_TIMEOUT)
+        self._close()
+
+    def _count(self, sent=0, dropped=0):
+        with self._counters_lock:
+            self.sent += sent
+            self.dropped += dropped
+
+    def _flush_loop(self):
+        batch = list()
+        deadline = time.time() + self.flush_interval
+        while not self._stopping.is_set():
+            try:
+                metric = self.queue.get(timeout=max(deadline - time.time(), 0.001))
+                if metric is not _STOP:
+                    batch.append(metric)
+            except Queue.Empty:
+                pass
+
+            # The batch is sent when it is full or the flush interval has passed
+            if len(batch) < self.batch_size and time.time() < deadline:
+                continue
+            if batch:
+                self._flush(batch)
+                batch = list()
+            deadline = time.time() + self.flush_interval
+
+        # Stopping: send what is left
+        while True:
+            try:
+                metric = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if metric is not _STOP:
+                batch.append(metric)
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch):
+        lines = list()
+        invalid = 0
+        for metric in batch:
+            try:
+                lines.append(json.dumps(metric.as_dict()) + '\n')
+            except (TypeError, ValueError):
+                invalid += 1
+        try:
+            self._send(lines)
+            self._count(sent=len(lines), dropped=invalid)
+        except socket.error as e:
+            logger.info("Logstash exporter: Error sending monitoring data to logstash: " + str(e))
+            self._count(dropped=len(lines) + invalid)
+            self._close()
+
+    @abstractmethod
+    def _send(self, lines):
+        """
+        Sends a batch of NDJSON lines to Logstash.
+
+        :param lines: The serialized records, each one ended by a newline.
+        :type lines: list of str
+        :raises socket.error: If the batch can not be sent.
+        """
+
+    def _close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class UDPLogstashExporter(LogstashExporter):
+    """
+    Sends the batches through a long-lived UDP socket. Each datagram carries
+    as many NDJSON lines as fit in MAX_DATAGRAM_SIZE.
+    """
+
+    def _send(self, lines):
+        if not self.sock:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        datagram = list()
+        size = 0
+        for line in lines:
+            if datagram and size + len(line) > MAX_DATAGRAM_SIZE:
+                self.sock.sendto(''.join(datagram), self.server)
+                datagram = list()
+                size = 0
+            datagram.append(line)
+            size += len(line)
+        if datagram:
+            self.sock.sendto(''.join(datagram), self.server)
+
+
+class TCPLogstashExporter(LogstashExporter):
+    """
+    Sends the batches through a long-lived TCP connection, which is
+    re-established on the next batch after an error.
+    """
+
+    def _send(self, lines):
+        if not self.sock:
+            self.sock = socket.create_connection(self.server, timeout=5)
+        self.sock.sendall(''.join(lines))
+
+
+EXPORTERS = {'udp': UDPLogstashExporter,
+             'tcp': TCPLogstashExporter}
+
+
+def get_logstash_exporter():
+    """
+    Returns the Logstash exporter of this process, creating it the first time.
+    The exporters are keyed by pid: a forked ingestion worker does not inherit
+    the flusher thread of its parent, so it gets its own exporter. Each call
+    must be paired with a release_logstash_exporter().
+    """
+    protocol = settings.LOGSTASH_PROTOCOL
+    key = (os.getpid(), protocol, settings.LOGSTASH_HOST, settings.LOGSTASH_PORT)
+    with _exporters_lock:
+        if key not in _exporters:
+            _exporters[key] = EXPORTERS[protocol](settings.LOGSTASH_HOST, settings.LOGSTASH_PORT,
+                                                  settings.LOGSTASH_QUEUE_SIZE, settings.LOGSTASH_BATCH_SIZE,
+                                                  settings.LOGSTASH_FLUSH_INTERVAL)
+            _exporters_users[key] = 0
+        _exporters_users[key] += 1
+        return _exporters[key]
+
+
+def release_logstash_exporter(exporter):
+    """
+    Releases an exporter returned by get_logstash_exporter(). The exporter is
+    stopped when its last user releases it.
+    """
+    with _exporters_lock:
+        for key, shared in _exporters.items():
+            if shared is exporter:
+                _exporters_users[key] -= 1
+                if _exporters_users[key] > 0:
+                    return
+                del _exporters[key]
+                del _exporters_users[key]
+                break
+    exporter.stop()
+
+
+def stop_logstash_exporters():
+    """
+    Stops all the exporters of this process, sending their queued records.
+    It is called at exit, before the flusher threads lose their modules.
+    """
+    with _exporters_lock:
+        exporters = _exporters.values()
+        _exporters.clear()
+        _exporters_users.clear()
+    for exporter in exporters:
+        exporter.stop()
+
+
+atexit.register(stop_logstash_exporters)
@@ -0,0 +1,209 @@
+from django.conf import settings
+from threading import Thread, Lock
+from api.exceptions import MetricDecodeError
+from metrics.decoder import decode_batch, record_from_dict, msgpack
+import json
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+# Maximum payload of an ingestion datagram
+MAX_DATAGRAM_SIZE = 65507
+
+# Server shared by all the metric actors of this process
+_server = None
+_server_lock = Lock()
+
+
+def parse_address(address):
+    """
+    Returns the socket family and address of an ingestion address:
+    udp://host:port or unix:///path/to/socket.
+    """
+    if address.startswith('udp://'):
+        host, _, port = address[len('udp://'):].rpartition(':')
+        return socket.AF_INET, (host, int(port))
+    if address.startswith('unix://'):
+        return socket.AF_UNIX, address[len('unix://'):]
+    raise ValueError("Invalid metric ingestion address: " + str(address))
+
+
+def parse_datagram(data):
+    """
+    Decodes an ingestion datagram. The first line is the routing key of the
+    metric (as published to RabbitMQ, e.g. metric.get_bandwidth), followed by
+    the metric messages: one JSON message per line, or concatenated msgpack
+    messages. The JSON lines are decoded at once as a list (decode_batch),
+    and one by one only if the datagram has a malformed line.
+
+    :return: The routing key, the metric records and the number of invalid
+             messages.
+    :rtype: (str, list, int)
+    """
+    routing_key, _, payload = data.partition('\n')
+    records = list()
+    invalid = 0
+    if payload[:1] == '{':
+        lines = [line for line in payload.split('\n') if line]
+        try:
+            records, invalid = decode_batch('[' + ','.join(lines) + ']')
+        except MetricDecodeError:
+            for line in lines:
+                try:
+                    line_records, line_invalid = decode_batch(line)
+                except MetricDecodeError:
+                    invalid += 1
+                    continue
+                records.extend(line_records)
+                invalid += line_invalid
+    elif payload and msgpack is not None:
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(payload)
+        try:
+            for metric in unpacker:
+                try:
+                    records.append(record_from_dict(metric))
+                except MetricDecodeError:
+                    invalid += 1
+        except Exception:
+            invalid += 1
+    elif payload:
+        invalid += 1
+    return routing_key, records, invalid
+
+
+class DatagramIngestionServer(object):
+    """
+    Receives batched workload metrics over UDP or a Unix datagram socket and
+    hands the decoded records to the metric actors of this process, without
+    going through RabbitMQ. Each metric actor registers a handler for its
+    routing key. Datagrams are best effort: a datagram that can not be
+    delivered is lost, as a message published to a missing queue would be.
+    """
+
+    def __init__(self, address, receive_buffer=None):
+        self.address = address
+        self.family, self.bind_address = parse_address(address)
+        self.receive_buffer = receive_buffer
+        self._handlers = dict()  # {routing_key: callable(records)}
+        self._lock = Lock()
+        self._thread = None
+        self.sock = None
+
+        self.datagrams = 0
+        self.records = 0
+        self.invalid = 0
+        self.unroutable = 0
+
+    def register(self, routing_key, handler):
+        """
+        Registers the handler of a routing key and starts the server if it is
+        not running.
+
+        :param handler: Function called with the list of records of each
+                        datagram, from the server thread.
+        :type handler: callable
+        """
+        with self._lock:
+            self._handlers[routing_key] = handler
+            if self._thread is None:
+                self._bind()
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def unregister(self, routing_key):
+        with self._lock:
+            self._handlers.pop(routing_key, None)
+
+    def _bind(self):
+        self.sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        if self.receive_buffer:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        if self.family == socket.AF_UNIX and os.path.exists(self.bind_address):
+            os.unlink(self.bind_address)
+        self.sock.bind(self.bind_address)
+        logger.info('Metric ingestion, Listening on ' + self.address)
+
+    def _run(self):
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM_SIZE)
+            except socket.error as e:
+                logger.error("Metric ingestion, Error receiving: " + str(e))
+                continue
+            self.handle_datagram(data)
+
+    def handle_datagram(self, data):
+        self.datagrams += 1
+        routing_key, records, invalid = parse_datagram(data)
+        self.invalid += invalid
+        handler = self._handlers.get(routing_key)
+        if handler is None:
+            self.unroutable += 1
+            return
+        if records:
+            self.records += len(records)
+            try:
+                handler(records)
+            except Exception as e:
+                logger.error("Metric ingestion, Error handling the metrics of " + routing_key + ": " + str(e))
+
+    def stats(self):
+        """
+        Returns the server counters.
+        """
+        return {'datagrams': self.datagrams, 'records': self.records, 'invalid': self.invalid,
+                'unroutable': self.unroutable}
+
+
+class DatagramSender(object):
+    """
+    Sends workload metrics to an ingestion server, packing as many JSON
+    messages per datagram as they fit.
+    """
+
+    def __init__(self, address):
+        self.family, self.address = parse_address(address)
+        self.sock = socket.socket(self.family, socket.SOCK_DGRAM)
+
+    def send(self, routing_key, metrics):
+        """
+        :param routing_key: The routing key of the metric.
+        :type routing_key: str
+        :param metrics: The metric messages.
+        :type metrics: list of dict
+        """
+        header = routing_key + '\n'
+        lines = list()
+        size = len(header)
+        for metric in metrics:
+            line = json.dumps(metric)
+            if lines and size + len(line) + 1 > MAX_DATAGRAM_SIZE:
+                self.sock.sendto(header + '\n'.join(lines), self.address)
+                lines = list()
+                size = len(header)
+            lines.append(line)
+            size += len(line) + 1
+        if lines:
+            self.sock.sendto(header + '\n'.join(lines), self.address)
+
+    def close(self):
+        self.sock.close()
+
+
+def get_ingestion_server():
+    """
+    Returns the ingestion server of this process (None if the
+    METRIC_INGESTION_ADDRESS setting is not set).
+    """
+    global _server
+    if not settings.METRIC_INGESTION_ADDRESS:
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = DatagramIngestionServer(settings.METRIC_INGESTION_ADDRESS,
+                                              settings.METRIC_INGESTION_RECEIVE_BUFFER)
+        return _server
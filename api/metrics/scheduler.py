@@ -0,0 +1,108 @@
+from threading import Thread, Condition, Lock
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+# Scheduler shared by all the metric actors of this process
+_scheduler = None
+_scheduler_lock = Lock()
+
+
+def next_tick(now, interval):
+    """
+    Returns the first tick after *now* aligned to the interval, so all the
+    tasks with the same interval tick at the same time.
+    """
+    return (math.floor(now / interval) + 1) * interval
+
+
+class TickScheduler(object):
+    """
+    Runs periodic tasks from a single thread. Each task is registered with
+    its own interval and ticks at the multiples of that interval (wall-clock
+    aligned), so the metrics with the same interval are aggregated at the same
+    instant and the rules see consistent snapshots. The thread sleeps until
+    the next due tick, and it is not started until the first registration.
+    """
+
+    def __init__(self):
+        self._tasks = dict()
+        self._condition = Condition()
+        self._thread = None
+
+    def register(self, key, callback, interval):
+        """
+        Registers (or replaces) a periodic task.
+
+        :param key: The id of the task, e.g. the metric id.
+        :type key: str
+        :param callback: Function called on every tick with the tick time.
+        :type callback: callable
+        :param interval: The interval between ticks, in seconds.
+        :type interval: float
+        """
+        with self._condition:
+            self._tasks[key] = [interval, callback, next_tick(time.time(), interval)]
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def unregister(self, key):
+        """
+        Removes a periodic task. It does nothing if the task is not registered.
+        """
+        with self._condition:
+            self._tasks.pop(key, None)
+            self._condition.notify()
+
+    def registered(self):
+        with self._condition:
+            return dict((key, task[0]) for key, task in self._tasks.items())
+
+    def _due_tasks(self, now):
+        """
+        Returns the (tick, key, callback) of the tasks that are due at *now*
+        and schedules their next tick. Missed ticks are skipped.
+        """
+        due = list()
+        for key, task in self._tasks.items():
+            interval, callback, tick = task
+            if tick <= now:
+                due.append((tick, key, callback))
+                task[2] = next_tick(now, interval)
+        due.sort()
+        return due
+
+    def _run(self):
+        while True:
+            with self._condition:
+                now = time.time()
+                due = self._due_tasks(now)
+                if not due:
+                    if self._tasks:
+                        timeout = min(task[2] for task in self._tasks.values()) - now
+                    else:
+                        timeout = None
+                    self._condition.wait(timeout)
+                    continue
+
+            for tick, key, callback in due:
+                try:
+                    callback(tick)
+                except Exception as e:
+                    logger.error("Tick scheduler: Error running the task " + str(key) + ": " + str(e))
+
+
+def get_scheduler():
+    """
+    Returns the tick scheduler of this process, creating it the first time.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TickScheduler()
+        return _scheduler
@@ -0,0 +1,143 @@
+from redis.exceptions import RedisError
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+# Each slot of a series is the (timestamp, value) of an interval
+SLOT = struct.Struct('<Id')
+
+# Tiers: (resolution in seconds, number of slots). 10 minutes at 1s, 6 hours
+# at 10s and 24 hours at 1m: the three tiers of a target take ~50KB in Redis.
+TIERS = ((1, 600), (10, 2160), (60, 1440))
+
+# Seconds covered by the longest tier
+RETENTION = max(resolution * slots for resolution, slots in TIERS)
+
+
+def series_key(metric_id, resolution, target):
+    return 'series:' + metric_id + ':' + str(resolution) + ':' + target
+
+
+def targets_key(metric_id):
+    """
+    Sorted set of the targets with a series, scored by their last write.
+    """
+    return 'series:' + metric_id + ':targets'
+
+
+def choose_resolution(seconds):
+    """
+    Returns the finest tier resolution that covers the last *seconds*.
+    """
+    for resolution, slots in TIERS:
+        if resolution * slots >= seconds:
+            return resolution
+    return TIERS[-1][0]
+
+
+class SeriesWriter(object):
+    """
+    Writes the per-interval aggregates of a workload metric into fixed-size
+    ring buffers in Redis, one per target and tier. A slot is overwritten in
+    place (SETRANGE) at the position of its timestamp, so the memory of a
+    series is bounded, and all the slots of an interval are written with one
+    pipeline. The coarse tiers store the mean of all the aggregation
+    intervals of their bucket, where an interval without a value counts as
+    zero. The sum of the current bucket of each target is kept in memory, and
+    the bucket is written at every interval until it ends, with or without a
+    value of the target. The targets are kept in a sorted set, so the series
+    are read without listing the keys.
+    """
+
+    def __init__(self, redis, metric_id, include_containers=False, interval=1):
+        self.redis = redis
+        self.metric_id = metric_id
+        self.include_containers = include_containers
+        self.interval = max(int(interval), 1)
+        self._buckets = dict()  # {(resolution, target): [bucket, sum]}
+
+    def write(self, timestamp, aggregate):
+        """
+        :param timestamp: The time of the interval (epoch seconds).
+        :type timestamp: float
+        :param aggregate: The {target: value} aggregate of the interval.
+        :type aggregate: dict
+        """
+        timestamp = int(timestamp)
+        pipe = self.redis.pipeline(transaction=False)
+        targets = dict()
+        for target, value in aggregate.iteritems():
+            if target is None or (not self.include_containers and '/' in target):
+                continue
+            targets[target] = timestamp
+            for resolution, slots in TIERS:
+                bucket = timestamp - timestamp % resolution
+                if resolution > 1:
+                    state = self._buckets.get((resolution, target))
+                    if state is None or state[0] != bucket:
+                        state = self._buckets[(resolution, target)] = [bucket, 0.0]
+                    state[1] += value
+                else:
+                    self._set(pipe, resolution, slots, target, bucket, value)
+
+        # The coarse buckets, including those of the targets without a value
+        # in this interval
+        tiers = dict(TIERS)
+        for (resolution, target), state in self._buckets.items():
+            bucket = timestamp - timestamp % resolution
+            if state[0] != bucket:
+                # Complete: it was written at its last interval
+                del self._buckets[(resolution, target)]
+                continue
+            intervals = min((timestamp - bucket) // self.interval + 1, max(resolution // self.interval, 1))
+            self._set(pipe, resolution, tiers[resolution], target, bucket, state[1] / intervals)
+
+        if targets:
+            key = targets_key(self.metric_id)
+            pipe.zadd(key, **targets)
+            pipe.zremrangebyscore(key, 0, timestamp - RETENTION)
+            pipe.expire(key, RETENTION)
+        try:
+            pipe.execute()
+        except RedisError as e:
+            logger.error("Metric series, Error writing the series of " + self.metric_id + ": " + str(e))
+
+    def _set(self, pipe, resolution, slots, target, bucket, value):
+        key = series_key(self.metric_id, resolution, target)
+        pipe.setrange(key, (bucket // resolution) % slots * SLOT.size, SLOT.pack(bucket, value))
+        pipe.expire(key, resolution * slots)
+
+
+def unpack_series(data, since=0):
+    """
+    Returns the [timestamp, value] points of a ring buffer, in time order.
+    """
+    points = list()
+    for offset in range(0, len(data) - SLOT.size + 1, SLOT.size):
+        timestamp, value = SLOT.unpack_from(data, offset)
+        if timestamp and timestamp >= since:
+            points.append([timestamp, value])
+    points.sort()
+    return points
+
+
+def read_series(redis, metric_id, resolution, since, targets=None):
+    """
+    Returns the {target: [[timestamp, value], ...]} series of a metric.
+
+    :param targets: The targets to read. All the targets written since
+                    *since* if it is None.
+    :type targets: list
+    """
+    if targets is None:
+        targets = redis.zrangebyscore(targets_key(metric_id), since, '+inf')
+    if not targets:
+        return dict()
+    keys = [series_key(metric_id, resolution, target) for target in targets]
+
+    series = dict()
+    for target, data in zip(targets, redis.mget(keys)):
+        if data:
+            series[target] = unpack_series(data, since)
+    return series
@@ -0,0 +1,400 @@
+from _multiprocessing import Connection
+from collections import namedtuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from threading import Lock, Thread
+from api.exceptions import MetricDecodeError
+from metrics.admission import ProjectAdmission
+from metrics.aggregation import ColumnarAggregator
+from metrics.buffers import MetricBuffer, BLOCK
+from metrics.decoder import decode_batch
+from metrics.exporters import get_logstash_exporter, release_logstash_exporter
+from metrics.scheduler import next_tick
+import json
+import logging
+import os
+import pika
+import select
+import subprocess
+import sys
+import time
+
+logging.getLogger("pika").propagate = False
+logger = logging.getLogger(__name__)
+
+# Seconds a worker waits for a message before checking its deadline
+CONSUME_TIMEOUT = 0.05
+
+# Seconds the reader thread of the coordinator waits before checking if it is stopped
+READ_TIMEOUT = 0.5
+
+# Seconds stop() waits for a worker to exit
+STOP_TIMEOUT = 2
+
+# Pre-aggregated interval of an ingestion worker: the sum of each target, the
+# quantile sketches, the raw proxy records if the coordinator needs them, the
+# sum of each host and the summaries of the records folded by the project quotas
+PartialAggregate = namedtuple('PartialAggregate', ['worker', 'tick', 'sums', 'sketches', 'records', 'hosts',
+                                                   'folded'])
+
+
+def check_sharding_settings(metric_id):
+    """
+    Checks that the buffer of a workload metric can be used by its ingestion
+    workers, which drain their buffer from the same thread that fills it.
+
+    :raises ImproperlyConfigured: If the buffer policy of the metric is block.
+    """
+    policy = settings.METRIC_BUFFERS.get(metric_id, dict()).get('policy', settings.METRIC_BUFFER_POLICY)
+    if policy == BLOCK:
+        raise ImproperlyConfigured("The '" + BLOCK + "' metric buffer policy of '" + str(metric_id) + "' can not "
+                                   "be used with sharded ingestion (METRIC_INGESTION_WORKERS)")
+
+
+def shard_policies(metric_id, workers):
+    """
+    Returns the buffer and the admission (None if there are no project quotas)
+    of an ingestion worker of a workload metric. RabbitMQ distributes the
+    messages evenly among the workers, so each one gets an equal share of the
+    buffer size and of the project quotas.
+
+    :rtype: (metrics.buffers.MetricBuffer, metrics.admission.ProjectAdmission)
+    """
+    check_sharding_settings(metric_id)
+    buffer_settings = settings.METRIC_BUFFERS.get(metric_id, dict())
+    size = buffer_settings.get('size', settings.METRIC_BUFFER_SIZE)
+    buf = MetricBuffer(max(1, size // workers), buffer_settings.get('policy', settings.METRIC_BUFFER_POLICY))
+    admission = None
+    if settings.METRIC_PROJECT_RATE:
+        quotas = dict((project, (rate / float(workers), burst / float(workers)))
+                      for project, (rate, burst) in settings.METRIC_PROJECT_QUOTAS.iteritems())
+        admission = ProjectAdmission(settings.METRIC_PROJECT_RATE / float(workers),
+                                     settings.METRIC_PROJECT_BURST / float(workers), quotas)
+    return buf, admission
+
+
+class IngestionShard(object):
+    """
+    Decodes and pre-aggregates the messages consumed by one ingestion worker.
+    The proxy records are kept in a bounded buffer and admitted by the project
+    quotas, as in the metric actor.
+    """
+
+    def __init__(self, worker, sketch_accuracy=None, buf=None, admission=None):
+        self.worker = worker
+        self.sketch_accuracy = sketch_accuracy
+        self.exporter = get_logstash_exporter()
+        self.aggregator = ColumnarAggregator(with_hosts=True)
+        self.records = buf if buf is not None else MetricBuffer(settings.METRIC_BUFFER_SIZE)
+        self.admission = admission
+
+    def add(self, body, content_type=None):
+        try:
+            metrics, invalid = decode_batch(body, content_type)
+        except MetricDecodeError as e:
+            logger.info("Ingestion worker, Error decoding metric: " + str(e))
+            return
+        proxy_metrics = list()
+        for metric in metrics:
+            if metric.server_type == 'proxy':
+                proxy_metrics.append(metric)
+            self.exporter.export(metric)
+        if self.admission and proxy_metrics:
+            proxy_metrics = self.admission.admit(proxy_metrics)
+        self.records.extend(proxy_metrics)
+
+    def flush(self, tick, with_records=False):
+        """
+        Returns the partial aggregate of the interval and resets the shard.
+
+        :rtype: PartialAggregate
+        """
+        records, weight = self.records.drain()
+        self.aggregator.add_records(records)
+        aggregate = self.aggregator.flush(sketch_accuracy=self.sketch_accuracy)
+        if weight != 1.0:
+            aggregate.scale(weight)
+        folded = self.admission.drain() if self.admission else None
+        return PartialAggregate(self.worker, tick, aggregate.as_dict(), aggregate.sketches,
+                                records if with_records else None, aggregate.hosts, folded)
+
+    def close(self):
+        release_logstash_exporter(self.exporter)
+
+
+def merge_partials(partials, sums, sketches, records, hosts=None, folded=None):
+    """
+    Merges partial aggregates into the aggregate of the coordinator.
+
+    :param partials: The partial aggregates received from the workers.
+    :type partials: list of PartialAggregate
+    :param sums: The {target: value} aggregate, updated in place.
+    :param sketches: The {target: DDSketch} sketches, updated in place.
+    :param records: The proxy records, extended in place.
+    :param hosts: The {host: value} sums, updated in place.
+    :param folded: The {project: [count, sum]} summaries, updated in place.
+    """
+    for partial in partials:
+        for target, value in partial.sums.iteritems():
+            sums[target] = sums.get(target, 0) + value
+        if partial.sketches:
+            for target, sketch in partial.sketches.iteritems():
+                if target in sketches:
+                    sketches[target].merge(sketch)
+                else:
+                    sketches[target] = sketch
+        if partial.records:
+            records.extend(partial.records)
+        if hosts is not None and partial.hosts:
+            for host, value in partial.hosts.iteritems():
+                hosts[host] = hosts.get(host, 0) + value
+        if folded is not None and partial.folded:
+            for project, (count, total) in partial.folded.iteritems():
+                summary = folded.setdefault(project, [0, 0.0])
+                summary[0] += count
+                summary[1] += total
+
+
+class WorkerControl(object):
+    """
+    Control channel of an ingestion worker, read without blocking. The
+    coordinator writes a '1' (or '0') line when the raw proxy records are
+    needed (or not), and closes the channel to stop the worker, which also
+    stops if the coordinator dies.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.with_records = False
+        self.stopped = False
+        self._buffer = ''
+
+    def poll(self):
+        while not self.stopped and select.select([self.fd], [], [], 0)[0]:
+            data = os.read(self.fd, 4096)
+            if not data:
+                self.stopped = True
+                break
+            lines = (self._buffer + data).split('\n')
+            self._buffer = lines.pop()
+            if lines:
+                self.with_records = lines[-1] == '1'
+
+
+def _ingestion_worker(worker, workers, queue, routing_key, interval, sketch_accuracy, results, control):
+    """
+    Main function of an ingestion worker process. It consumes the metric
+    queue (competing with the other workers), pre-aggregates the messages and
+    sends a PartialAggregate to the coordinator at every aligned tick.
+
+    :param workers: The number of workers of the metric.
+    :type workers: int
+
+    :param results: The connection to send the partial aggregates.
+    :type results: _multiprocessing.Connection
+    :param control: The control channel of the coordinator.
+    :type control: WorkerControl
+    """
+    credentials = pika.PlainCredentials(settings.RABBITMQ_USERNAME, settings.RABBITMQ_PASSWORD)
+    parameters = pika.ConnectionParameters(host=settings.RABBITMQ_HOST,
+                                           port=settings.RABBITMQ_PORT,
+                                           credentials=credentials)
+    connection = pika.BlockingConnection(parameters)
+    channel = connection.channel()
+    channel.queue_declare(queue=queue)
+    channel.queue_bind(exchange=settings.RABBITMQ_EXCHANGE, queue=queue, routing_key=routing_key)
+    channel.basic_qos(prefetch_count=settings.CONSUMER_PREFETCH)
+
+    buf, admission = shard_policies(queue, workers)
+    shard = IngestionShard(worker, sketch_accuracy, buf, admission)
+    delivery_tag = None
+    pending = 0
+    deadline = next_tick(time.time(), interval)
+    try:
+        for method, properties, body in channel.consume(queue, inactivity_timeout=CONSUME_TIMEOUT):
+            control.poll()
+            if body is not None:
+                shard.add(body, properties.content_type)
+                delivery_tag = method.delivery_tag
+                pending += 1
+            now = time.time()
+            if now >= deadline:
+                results.send(shard.flush(deadline, control.with_records))
+                deadline = next_tick(now, interval)
+            if delivery_tag is not None and (pending >= settings.CONSUMER_BATCH_SIZE or body is None):
+                channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+                delivery_tag = None
+                pending = 0
+            if control.stopped:
+                break
+    finally:
+        shard.close()
+        try:
+            channel.cancel()
+            connection.close()
+        except Exception:
+            pass
+
+
+def main(argv):
+    """
+    Entry point of a worker process: python -m metrics.sharding <arguments>,
+    where the arguments are the JSON list [worker, workers, queue,
+    routing_key, interval, sketch_accuracy]. The partial aggregates are sent
+    through the standard output and the control channel is the standard
+    input.
+    """
+    worker, workers, queue, routing_key, interval, sketch_accuracy = json.loads(argv[0])
+    results = Connection(os.dup(1))
+    # Anything printed goes to the standard error
+    os.dup2(2, 1)
+    _ingestion_worker(worker, workers, queue, routing_key, interval, sketch_accuracy, results, WorkerControl(0))
+
+
+class ShardedIngestion(object):
+    """
+    Consumes a metric queue with several worker processes, so decoding and
+    aggregation are not bound by the GIL of the metric actor. The workers
+    share the queue (RabbitMQ distributes the messages among them) and send
+    their partial aggregates to the actor, which merges them at every tick.
+
+    A reader thread receives the partial aggregates, so the tick never waits
+    for the workers: the partials of an interval are merged at the next tick.
+
+    The workers are new interpreters (not forks), because the actor process
+    already runs the PyActor, scheduler and consumer threads when they start.
+    """
+
+    def __init__(self, queue, routing_key, workers, interval, sketch_accuracy=None):
+        self.queue = queue
+        self.routing_key = routing_key
+        self.workers = workers
+        self.interval = interval
+        self.sketch_accuracy = sketch_accuracy
+
+        self.with_records = False
+        self.processes = list()  # [(subprocess.Popen, Connection)]
+        self.pending = dict()  # {interval number: [PartialAggregate]}
+        self.lock = Lock()
+        self.reader = None
+        self.late_partials = 0
+
+    def start(self):
+        if self.processes:
+            return
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'api.settings'))
+        for worker in range(self.workers):
+            arguments = json.dumps([worker, self.workers, self.queue, self.routing_key, self.interval,
+                                    self.sketch_accuracy])
+            process = subprocess.Popen([sys.executable, '-m', 'metrics.sharding', arguments],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       cwd=settings.BASE_DIR, env=env, close_fds=True)
+            results = Connection(os.dup(process.stdout.fileno()))
+            process.stdout.close()
+            if self.with_records:
+                process.stdin.write('1\n')
+                process.stdin.flush()
+            self.processes.append((process, results))
+        self._start_reader()
+        logger.info('Sharded ingestion, started ' + str(self.workers) + ' workers for ' + self.routing_key)
+
+    def _start_reader(self):
+        self.reader = Thread(target=self._read_loop, args=(list(self.processes),))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read_loop(self, processes):
+        """
+        Receives the partial aggregates of the workers until all of them are
+        gone (their results connection is closed).
+        """
+        connections = dict((results.fileno(), results) for _, results in processes)
+        while connections:
+            try:
+                ready, _, _ = select.select(list(connections), [], [], READ_TIMEOUT)
+            except (select.error, ValueError):
+                break
+            for fd in ready:
+                try:
+                    partial = connections[fd].recv()
+                except (EOFError, IOError):
+                    # The worker is gone
+                    del connections[fd]
+                    continue
+                with self.lock:
+                    self.pending.setdefault(self._interval_number(partial.tick), []).append(partial)
+
+    def _interval_number(self, tick):
+        return int(round(tick / float(self.interval)))
+
+    def stop(self):
+        for process, results in self.processes:
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+        deadline = time.time() + STOP_TIMEOUT
+        for process, results in self.processes:
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        # The workers are gone, so the reader gets the end of their connections
+        if self.reader:
+            self.reader.join(STOP_TIMEOUT)
+            self.reader = None
+        for process, results in self.processes:
+            results.close()
+        self.processes = list()
+        with self.lock:
+            self.pending = dict()
+        logger.info('Sharded ingestion, stopped the workers of ' + self.routing_key)
+
+    def ship_records(self, enabled):
+        """
+        Tells the workers whether the raw proxy records are needed (there are
+        observers subscribed to ALL).
+        """
+        if enabled == self.with_records:
+            return
+        self.with_records = enabled
+        for process, results in self.processes:
+            try:
+                process.stdin.write('1\n' if enabled else '0\n')
+                process.stdin.flush()
+            except IOError as e:
+                logger.error('Sharded ingestion, Error writing to a worker of ' + self.routing_key + ': ' + str(e))
+
+    def collect(self, tick):
+        """
+        Returns the partial aggregates of the interval before the one that
+        ends at *tick*, which the workers sent when it ended, without waiting
+        for them. The partials of older intervals are dropped and counted in
+        late_partials, so they never spill into another interval.
+
+        :param tick: The aligned time of the interval.
+        :type tick: float
+        :rtype: list of PartialAggregate
+        """
+        number = self._interval_number(tick) - 1
+        with self.lock:
+            partials = self.pending.pop(number, [])
+            for late in [late for late in self.pending if late < number]:
+                self.late_partials += len(self.pending.pop(late))
+        # Merged in the same order at every tick
+        partials.sort(key=lambda partial: partial.worker)
+        return partials
+
+    def stats(self):
+        """
+        Returns the counters of the workers.
+        """
+        return {'workers': len(self.processes), 'late_partials': self.late_partials}
+
+
+if __name__ == '__main__':
+    # Run as a module, this file is __main__: the worker is run from the
+    # metrics.sharding module, so the partial aggregates pickle with its names
+    from metrics.sharding import main as worker_main
+    worker_main(sys.argv[1:])
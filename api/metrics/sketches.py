@@ -0,0 +1,172 @@
+import math
+import numpy
+
+DEFAULT_ACCURACY = 0.01  # relative error of the quantiles
+DEFAULT_MAX_BINS = 512  # bins per sign before collapsing the lowest ones
+QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+# Layout of the combined (target, sign, bucket) keys used by build_sketches()
+_KEY_OFFSET = 1 << 20
+_KEY_RANGE = 1 << 21
+
+
+class DDSketch(object):
+    """
+    Quantile sketch with relative-error guarantees (DDSketch). Values are
+    counted in logarithmic buckets, so sketches are mergeable. The number of
+    buckets is bounded: when it grows over max_bins, the lowest buckets are
+    collapsed, so the memory used by a sketch is constant.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = dict()
+        self.negative = dict()
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def key(self, value):
+        """
+        Returns the bucket of a (non-zero) absolute value.
+        """
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def add(self, value, count=1):
+        if value > 0:
+            self.add_bucket(1, self.key(value), count)
+        elif value < 0:
+            self.add_bucket(-1, self.key(-value), count)
+        else:
+            self.add_bucket(0, 0, count)
+        self.sum += value * count
+
+    def add_bucket(self, sign, key, count):
+        """
+        Adds *count* values to a bucket. The sum is not updated.
+
+        :param sign: 1 for positive values, -1 for negative values, 0 for zeros.
+        :param key: The bucket, as returned by key().
+        """
+        if sign > 0:
+            store = self.positive
+        elif sign < 0:
+            store = self.negative
+        else:
+            self.zero_count += count
+            self.count += count
+            return
+        store[key] = store.get(key, 0) + count
+        self.count += count
+        if len(store) > self.max_bins:
+            self._collapse(store, sign)
+
+    def _collapse(self, store, sign):
+        # The lowest values are collapsed: the lowest keys of the positive
+        # store and the highest keys (largest absolute values) of the negative one
+        keys = sorted(store, reverse=sign < 0)
+        excess = keys[:len(keys) - self.max_bins + 1]
+        target = keys[len(excess)]
+        for key in excess:
+            store[target] += store.pop(key)
+
+    def merge(self, other):
+        """
+        Merges another sketch (with the same accuracy) into this one.
+        """
+        for key, count in other.positive.iteritems():
+            self.add_bucket(1, key, count)
+        for key, count in other.negative.iteritems():
+            self.add_bucket(-1, key, count)
+        self.add_bucket(0, 0, other.zero_count)
+        self.sum += other.sum
+
+    def scale(self, factor):
+        """
+        Multiplies the counts and the sum of the sketch, e.g. to extrapolate a
+        uniform sample to the population. Quantiles are not changed.
+        """
+        for store in (self.positive, self.negative):
+            for key in store:
+                store[key] *= factor
+        self.zero_count *= factor
+        self.count *= factor
+        self.sum *= factor
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """
+        Returns the estimated q-quantile (0 <= q <= 1), or None if empty.
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive)) if self.positive else 0.0
+
+    def summary(self):
+        """
+        Returns the count, the sum and the p50, p95 and p99 of the sketch.
+        """
+        summary = {'count': self.count, 'sum': self.sum}
+        for name, q in QUANTILES:
+            summary[name] = self.quantile(q)
+        return summary
+
+
+def build_sketches(ids, values, targets, relative_accuracy=DEFAULT_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+    """
+    Builds a sketch per target from the parallel arrays of an aggregation
+    interval. The buckets are computed and counted with NumPy, so the Python
+    work is proportional to the number of distinct (target, bucket) pairs
+    instead of the number of values.
+
+    :param ids: The target id of each value.
+    :type ids: numpy.ndarray
+    :param values: The values.
+    :type values: numpy.ndarray
+    :param targets: The target of each id.
+    :type targets: list
+    :return: A {target: DDSketch} dictionary.
+    """
+    sketches = dict()
+    if not len(ids):
+        return sketches
+    log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+
+    signs = numpy.sign(values).astype(numpy.int64)
+    absolute = numpy.abs(values)
+    keys = numpy.zeros(len(values), dtype=numpy.int64)
+    nonzero = signs != 0
+    keys[nonzero] = numpy.ceil(numpy.log(absolute[nonzero]) / log_gamma)
+
+    combined = ((ids * 3 + signs + 1) * _KEY_RANGE) + keys + _KEY_OFFSET
+    unique, counts = numpy.unique(combined, return_counts=True)
+    sums = numpy.bincount(ids, weights=values)
+
+    for combined_key, count in zip(unique.tolist(), counts.tolist()):
+        target_sign, key = divmod(combined_key, _KEY_RANGE)
+        target_id, sign = divmod(target_sign, 3)
+        target = targets[target_id]
+        sketch = sketches.get(target)
+        if sketch is None:
+            sketch = sketches[target] = DDSketch(relative_accuracy, max_bins)
+            sketch.sum = float(sums[target_id])
+        sketch.add_bucket(sign - 1, key - _KEY_OFFSET, count)
+    return sketches
@@ -8,7 +8,9 @@ from django.test import TestCase, override_settings
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
-from metrics.views import metric_module_list, metric_module_detail, MetricModuleData, list_activated_metrics
+from metrics.views import metric_module_list, metric_module_detail, MetricModuleData, list_activated_metrics, metric_quantiles, \
+    metric_stats, metric_series, metric_top, start_metric, stop_metric
+from metrics.series import SeriesWriter
 
 
 # Tests use database=10 instead of 0.
@@ -157,6 +159,86 @@ class MetricsTestCase(TestCase):
         metrics_data = json.loads(response.content)
         self.assertEqual(len(metrics_data), 2)
 
+    @mock.patch('metrics.views.create_local_host')
+    def test_start_and_stop_metric_bump_dsl_generation(self, mock_create_local_host):
+        with mock.patch.dict('metrics.views.metric_actors', {}):
+            start_metric('get_bandwidth')
+            mock_create_local_host.return_value.spawn.return_value.init_consum.assert_called_once_with()
+            generation = self.r.get('dsl:generation')
+            self.assertIsNotNone(generation)
+
+            stop_metric('get_bandwidth')
+            mock_create_local_host.return_value.spawn.return_value.stop_actor.assert_called_once_with()
+            self.assertNotEqual(self.r.get('dsl:generation'), generation)
+
+    #
+    # Metric actor views
+    #
+
+    def test_metric_quantiles_view(self):
+        request = self.factory.get('/metrics/get_bandwidth/quantiles')
+        response = metric_quantiles(request, 'get_bandwidth')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        actor = mock.MagicMock()
+        actor.get_quantiles.return_value = {'p1': {'count': 1, 'sum': 2.0, 'rate': 1.0, 'p50': 2.0, 'p95': 2.0, 'p99': 2.0}}
+        with mock.patch.dict('metrics.views.metric_actors', {'get_bandwidth': actor}):
+            response = metric_quantiles(request, 'get_bandwidth')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['p1']['sum'], 2.0)
+
+        request = self.factory.post('/metrics/get_bandwidth/quantiles')
+        response = metric_quantiles(request, 'get_bandwidth')
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    def test_metric_stats_view(self):
+        request = self.factory.get('/metrics/get_bandwidth/stats')
+        response = metric_stats(request, 'get_bandwidth')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        actor = mock.MagicMock()
+        actor.get_stats.return_value = {'buffer': {'dropped': 3}, 'logstash': {'dropped': 0}}
+        with mock.patch.dict('metrics.views.metric_actors', {'get_bandwidth': actor}):
+            response = metric_stats(request, 'get_bandwidth')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['buffer']['dropped'], 3)
+
+    def test_metric_top_view(self):
+        request = self.factory.get('/metrics/get_bandwidth/top', {'k': 1})
+        actor = mock.MagicMock()
+        actor.get_top.return_value = {'containers': [{'target': 'p1/c1', 'value': 2.0, 'error': 0.0}]}
+        with mock.patch.dict('metrics.views.metric_actors', {'get_bandwidth': actor}):
+            response = metric_top(request, 'get_bandwidth')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            actor.get_top.assert_called_with(1)
+            self.assertEqual(json.loads(response.content)['containers'][0]['target'], 'p1/c1')
+
+            request = self.factory.get('/metrics/get_bandwidth/top', {'k': 'x'})
+            response = metric_top(request, 'get_bandwidth')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = metric_top(self.factory.get('/metrics/get_bandwidth/top'), 'get_bandwidth')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @mock.patch('metrics.views.time.time')
+    def test_metric_series_view(self, mock_time):
+        writer = SeriesWriter(self.r, 'get_bandwidth')
+        writer.write(1500000000, {'p1': 2.0, 'p2': 3.0})
+        mock_time.return_value = 1500000030
+
+        request = self.factory.get('/metrics/get_bandwidth/series', {'target': 'p1', 'minutes': 1})
+        response = metric_series(request, 'get_bandwidth')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {'p1': [[1500000000, 2.0]]})
+
+        request = self.factory.get('/metrics/get_bandwidth/series', {'resolution': 60})
+        response = metric_series(request, 'get_bandwidth')
+        self.assertEqual(sorted(json.loads(response.content).keys()), ['p1', 'p2'])
+
+        request = self.factory.get('/metrics/get_bandwidth/series', {'resolution': 7})
+        response = metric_series(request, 'get_bandwidth')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     #
     # Aux methods
     #
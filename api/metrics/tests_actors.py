@@ -1,15 +1,42 @@
+import cPickle
+import errno
+import itertools
 import json
+import multiprocessing
 import os
+import socket
+import time
+import unittest
+import Queue
 
 import mock
+import numpy
 import redis
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase, override_settings
-from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
-from metrics.views import metric_module_list, metric_module_detail, MetricModuleData, list_activated_metrics
 from metrics.actors.swift_metric import SwiftMetric
+from metrics.decoder import decode, decode_batch, encode_columns, encode_msgpack, msgpack, MetricRecord, \
+    BATCH_CONTENT_TYPE, MSGPACK_BATCH_CONTENT_TYPE
+from metrics.exporters import UDPLogstashExporter, get_logstash_exporter, release_logstash_exporter, \
+    stop_logstash_exporters
+from metrics.ingestion import DatagramIngestionServer, DatagramSender, parse_datagram
+from metrics.admission import ProjectAdmission
+from metrics.aggregation import ColumnarAggregator, DeviceAggregator
+from metrics.batch import MetricBatch
+from metrics.buffers import MetricBuffer
+from metrics.bus import MetricBusWriter, MetricBusReader, BusSubscription, bus_alive, bus_path, subscribe, unsubscribe
+from metrics.delta import DeltaFilter
+from metrics.scheduler import TickScheduler, next_tick
+from metrics.series import SeriesWriter, read_series, series_key, SLOT
+from metrics.windows import EventTimeWindows, parse_timestamp
+from metrics.sharding import IngestionShard, PartialAggregate, ShardedIngestion, WorkerControl, merge_partials, \
+    shard_policies, _ingestion_worker
+from metrics.sketches import DDSketch, build_sketches
+from metrics.topk import SpaceSaving
+from api.exceptions import MetricDecodeError
 
 
 # Tests use database=10 instead of 0.
@@ -28,19 +55,19 @@ class MetricsActorsTestCase(TestCase):
 
     def tearDown(self):
         self.r.flushdb()
+        stop_logstash_exporters()
 
     #
     # Actors
     #
 
     @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
-    @mock.patch('metrics.actors.swift_metric.Thread')
-    def test_swift_metric(self, mock_thread, mock_send_data_to_logstash):
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric(self, mock_get_scheduler, mock_send_data_to_logstash):
         actor_id = '1'
         routing_key = 'metric.' + actor_id
         swift_metric = SwiftMetric(actor_id, routing_key)
-        mock_thread.assert_called()
-        mock_thread.return_value.start.assert_called()
+        mock_get_scheduler.return_value.register.assert_called_with(actor_id, swift_metric._process_interval, 1)
         self.assertEqual(swift_metric.name, actor_id)
 
         body = '{"container": "crystal/data", "metric_name": "bandwidth", "@timestamp": "2017-09-09T18:00:18.331492+02:00", ' \
@@ -48,9 +75,1130 @@ class MetricsActorsTestCase(TestCase):
         swift_metric.notify(body)
         expected_dict = {'project': 'crystal', 'host': 'controller', 'container': 'crystal/data', 'metric_name': 'bandwidth',
                          'server_type': 'proxy', '@timestamp': '2017-09-09T18:00:18.331492+02:00', 'method': 'GET', 'value': 16.4375}
-        mock_send_data_to_logstash.assert_called_with(expected_dict)
-        self.assertFalse(swift_metric.metrics.empty())
-        self.assertEqual(swift_metric.metrics.get(), expected_dict)
+        self.assertEqual(mock_send_data_to_logstash.call_args[0][0].as_dict(), expected_dict)
+        metric_list, weight = swift_metric._drain_metrics()
+        self.assertEqual(len(metric_list), 1)
+        self.assertEqual(metric_list[0].as_dict(), expected_dict)
+        self.assertEqual(swift_metric._drain_metrics(), ([], 1.0))
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_invalid_message(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('1', 'metric.1')
+        swift_metric.notify('__import__("os").system("true")')
+        swift_metric.notify('{"value": 1}')
+        self.assertEqual(swift_metric._drain_metrics(), ([], 1.0))
+        self.assertFalse(mock_send_data_to_logstash.called)
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_notify_batch(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('1', 'metric.1')
+        swift_metric.notify_batch(['{"value": 1, "server_type": "proxy", "project": "p1"}',
+                                   'invalid',
+                                   '{"value": 2, "server_type": "object", "project": "p1"}',
+                                   '{"value": 3, "server_type": "proxy", "project": "p2"}'])
+        self.assertEqual([metric.value for metric in swift_metric._drain_metrics()[0]], [1, 3])
+        self.assertEqual(mock_send_data_to_logstash.call_count, 3)
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_summaries(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        summary_observer = mock.MagicMock()
+        summary_observer.get_target.return_value = 'p1'
+        summary_observer.get_id.return_value = 'rule_1'
+        value_observer = mock.MagicMock()
+        value_observer.get_target.return_value = 'p1'
+        value_observer.get_id.return_value = 'rule_2'
+        swift_metric.attach(summary_observer, summaries=True)
+        swift_metric.attach(value_observer)
+
+        for value in range(1, 101):
+            swift_metric.notify('{"value": %d, "server_type": "proxy", "project": "p1", "container": "p1/c1"}' % value)
+        swift_metric._process_interval()
+
+        value_observer.update.assert_called_once_with('get_bandwidth', 5050)
+        summary = summary_observer.update.call_args[0][1]
+        self.assertEqual(summary['value'], 5050)
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['rate'], 100)
+        self.assertAlmostEqual(summary['p50'], 50, delta=1)
+        self.assertAlmostEqual(summary['p99'], 99, delta=1)
+
+        quantiles = swift_metric.get_quantiles()
+        self.assertEqual(set(quantiles.keys()), {'p1', 'p1/c1'})
+        self.assertEqual(quantiles['p1/c1']['count'], 100)
+
+        swift_metric.detach('rule_1', 'p1')
+        self.assertEqual(swift_metric._summary_observers, set())
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_merges_shards(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        observer = mock.MagicMock()
+        observer.get_target.return_value = 'p1'
+        observer.get_id.return_value = 'rule_1'
+        swift_metric.attach(observer)
+        swift_metric.shards = mock.MagicMock()
+        swift_metric.shards.collect.return_value = [
+            PartialAggregate(0, 101, {'p1': 2.0, 'p1/c1': 2.0}, None, None, None, None),
+            PartialAggregate(1, 101, {'p1': 3.0, 'p1/c2': 3.0}, None, None, None, None)]
+        swift_metric.notify('{"value": 1, "server_type": "proxy", "project": "p1", "container": "p1/c1"}')
+        swift_metric._process_interval(101)
+        swift_metric.shards.ship_records.assert_called_with(False)
+        swift_metric.shards.collect.assert_called_once_with(101)
+        observer.update.assert_called_once_with('get_bandwidth', 6.0)
+
+    @override_settings(METRIC_BUFFERS={'get_bandwidth': {'size': 10, 'policy': 'sample'}})
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_sampled_buffer(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        observer = mock.MagicMock()
+        observer.get_target.return_value = 'p1'
+        observer.get_id.return_value = 'rule_1'
+        swift_metric.attach(observer)
+        swift_metric.notify_batch(['{"value": 2, "server_type": "proxy", "project": "p1"}'] * 40)
+        swift_metric._process_interval()
+        # 10 sampled metrics with a weight of 4
+        observer.update.assert_called_once_with('get_bandwidth', 80)
+        self.assertEqual(swift_metric.get_stats()['buffer']['sampled'], 30)
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_batched_fan_out(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        batch_observer = mock.MagicMock()
+        batch_observer.get_id.return_value = 'controller_1'
+        swift_metric.attach(batch_observer, targets=['p1', 'p2', 'p3'])
+        rule = mock.MagicMock()
+        rule.get_target.return_value = 'p2'
+        rule.get_id.return_value = 'rule_1'
+        swift_metric.attach(rule)
+        self.assertEqual(set(swift_metric._observers['p2'].keys()), {'controller_1', 'rule_1'})
+
+        swift_metric.notify_batch(['{"value": 1, "server_type": "proxy", "project": "p1", "container": "p1/c1"}',
+                                   '{"value": 2, "server_type": "proxy", "project": "p2", "container": "p2/c1"}',
+                                   '{"value": 4, "server_type": "proxy", "project": "p4", "container": "p4/c1"}'])
+        swift_metric._process_interval()
+        batch_observer.update_batch.assert_called_once_with('get_bandwidth', {'p1': 1, 'p2': 2})
+        self.assertFalse(batch_observer.update.called)
+        rule.update.assert_called_once_with('get_bandwidth', 2)
+
+        swift_metric.detach('controller_1', 'p1')
+        self.assertIn('controller_1', swift_metric._batch_observers)
+        swift_metric.detach('controller_1')
+        self.assertEqual(swift_metric._observers, {'p2': {'rule_1': rule}})
+        self.assertEqual(swift_metric._batch_observers, set())
+        self.assertEqual(swift_metric._observer_proxies, {'rule_1': rule})
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_delta_observer(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        observer = mock.MagicMock()
+        observer.get_target.return_value = 'p1'
+        observer.get_id.return_value = 'rule_1'
+        swift_metric.attach(observer, epsilon=0.1, relative=True, keyframe=3)
+
+        for value in [10, 10.5, 12, 12, 12]:
+            swift_metric.notify('{"value": %s, "server_type": "proxy", "project": "p1"}' % value)
+            swift_metric._process_interval()
+        # First value, change over 10%, and keyframe
+        self.assertEqual([call[0][1] for call in observer.update.call_args_list], [10, 12, 12])
+
+        swift_metric.detach('rule_1', 'p1')
+        self.assertEqual(swift_metric._delta_observers, {})
+
+    @override_settings(METRIC_BUS_ENABLED=True, METRIC_BUS_DIR=os.path.join("/tmp", "crystal", "bus"))
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_bus_observer(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        reader = MetricBusReader(bus_path('get_bandwidth'))
+        self.assertEqual(reader.poll(), [])
+        local = mock.MagicMock()
+        local.get_target.return_value = 'p1'
+        local.get_id.return_value = 'rule_1'
+        remote = mock.MagicMock()
+        remote.get_target.return_value = 'p1'
+        remote.get_id.return_value = 'rule_2'
+        swift_metric.attach(local, bus=True)
+        swift_metric.attach(remote)
+
+        swift_metric.notify('{"value": 10, "server_type": "proxy", "project": "p1"}')
+        swift_metric._process_interval(100.0)
+        # The local observer reads the bus instead of receiving updates
+        self.assertFalse(local.update.called)
+        remote.update.assert_called_once_with('get_bandwidth', 10)
+        self.assertEqual(reader.poll(set(['p1'])), [(1, 100.0, {'p1': 10})])
+
+        swift_metric.detach('rule_1')
+        self.assertEqual(swift_metric._bus_observers, set())
+        swift_metric.bus.close()
+        reader.close()
+
+    @override_settings(METRIC_BUS_ENABLED=True, METRIC_BUS_DIR=os.path.join("/tmp", "crystal", "bus"),
+                       METRIC_BUS_SLOT_SIZE=40)
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_bus_overflow(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        reader = MetricBusReader(bus_path('get_bandwidth'))
+        reader.poll()
+        observers = dict()
+        for project in ('p1', 'p2'):
+            observer = observers[project] = mock.MagicMock()
+            observer.get_target.return_value = project
+            observer.get_id.return_value = 'rule_' + project
+            swift_metric.attach(observer, bus=True)
+
+        swift_metric.notify_batch(['{"value": 10, "server_type": "proxy", "project": "p1"}',
+                                   '{"value": 20, "server_type": "proxy", "project": "p2"}'])
+        swift_metric._process_interval(100.0)
+        # A slot only has room for one target: the other one is sent to its observer
+        published = reader.poll()[0][2]
+        self.assertEqual(len(published), 1)
+        sent = [project for project, observer in observers.items() if observer.update.called]
+        self.assertEqual(sent, [project for project in ('p1', 'p2') if project not in published])
+        self.assertEqual(swift_metric.get_stats()['bus'], {'overflow': 1})
+        swift_metric.bus.close()
+        reader.close()
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_device_observer(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        body = '{"value": %s, "server_type": "object", "host": "storage1", "storage_policy": "0", "device": "sdb"}'
+        # Object-server metrics are not kept without device observers
+        swift_metric.notify(body % 1)
+        self.assertEqual(len(swift_metric.object_metrics), 0)
+
+        controller = mock.MagicMock()
+        controller.get_id.return_value = 'controller_1'
+        swift_metric.attach(controller, devices=True)
+        swift_metric.notify_batch([body % 1, body % 2, '{"value": 4, "server_type": "object", "host": "storage2"}',
+                                   '{"value": 8, "server_type": "proxy", "project": "p1"}'])
+        swift_metric._process_interval(100.0)
+        controller.update_devices.assert_called_once_with('get_bandwidth', {('storage1', '0', 'sdb'): 3.0,
+                                                                            ('storage2', None, None): 4.0})
+        self.assertFalse(controller.update.called)
+
+        swift_metric.detach('controller_1', 'ALL')
+        self.assertIn('controller_1', swift_metric._observer_proxies)
+        swift_metric.detach('controller_1')
+        self.assertEqual(swift_metric._device_observers, {})
+        self.assertEqual(swift_metric._observer_proxies, {})
+
+    @override_settings(METRIC_PROJECT_RATE=1, METRIC_PROJECT_BURST=2, METRIC_COLUMNAR_BATCHES=True)
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_project_quotas(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        rule = mock.MagicMock()
+        rule.get_target.return_value = 'noisy'
+        rule.get_id.return_value = 'rule_1'
+        controller = mock.MagicMock()
+        controller.get_target.return_value = 'ALL'
+        controller.get_id.return_value = 'controller_1'
+        other = mock.MagicMock()
+        other.get_target.return_value = 'ALL'
+        other.get_id.return_value = 'controller_2'
+        swift_metric.attach(rule)
+        swift_metric.attach(controller, folded=True)
+        swift_metric.attach(other)
+
+        body = '{"value": %d, "server_type": "proxy", "project": "%s", "container": "%s/c1", "host": "proxy1"}'
+        swift_metric.notify_batch([body % (value, 'noisy', 'noisy') for value in range(1, 11)] +
+                                  [body % (5, 'quiet', 'quiet')])
+        metric_list, _ = swift_metric._drain_metrics()
+        # The noisy project only keeps its burst, the quiet one is not affected
+        self.assertEqual([(metric.project, metric.value) for metric in metric_list],
+                         [('noisy', 1), ('noisy', 2), ('quiet', 5)])
+        self.assertEqual(swift_metric.admission.stats(), {'admitted': 3, 'folded': 8, 'projects': 2})
+
+        swift_metric.metrics.extend(metric_list)
+        swift_metric._process_interval(100.0)
+        # The project sums include the folded records
+        rule.update.assert_called_once_with('get_bandwidth', 55)
+        batch = controller.update.call_args[0][1]
+        self.assertEqual(batch.group_sum('project'), {'noisy': 55, 'quiet': 5})
+        self.assertEqual([metric['count'] for metric in batch if 'count' in metric], [8])
+        # Only the observers that opt in receive the summaries
+        self.assertEqual(other.update.call_args[0][1].group_sum('project'), {'noisy': 3, 'quiet': 5})
+        self.assertEqual(swift_metric.get_quantiles()['noisy']['count'], 10)
+        self.assertEqual(swift_metric.get_top(1)['projects'][0]['value'], 55)
+        self.assertEqual(swift_metric.get_top(1)['hosts'][0]['value'], 8)
+
+    @override_settings(METRIC_EVENT_TIME=True, METRIC_WINDOW_LENGTH=1, METRIC_ALLOWED_LATENESS=1)
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_event_time(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        observer = mock.MagicMock()
+        observer.get_target.return_value = 'p1'
+        observer.get_id.return_value = 'rule_1'
+        swift_metric.attach(observer)
+        body = '{"value": %d, "server_type": "proxy", "project": "p1", "@timestamp": "%s"}'
+
+        # Delayed messages of the second 100 arrive with the messages of the following seconds
+        swift_metric.notify_batch([body % (1, '1970-01-01T00:01:40.500000+00:00'),
+                                   body % (2, '1970-01-01T00:01:41.100000+00:00'),
+                                   body % (4, '1970-01-01T00:01:40.900000+00:00')])
+        swift_metric._process_interval(102)
+        self.assertFalse(observer.update.called)
+        swift_metric.notify_batch([body % (8, '1970-01-01T00:01:40.950000+00:00'),
+                                   body % (16, '1970-01-01T00:01:42.200000+00:00')])
+        swift_metric._process_interval(103)
+        observer.update.assert_called_once_with('get_bandwidth', 13)
+        # Too late for the window of the second 100
+        swift_metric.notify_batch([body % (32, '1970-01-01T00:01:40.700000+00:00'),
+                                   body % (64, '1970-01-01T00:01:43.500000+00:00')])
+        swift_metric._process_interval(104)
+        observer.update.assert_called_with('get_bandwidth', 2)
+        self.assertEqual(swift_metric.get_stats()['windows']['late'], 1)
+
+    @override_settings(METRIC_EVENT_TIME=True, METRIC_WINDOW_LENGTH=1, METRIC_ALLOWED_LATENESS=1)
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_event_time_shards(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        observer = mock.MagicMock()
+        observer.get_target.return_value = 'p1'
+        observer.get_id.return_value = 'rule_1'
+        swift_metric.attach(observer)
+        swift_metric.shards = mock.MagicMock()
+        body = '{"value": %d, "server_type": "proxy", "project": "p1", "@timestamp": "%s"}'
+
+        # The first tick closes no window: the partials of the workers are kept
+        swift_metric.shards.collect.return_value = [PartialAggregate(0, 102, {'p1': 2.0}, None, None, None, None)]
+        swift_metric.notify(body % (1, '1970-01-01T00:01:40.500000+00:00'))
+        swift_metric._process_interval(102)
+        self.assertFalse(observer.update.called)
+
+        swift_metric.shards.collect.return_value = [PartialAggregate(0, 103, {'p1': 4.0}, None, None, None, None)]
+        swift_metric._process_interval(103)
+        observer.update.assert_called_once_with('get_bandwidth', 7.0)
+        self.assertEqual(swift_metric.window_partials, [])
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_top(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        body = '{"value": %d, "server_type": "proxy", "project": "%s", "container": "%s", "host": "%s"}'
+        swift_metric.notify_batch([body % (1, 'p1', 'p1/c1', 'proxy1'),
+                                   body % (5, 'p2', 'p2/c1', 'proxy1'),
+                                   body % (2, 'p1', 'p1/c2', 'proxy2')])
+        swift_metric._process_interval()
+        swift_metric.notify(body % (4, 'p1', 'p1/c2', 'proxy2'))
+        swift_metric._process_interval()
+
+        top = swift_metric.get_top(2)
+        self.assertEqual(top['projects'], [{'target': 'p1', 'value': 7, 'error': 0},
+                                           {'target': 'p2', 'value': 5, 'error': 0}])
+        self.assertEqual([item['target'] for item in top['containers']], ['p1/c2', 'p2/c1'])
+        self.assertEqual(sorted((item['target'], item['value']) for item in top['hosts']), [('proxy1', 6), ('proxy2', 6)])
+
+    @override_settings(METRIC_TOP_CAPACITY=0)
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_top_disabled(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        swift_metric.notify('{"value": 1, "server_type": "proxy", "project": "p1", "host": "proxy1"}')
+        swift_metric._process_interval()
+        self.assertEqual(swift_metric.get_top(2), {})
+
+    @override_settings(METRIC_COLUMNAR_BATCHES=True)
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_all_observers_get_batches(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        controller = mock.MagicMock()
+        controller.get_target.return_value = 'ALL'
+        controller.get_id.return_value = 'controller_1'
+        swift_metric.attach(controller)
+        body = '{"value": 1.5, "server_type": "proxy", "project": "p1", "container": "p1/c1", "storage_policy": "0"}'
+        swift_metric.notify_batch([body, body])
+        swift_metric._process_interval()
+
+        batch = controller.update.call_args[0][1]
+        self.assertIsInstance(batch, MetricBatch)
+        self.assertEqual([metric['storage_policy'] for metric in batch], ['0', '0'])
+        self.assertEqual(batch.group_sum('project'), {'p1': 3.0})
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_all_observers_get_lists(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        controller = mock.MagicMock()
+        controller.get_target.return_value = 'ALL'
+        controller.get_id.return_value = 'controller_1'
+        swift_metric.attach(controller)
+        swift_metric.notify('{"value": 2, "server_type": "proxy", "project": "p1"}')
+        swift_metric._process_interval()
+
+        metric_list = controller.update.call_args[0][1]
+        self.assertIsInstance(metric_list, list)
+        self.assertEqual([(metric['project'], metric['value']) for metric in metric_list], [('p1', 2)])
+
+    #
+    # Decoder
+    #
+
+    def test_decode_json(self):
+        body = '{"container": "crystal/data", "metric_name": "bandwidth", "@timestamp": "2017-09-09T18:00:18.331492+02:00", ' \
+               '"value": 16.4375, "project": "crystal", "host": "controller", "method": "GET", "server_type": "proxy", ' \
+               '"storage_policy": "0"}'
+        metric = decode(body)
+        self.assertIsInstance(metric, MetricRecord)
+        self.assertEqual(metric.project, 'crystal')
+        self.assertEqual(metric.container, 'crystal/data')
+        self.assertEqual(metric.value, 16.4375)
+        self.assertEqual(metric.extra, {'storage_policy': '0'})
+        self.assertIs(decode(body).project, metric.project)
+
+    def test_decode_python_literal(self):
+        metric_dict = {'container': 'crystal/data', 'metric_name': 'bandwidth', '@timestamp': '2017-09-09T18:00:18.331492+02:00',
+                       'value': 16.4375, 'project': 'crystal', 'host': 'controller', 'method': 'GET', 'server_type': 'proxy'}
+        self.assertEqual(decode(str(metric_dict)).as_dict(), metric_dict)
+
+    @unittest.skipUnless(msgpack, "msgpack is not installed")
+    def test_decode_msgpack(self):
+        metric_dict = {'container': 'crystal/data', 'metric_name': 'bandwidth', '@timestamp': '2017-09-09T18:00:18.331492+02:00',
+                       'value': 16.4375, 'project': 'crystal', 'host': 'controller', 'method': 'GET', 'server_type': 'proxy'}
+        self.assertEqual(decode(encode_msgpack(metric_dict)).as_dict(), metric_dict)
+
+        blob = encode_columns([{'value': 1, 'server_type': 'proxy', 'project': 'p1'},
+                               {'value': 2, 'server_type': 'proxy', 'project': 'p2'}])
+        records, invalid = decode_batch(encode_msgpack(blob), MSGPACK_BATCH_CONTENT_TYPE)
+        self.assertEqual([record.project for record in records], ['p1', 'p2'])
+
+    @mock.patch('metrics.decoder.msgpack', None)
+    def test_decode_without_msgpack(self):
+        self.assertEqual(decode('{"value": 1, "server_type": "proxy"}').value, 1)
+        with self.assertRaises(MetricDecodeError):
+            decode('\x82\xa5value\x01\xabserver_type\xa5proxy')
+
+    def test_decode_invalid_message(self):
+        with self.assertRaises(MetricDecodeError):
+            decode("{'value': __import__('os').getpid(), 'server_type': 'proxy'}")
+        with self.assertRaises(MetricDecodeError):
+            decode('{"value": 1}')
+
+    def test_decode_batch(self):
+        metrics = [{'value': 1, 'server_type': 'proxy', 'project': 'p1', 'host': 'proxy1'},
+                   {'value': 2, 'server_type': 'proxy', 'project': 'p2', 'host': 'proxy1'},
+                   {'value': 3, 'project': 'p3', 'host': 'proxy1'}]
+        records, invalid = decode_batch(json.dumps(metrics))
+        self.assertEqual(([record.value for record in records], invalid), ([1, 2], 1))
+
+        blob = encode_columns(metrics[:2])
+        self.assertEqual(blob['common'], {'server_type': 'proxy', 'host': 'proxy1'})
+        records, invalid = decode_batch(json.dumps(blob))
+        self.assertEqual([record.as_dict() for record in records], [decode(json.dumps(metric)).as_dict()
+                                                                    for metric in metrics[:2]])
+        self.assertEqual(decode_batch(json.dumps(metrics[0]))[0][0].project, 'p1')
+        with self.assertRaises(MetricDecodeError):
+            decode_batch('{"columns": {"value": [1, 2], "project": ["p1"]}}')
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_swift_metric_batch_messages(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        blob = encode_columns([{'value': 1, 'server_type': 'proxy', 'project': 'p1'},
+                               {'value': 2, 'server_type': 'proxy', 'project': 'p2'}])
+        swift_metric.notify(json.dumps(blob))
+        swift_metric.notify_batch(['{"value": 3, "server_type": "proxy", "project": "p1"}', json.dumps(blob)],
+                                  [None, BATCH_CONTENT_TYPE])
+        metric_list, _ = swift_metric._drain_metrics()
+        self.assertEqual([metric.value for metric in metric_list], [1, 2, 3, 1, 2])
+
+    #
+    # Aggregation
+    #
+
+    def test_columnar_aggregator(self):
+        aggregator = ColumnarAggregator(capacity=2)
+        records = [decode('{"value": %d, "server_type": "proxy", "project": "%s", "container": "%s"}' % (value, project, container))
+                   for value, project, container in [(1, 'p1', 'p1/c1'), (2, 'p1', 'p1/c2'), (4, 'p2', 'p2/c1')]]
+        aggregator.add_records(records)
+        aggregator.add('p1', 'p1/c1', 8)
+        aggregate = aggregator.flush(with_maxima=True)
+        self.assertEqual(aggregate.as_dict(), {'p1': 11, 'p1/c1': 9, 'p1/c2': 2, 'p2': 4, 'p2/c1': 4})
+        self.assertEqual(aggregate.as_dict('counts'), {'p1': 3, 'p1/c1': 2, 'p1/c2': 1, 'p2': 1, 'p2/c1': 1})
+        self.assertEqual(aggregate.as_dict('maxima')['p1'], 8)
+
+        # The accumulators are reset after each interval
+        aggregator.add_records(records[2:])
+        self.assertEqual(aggregator.flush().as_dict(), {'p2': 4, 'p2/c1': 4})
+        self.assertEqual(len(aggregator.flush()), 0)
+
+    def test_columnar_aggregator_hosts(self):
+        aggregator = ColumnarAggregator(capacity=2, with_hosts=True)
+        records = [decode('{"value": %d, "server_type": "proxy", "project": "p1", "host": "%s"}' % (value, host))
+                   for value, host in [(1, 'proxy1'), (2, 'proxy2'), (4, 'proxy1')]]
+        aggregator.add_records(records)
+        aggregator.add('p1', None, 8, 'proxy2')
+        aggregate = aggregator.flush()
+        self.assertEqual(aggregate.hosts, {'proxy1': 5, 'proxy2': 10})
+        self.assertEqual(ColumnarAggregator().flush().hosts, None)
+
+    def test_device_aggregator(self):
+        records = [decode('{"value": 1, "server_type": "object", "host": "s1", "storage_policy": "0", "device": "sdb"}'),
+                   decode('{"value": 2, "server_type": "object", "host": "s1", "storage_policy": "0", "device": "sdb"}'),
+                   decode('{"value": 3, "server_type": "object", "host": "s1", "storage_policy": "1", "device": "sdc"}'),
+                   decode('{"value": "x", "server_type": "object", "host": "s1"}')]
+        self.assertEqual(DeviceAggregator().aggregate(records, 2.0), {('s1', '0', 'sdb'): 6.0, ('s1', '1', 'sdc'): 6.0})
+
+    def test_columnar_aggregator_invalid_value(self):
+        aggregator = ColumnarAggregator()
+        records = [decode('{"value": "x", "server_type": "proxy", "project": "p1", "container": "p1/c1"}'),
+                   decode('{"value": 2, "server_type": "proxy", "project": "p1", "container": "p1/c1"}')]
+        aggregator.add_records(records)
+        self.assertEqual(aggregator.flush().as_dict(), {'p1': 2, 'p1/c1': 2})
+
+    #
+    # Time series
+    #
+
+    def test_series_writer_tiers(self):
+        writer = SeriesWriter(self.r, 'get_bandwidth')
+        start = 1500000000  # multiple of 60
+        for second in range(25):
+            writer.write(start + second, {'p1': float(second), 'p1/c1': 1.0})
+
+        series = read_series(self.r, 'get_bandwidth', 1, start + 20)
+        self.assertEqual(series, {'p1': [[start + second, float(second)] for second in range(20, 25)]})
+        series = read_series(self.r, 'get_bandwidth', 10, 0, ['p1'])
+        self.assertEqual(series['p1'], [[start, 4.5], [start + 10, 14.5], [start + 20, 22.0]])
+        self.assertEqual(read_series(self.r, 'get_bandwidth', 60, 0)['p1'], [[start, 12.0]])
+        # Container series are disabled by default
+        self.assertFalse(self.r.exists(series_key('get_bandwidth', 1, 'p1/c1')))
+
+        # The ring buffer has a fixed size
+        for second in range(600, 1300):
+            writer.write(start + second, {'p1': 1.0})
+        self.assertEqual(self.r.strlen(series_key('get_bandwidth', 1, 'p1')), 600 * SLOT.size)
+        self.assertEqual(len(read_series(self.r, 'get_bandwidth', 1, 0)['p1']), 600)
+
+    def test_series_writer_sparse_target(self):
+        # The intervals without a value of a target count as zero in the
+        # coarse tiers, and the targets are read from the target set
+        writer = SeriesWriter(self.r, 'get_bandwidth', interval=2)
+        start = 1500000000
+        writer.write(start, {'p1': 8.0, 'p2': 1.0})
+        self.assertEqual(read_series(self.r, 'get_bandwidth', 10, 0)['p1'], [[start, 8.0]])
+        for second in range(2, 10, 2):
+            writer.write(start + second, {'p2': 1.0})
+        self.assertEqual(read_series(self.r, 'get_bandwidth', 10, 0), {'p1': [[start, 1.6]], 'p2': [[start, 1.0]]})
+        # The complete buckets are forgotten
+        writer.write(start + 10, {})
+        self.assertEqual(sorted(writer._buckets), [(60, 'p1'), (60, 'p2')])
+
+        self.assertEqual(self.r.zrange('series:get_bandwidth:targets', 0, -1), ['p1', 'p2'])
+        self.assertEqual(read_series(self.r, 'get_bandwidth', 1, start + 1).keys(), ['p2'])
+        self.assertEqual(read_series(self.r, 'get_bandwidth', 1, start + 20), {})
+
+    #
+    # Event time
+    #
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp('2017-09-09T18:00:18.331492+02:00'), 1504972818.331492)
+        self.assertEqual(parse_timestamp('2017-09-09T16:00:18Z'), 1504972818)
+        self.assertEqual(parse_timestamp('2017-09-09T16:00:18.5'), 1504972818.5)
+        self.assertEqual(parse_timestamp(1504972818.5), 1504972818.5)
+        self.assertIsNone(parse_timestamp('yesterday'))
+        self.assertIsNone(parse_timestamp(None))
+
+    def test_event_time_windows(self):
+        windows = EventTimeWindows(10, 5)
+        record = lambda timestamp: MetricRecord('bandwidth', timestamp, 1, 'p1', 'p1/c1', None, 'GET', 'proxy', None)
+        windows.add_records([record(101), record(116), record(109), record(None)], 117, weight=2.0)
+        self.assertEqual(windows.stats()['without_timestamp'], 1)
+        # The watermark (117 - 5) closes the window [100, 110)
+        closed = windows.advance(117)
+        self.assertEqual([(start, len(records), weight) for start, records, weight in closed], [(100, 2, 2.0)])
+        windows.add_records([record(105), record(118)], 119)
+        self.assertEqual(windows.stats()['late'], 1)
+        self.assertEqual(windows.advance(119), [])
+        # Without new records, the clock moves the watermark
+        closed = windows.advance(140)
+        self.assertEqual([(start, len(records)) for start, records, weight in closed], [(110, 3)])
+        self.assertEqual(windows.stats()['open_windows'], 0)
+
+    def test_event_time_windows_clock_skew(self):
+        windows = EventTimeWindows(10, 5)
+        record = lambda timestamp: MetricRecord('bandwidth', timestamp, 1, 'p1', 'p1/c1', None, 'GET', 'proxy', None)
+        # Timestamps an hour ahead go to the window of now + allowed lateness
+        windows.add_records([record(3700), record(3800), record(101)], 100)
+        self.assertEqual(windows.stats()['future'], 2)
+        self.assertEqual(windows.stats()['open_windows'], 1)
+        closed = windows.advance(125)
+        self.assertEqual([(start, len(records)) for start, records, weight in closed], [(100, 3)])
+        self.assertEqual(windows.stats()['open_windows'], 0)
+
+    #
+    # Delta notifications
+    #
+
+    def test_delta_filter(self):
+        delta = DeltaFilter(5, keyframe=4)
+        self.assertEqual(delta.filter({'p1': 100, 'p2': 50}), {'p1': 100, 'p2': 50})
+        self.assertEqual(delta.filter({'p1': 104, 'p2': 56}), {'p2': 56})
+        self.assertEqual(delta.filter({'p1': 106, 'p2': 56}), {'p1': 106})
+        self.assertEqual(delta.filter({'p1': 106, 'p3': {'value': 1}}), {'p3': {'value': 1}})
+        # Keyframe
+        self.assertEqual(delta.filter({'p1': 106, 'p2': 56}), {'p1': 106, 'p2': 56})
+
+    #
+    # Heavy hitters
+    #
+
+    def test_project_admission(self):
+        admission = ProjectAdmission(10, 2, {'vip': (100, 5)})
+        records = [MetricRecord(None, None, 1, project, project + '/c1', 'h1', None, 'proxy', None)
+                   for project in ['p1'] * 4 + ['vip'] * 4]
+        admitted = admission.admit(records, now=100.0)
+        self.assertEqual([record.project for record in admitted], ['p1', 'p1', 'vip', 'vip', 'vip', 'vip'])
+        # 0.15s refill 1.5 tokens of p1
+        self.assertEqual(len(admission.admit(records[:2], now=100.15)), 1)
+        self.assertEqual(admission.drain(), {'p1': [3, 3.0]})
+        self.assertEqual(admission.drain(), {})
+
+    def test_space_saving(self):
+        summary = SpaceSaving(3)
+        summary.update({'a': 10, 'b': 5, 'c': 1})
+        summary.update({'d': 2, 'a': 1})
+        # 'c' is evicted: unmonitored items weigh at most 1
+        self.assertEqual(summary.top(3), [('a', 11, 0), ('b', 5, 0), ('d', 2, 0)])
+        self.assertEqual(summary.floor, 1)
+        # 'e' may include up to 1 of unmonitored weight
+        summary.update({'e': 1})
+        self.assertIn(summary.counters.get('e'), (None, [2, 1]))
+        self.assertEqual(len(summary.counters), 3)
+        self.assertEqual(summary.floor, 2)
+
+        other = SpaceSaving(3)
+        other.update({'b': 20})
+        merged = summary.merge(other)
+        self.assertEqual(merged.top(1), [('b', 25, 0)])
+        self.assertEqual(len(merged.counters), 3)
+
+    #
+    # Shared-memory bus
+    #
+
+    def test_metric_bus(self):
+        path = os.path.join("/tmp", "crystal", "bus", "test.bus")
+        writer = MetricBusWriter(path, 4, 256)
+        reader = MetricBusReader(path)
+        self.assertEqual(reader.poll(), [])
+
+        writer.publish(1.0, {'p1': 1.5, u'p2/c\xe9': 2.0, None: 3.0})
+        self.assertEqual(reader.poll(), [(1, 1.0, {'p1': 1.5, 'p2/c\xc3\xa9': 2.0})])
+        self.assertEqual(reader.poll(), [])
+
+        # A slow reader loses the overwritten aggregates
+        for tick in range(2, 8):
+            writer.publish(float(tick), {'p1': tick})
+        aggregates = reader.poll(set(['p1']))
+        self.assertEqual([seq for seq, _, _ in aggregates], [4, 5, 6, 7])
+        self.assertEqual(reader.lost, 2)
+
+        # The targets that do not fit in a slot are returned
+        overflow = writer.publish(8.0, dict(('project_%d' % i, i) for i in range(100)))
+        aggregate = reader.poll()[0][2]
+        self.assertEqual(len(aggregate) + len(overflow), 100)
+        self.assertEqual(set(aggregate) & overflow, set())
+        self.assertEqual(writer.overflow, len(overflow))
+
+        # A new writer of the same file starts a new generation
+        writer = MetricBusWriter(path, 4, 256)
+        writer.publish(1.0, {'p1': 1.0})
+        self.assertEqual(reader.poll(), [(1, 1.0, {'p1': 1.0})])
+        writer.close()
+        self.assertFalse(os.path.exists(path))
+        reader.close()
+
+    @override_settings(METRIC_BUS_DIR=os.path.join("/tmp", "crystal", "bus"))
+    def test_metric_bus_alive(self):
+        self.assertFalse(bus_alive('get_bandwidth'))
+        writer = MetricBusWriter(bus_path('get_bandwidth'), 4, 256)
+        self.assertTrue(bus_alive('get_bandwidth'))
+        # The file of a writer that died is not used
+        with mock.patch('metrics.bus.os.kill', side_effect=OSError(errno.ESRCH, 'No such process')):
+            self.assertFalse(bus_alive('get_bandwidth'))
+        writer.close()
+        self.assertFalse(bus_alive('get_bandwidth'))
+
+    @override_settings(METRIC_BUS_DIR=os.path.join("/tmp", "crystal", "bus"))
+    def test_bus_subscription_fan_out(self):
+        writer = MetricBusWriter(bus_path('get_bandwidth'), 4, 256)
+        subscription = BusSubscription('get_bandwidth')
+        first, second, every = mock.MagicMock(), mock.MagicMock(), mock.MagicMock()
+        subscription.add(first, ['p1'])
+        key = subscription.add(second, [u'p2'])
+        subscription.poll()
+
+        writer.publish(1.0, {'p1': 1.0, 'p2': 2.0, 'p3': 3.0})
+        subscription.poll()
+        first.assert_called_once_with('get_bandwidth', 1.0, {'p1': 1.0})
+        second.assert_called_once_with('get_bandwidth', 1.0, {'p2': 2.0})
+
+        self.assertFalse(subscription.remove(key))
+        subscription.add(every)
+        writer.publish(2.0, {'p2': 2.0, 'p3': 3.0})
+        subscription.poll()
+        self.assertEqual(first.call_count, 1)
+        self.assertEqual(second.call_count, 1)
+        every.assert_called_once_with('get_bandwidth', 2.0, {'p2': 2.0, 'p3': 3.0})
+        subscription.reader.close()
+        writer.close()
+
+    @mock.patch('metrics.bus.BusSubscription.start')
+    def test_bus_subscriptions_are_shared(self, mock_start):
+        first = subscribe('get_bandwidth', mock.MagicMock(), ['p1'])
+        second = subscribe('get_bandwidth', mock.MagicMock(), ['p2'])
+        # One reader thread per metric
+        self.assertEqual(mock_start.call_count, 1)
+        with mock.patch('metrics.bus.BusSubscription.stop') as mock_stop:
+            unsubscribe('get_bandwidth', first)
+            self.assertFalse(mock_stop.called)
+            unsubscribe('get_bandwidth', second)
+            mock_stop.assert_called_once_with()
+        subscribe('get_bandwidth', mock.MagicMock())
+        self.assertEqual(mock_start.call_count, 2)
+        unsubscribe('get_bandwidth', 1)
+
+    #
+    # Buffers
+    #
+
+    def test_metric_buffer_drop_oldest(self):
+        buf = MetricBuffer(3, 'drop_oldest')
+        buf.extend(range(5))
+        self.assertEqual(buf.drain(), ([2, 3, 4], 1.0))
+        self.assertEqual(buf.stats()['dropped'], 2)
+        self.assertEqual(buf.stats()['received'], 5)
+        self.assertEqual(buf.drain(), ([], 1.0))
+
+    def test_metric_buffer_sample(self):
+        buf = MetricBuffer(10, 'sample')
+        buf.extend(range(100))
+        records, weight = buf.drain()
+        self.assertEqual(len(records), 10)
+        self.assertEqual(len(set(records)), 10)
+        self.assertEqual(weight, 10.0)
+        self.assertEqual(buf.stats()['sampled'], 90)
+
+        buf.extend(range(5))
+        self.assertEqual(buf.drain(), ([0, 1, 2, 3, 4], 1.0))
+
+    def test_metric_buffer_block(self):
+        buf = MetricBuffer(2, 'block', block_timeout=0.01)
+        buf.extend(range(3))
+        self.assertEqual(buf.drain(), ([0, 1], 1.0))
+        self.assertEqual(buf.stats()['blocked'], 1)
+        self.assertEqual(buf.stats()['dropped'], 1)
+        with self.assertRaises(ValueError):
+            MetricBuffer(2, 'unknown')
+
+    @mock.patch('metrics.buffers.time.time')
+    def test_metric_buffer_block_deadline(self, mock_time):
+        # One deadline for the whole call: the overflow after it is dropped
+        # without waiting again
+        mock_time.side_effect = itertools.chain([100, 100, 100], itertools.repeat(106))
+        buf = MetricBuffer(2, 'block', block_timeout=5)
+        with mock.patch.object(buf._condition, 'wait') as mock_wait:
+            buf.extend(range(6))
+        self.assertEqual(mock_wait.call_count, 1)
+        self.assertEqual(buf.stats()['blocked'], 4)
+        self.assertEqual(buf.stats()['dropped'], 4)
+
+    #
+    # Columnar batches
+    #
+
+    def test_metric_batch(self):
+        records = [decode('{"value": %s, "server_type": "proxy", "project": "%s", "container": "%s", "host": "proxy1", '
+                          '"@timestamp": "2017-09-09T18:00:18.%d+02:00"%s}' % (value, project, container, i, extra))
+                   for i, (value, project, container, extra) in enumerate([
+                       (1, 'p1', 'p1/c1', ', "storage_policy": "0"'),
+                       (2, 'p1', 'p1/c2', ', "storage_policy": "1"'),
+                       (4, 'p2', 'p2/c1', ''),
+                       ('"x"', 'p2', 'p2/c1', ', "storage_policy": "0"')])]
+        batch = MetricBatch.from_records(records)
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(batch[0], records[0].as_dict())
+        self.assertEqual(list(batch)[2], records[2].as_dict())
+        self.assertEqual(batch.column('project'), ['p1', 'p1', 'p2', 'p2'])
+        self.assertEqual(batch.column('storage_policy'), ['0', '1', None, '0'])
+        self.assertEqual(len(batch.strings), len(set(batch.strings)))
+
+        # Invalid values and absent keys are ignored
+        self.assertEqual(batch.group_sum('project'), {'p1': 3, 'p2': 4})
+        self.assertEqual(batch.group_sum('project', 'storage_policy'), {('p1', '0'): 1, ('p1', '1'): 2})
+        self.assertEqual(MetricBatch.from_records([]).group_sum('project'), {})
+
+        # The values keep their type
+        self.assertIsInstance(batch[0]['value'], int)
+        self.assertEqual(batch[3]['value'], 'x')
+
+        part = batch[1:3]
+        self.assertIsInstance(part, MetricBatch)
+        self.assertEqual(part.to_list(), batch.to_list()[1:3])
+        self.assertEqual(part.group_sum('project'), {'p1': 2, 'p2': 4})
+        self.assertEqual(len(batch[10:]), 0)
+
+        copy = cPickle.loads(cPickle.dumps(batch))
+        self.assertEqual(copy.to_list(), batch.to_list())
+
+    def test_metric_batch_group_sum_wide_keys(self):
+        # 94 distinct strings: the key of 10 fields does not fit in an int64
+        records = [decode(json.dumps(dict([('value', 1), ('server_type', 'proxy'), ('project', 'p%d' % (row % 2))] +
+                                          [('k%d' % key, 'v%d_%d' % (row, key)) for key in range(9)])))
+                   for row in range(10)]
+        batch = MetricBatch.from_records(records)
+        fields = ['project'] + ['k%d' % key for key in range(9)]
+        groups = batch.group_sum(*fields)
+        self.assertEqual(len(groups), 10)
+        self.assertEqual(groups[tuple(['p1'] + ['v1_%d' % key for key in range(9)])], 1)
+        self.assertEqual(batch.group_sum('project', 'k0'), dict((('p%d' % (row % 2), 'v%d_0' % row), 1) for row in range(10)))
+
+    #
+    # Sketches
+    #
+
+    def test_ddsketch_quantiles_and_merge(self):
+        first = DDSketch(0.01)
+        second = DDSketch(0.01)
+        for value in range(1, 1001):
+            (first if value % 2 else second).add(value)
+        first.merge(second)
+        self.assertEqual(first.count, 1000)
+        self.assertEqual(first.sum, 500500)
+        self.assertAlmostEqual(first.quantile(0.5), 500, delta=500 * 0.01 + 1)
+        self.assertAlmostEqual(first.quantile(0.99), 990, delta=990 * 0.01 + 1)
+        self.assertIsNone(DDSketch().quantile(0.5))
+
+    def test_ddsketch_memory_is_bounded(self):
+        sketch = DDSketch(0.01, max_bins=64)
+        for exponent in range(-200, 200):
+            sketch.add(10 ** (exponent / 10.0))
+        self.assertLessEqual(len(sketch.positive), 64)
+        self.assertEqual(sketch.count, 400)
+        self.assertAlmostEqual(sketch.quantile(0.99), 10 ** 19.5, delta=10 ** 19.5 * 0.02)
+
+    def test_build_sketches(self):
+        ids = numpy.array([0, 0, 1, 1, 1, 0])
+        values = numpy.array([1.5, -3.0, 0.0, 250.0, 7.0, 1.5])
+        sketches = build_sketches(ids, values, ['p1', 'p1/c1'], 0.01)
+        for target_id, target in enumerate(['p1', 'p1/c1']):
+            expected = DDSketch(0.01)
+            for value in values[ids == target_id]:
+                expected.add(value)
+            self.assertEqual(sketches[target].positive, expected.positive)
+            self.assertEqual(sketches[target].negative, expected.negative)
+            self.assertEqual(sketches[target].zero_count, expected.zero_count)
+            self.assertEqual(sketches[target].summary(), expected.summary())
+
+    #
+    # Sharded ingestion
+    #
+
+    @mock.patch('metrics.sharding.get_logstash_exporter')
+    def test_ingestion_shard_and_merge(self, mock_get_logstash_exporter):
+        first, second = IngestionShard(0, 0.01), IngestionShard(1, 0.01)
+        first.add('{"value": 1, "server_type": "proxy", "project": "p1", "container": "p1/c1"}')
+        first.add('{"value": 5, "server_type": "object", "project": "p1", "container": "p1/c1"}')
+        first.add('invalid')
+        second.add('{"value": 2, "server_type": "proxy", "project": "p1", "container": "p1/c2"}')
+        self.assertEqual(mock_get_logstash_exporter.return_value.export.call_count, 3)
+
+        partials = [first.flush(101, with_records=True), second.flush(101)]
+        self.assertEqual(len(partials[0].records), 1)
+        self.assertIsNone(partials[1].records)
+        sums, sketches, records = dict(), dict(), list()
+        merge_partials(partials, sums, sketches, records)
+        self.assertEqual(sums, {'p1': 3, 'p1/c1': 1, 'p1/c2': 2})
+        self.assertEqual(sketches['p1'].count, 2)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(first.flush(102).sums, {})
+
+    @override_settings(CONSUMER_BATCH_SIZE=10)
+    @mock.patch('metrics.sharding.get_logstash_exporter')
+    @mock.patch('metrics.sharding.time.time')
+    @mock.patch('metrics.sharding.pika.BlockingConnection')
+    def test_ingestion_worker(self, mock_connection, mock_time, mock_get_logstash_exporter):
+        channel = mock_connection.return_value.channel.return_value
+        body = '{"value": 2, "server_type": "proxy", "project": "p1", "container": "p1/c1"}'
+        properties = mock.Mock(content_type=None)
+        channel.consume.return_value = [(mock.Mock(delivery_tag=1), properties, body),
+                                        (mock.Mock(delivery_tag=2), properties, body),
+                                        (None, None, None)]
+        mock_time.side_effect = [100.5, 100.6, 101.2, 101.3]
+        results = mock.Mock()
+        control = mock.Mock(with_records=False, stopped=False)
+        _ingestion_worker(0, 1, 'get_bandwidth', 'metric.get_bandwidth', 1, None, results, control)
+
+        partial = results.send.call_args[0][0]
+        self.assertEqual((partial.tick, partial.sums), (101, {'p1': 4, 'p1/c1': 4}))
+        self.assertEqual(results.send.call_count, 1)
+        channel.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+        mock_connection.return_value.close.assert_called_once_with()
+
+    def test_worker_control(self):
+        read_fd, write_fd = os.pipe()
+        control = WorkerControl(read_fd)
+        control.poll()
+        self.assertEqual((control.with_records, control.stopped), (False, False))
+        os.write(write_fd, '0\n1\n')
+        control.poll()
+        self.assertTrue(control.with_records)
+        os.write(write_fd, '0')
+        control.poll()
+        self.assertTrue(control.with_records)
+        os.write(write_fd, '\n')
+        os.close(write_fd)
+        control.poll()
+        self.assertEqual((control.with_records, control.stopped), (False, True))
+        os.close(read_fd)
+
+    def _wait_pending(self, ingestion, partials):
+        deadline = time.time() + 2
+        while sum(len(pending) for pending in ingestion.pending.values()) < partials and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_sharded_ingestion_collect_by_tick(self):
+        ingestion = ShardedIngestion('get_bandwidth', 'metric.get_bandwidth', 2, 1)
+        pipes = [multiprocessing.Pipe(duplex=False) for _ in range(2)]
+        ingestion.processes = [(mock.Mock(), reader) for reader, _ in pipes]
+        first, second = [writer for _, writer in pipes]
+        ingestion._start_reader()
+
+        # The partials of an interval are merged at the next tick, without waiting for them
+        first.send(PartialAggregate(0, 101, {'p1': 1}, None, None, None, None))
+        second.send(PartialAggregate(1, 101, {'p1': 2}, None, None, None, None))
+        self._wait_pending(ingestion, 2)
+        self.assertEqual(ingestion.collect(101), [])
+        self.assertEqual([partial.sums for partial in ingestion.collect(102)], [{'p1': 1}, {'p1': 2}])
+
+        # A worker is late: its partial of tick 102 is not merged into tick 104
+        first.send(PartialAggregate(0, 102, {'p1': 3}, None, None, None, None))
+        self._wait_pending(ingestion, 1)
+        self.assertEqual([partial.sums for partial in ingestion.collect(103)], [{'p1': 3}])
+        second.send(PartialAggregate(1, 102, {'p1': 4}, None, None, None, None))
+        first.send(PartialAggregate(0, 103, {'p1': 5}, None, None, None, None))
+        second.send(PartialAggregate(1, 104, {'p1': 6}, None, None, None, None))
+        self._wait_pending(ingestion, 3)
+        self.assertEqual([partial.sums for partial in ingestion.collect(104)], [{'p1': 5}])
+        self.assertEqual(ingestion.late_partials, 1)
+        self.assertEqual([partial.sums for partial in ingestion.collect(105)], [{'p1': 6}])
+        self.assertEqual(ingestion.stats(), {'workers': 2, 'late_partials': 1})
+
+        # The reader ends with the connections of the workers
+        first.close()
+        second.close()
+        ingestion.reader.join(2)
+        self.assertFalse(ingestion.reader.is_alive())
+
+    @override_settings(METRIC_PROJECT_RATE=2, METRIC_PROJECT_BURST=4,
+                       METRIC_BUFFERS={'get_bandwidth': {'size': 10, 'policy': 'sample'}})
+    @mock.patch('metrics.sharding.get_logstash_exporter')
+    def test_ingestion_shard_policies(self, mock_get_logstash_exporter):
+        buf, admission = shard_policies('get_bandwidth', 2)
+        self.assertEqual((buf.capacity, buf.policy), (5, 'sample'))
+        self.assertEqual((admission.rate, admission.burst), (1, 2))
+        shard = IngestionShard(0, None, buf, admission)
+        for _ in range(12):
+            shard.add('{"value": 1, "server_type": "proxy", "project": "p1", "container": "p1/c1"}')
+        # 2 records are admitted by the burst of the worker, the rest are folded
+        partial = shard.flush(101)
+        self.assertEqual(partial.sums, {'p1': 2, 'p1/c1': 2})
+        self.assertEqual(partial.folded, {'p1': [10, 10.0]})
+        sums, folded = dict(), {'p1': [1, 1.0]}
+        merge_partials([partial], sums, dict(), list(), folded=folded)
+        self.assertEqual(folded, {'p1': [11, 11.0]})
+
+        # The sampled records are scaled to the received volume
+        shard = IngestionShard(0, None, shard_policies('get_bandwidth', 2)[0])
+        for _ in range(20):
+            shard.add('{"value": 1, "server_type": "proxy", "project": "p1", "container": "p1/c1"}')
+        self.assertEqual(shard.flush(102).sums, {'p1': 20, 'p1/c1': 20})
+
+    @override_settings(METRIC_INGESTION_WORKERS=2, METRIC_BUFFER_POLICY='block')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_sharded_ingestion_rejects_block_buffers(self, mock_get_scheduler):
+        with self.assertRaises(ImproperlyConfigured):
+            SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        with override_settings(METRIC_BUFFERS={'get_bandwidth': {'policy': 'sample'}}):
+            SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+
+    @mock.patch('metrics.sharding.subprocess.Popen')
+    def test_sharded_ingestion_spawns_workers(self, mock_popen):
+        read_fd, write_fd = os.pipe()
+        mock_popen.return_value.stdout = os.fdopen(read_fd)
+        mock_popen.return_value.poll.return_value = 0
+        ingestion = ShardedIngestion('get_bandwidth', 'metric.get_bandwidth', 1, 1)
+        ingestion.start()
+        command = mock_popen.call_args[0][0]
+        self.assertEqual(command[1:3], ['-m', 'metrics.sharding'])
+        self.assertEqual(json.loads(command[3]), [0, 1, 'get_bandwidth', 'metric.get_bandwidth', 1, None])
+        self.assertTrue(mock_popen.call_args[1]['close_fds'])
+
+        ingestion.ship_records(True)
+        ingestion.ship_records(True)
+        mock_popen.return_value.stdin.write.assert_called_once_with('1\n')
+        ingestion.stop()
+        mock_popen.return_value.stdin.close.assert_called_once_with()
+        self.assertEqual(ingestion.processes, [])
+        os.close(write_fd)
+
+    #
+    # Datagram ingestion
+    #
+
+    def test_parse_datagram(self):
+        data = 'metric.get_bandwidth\n{"value": 1, "server_type": "proxy", "project": "p1"}\ninvalid\n' \
+               '{"value": 2, "server_type": "object"}\n'
+        routing_key, records, invalid = parse_datagram(data)
+        self.assertEqual(routing_key, 'metric.get_bandwidth')
+        self.assertEqual([record.value for record in records], [1, 2])
+        self.assertEqual(invalid, 1)
+        self.assertEqual(parse_datagram('metric.get_bandwidth'), ('metric.get_bandwidth', [], 0))
+
+        # The lines of a well-formed datagram are decoded at once
+        data = 'metric.get_bandwidth\n' + '\n'.join(['{"value": %d, "server_type": "proxy", "project": "p1"}' % i
+                                                     for i in range(3)])
+        with mock.patch('metrics.ingestion.decode_batch', wraps=decode_batch) as mock_decode_batch:
+            routing_key, records, invalid = parse_datagram(data)
+        self.assertEqual(mock_decode_batch.call_count, 1)
+        self.assertEqual(([record.value for record in records], invalid), ([0, 1, 2], 0))
+
+    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    def test_datagram_ingestion_server(self, mock_get_scheduler, mock_send_data_to_logstash):
+        swift_metric = SwiftMetric('get_bandwidth', 'metric.get_bandwidth')
+        received = Queue.Queue()
+
+        def handler(records):
+            swift_metric._ingest_records(records)
+            received.put(len(records))
+
+        address = 'unix://' + os.path.join("/tmp", "crystal", "metrics.sock")
+        if not os.path.exists(os.path.join("/tmp", "crystal")):
+            os.makedirs(os.path.join("/tmp", "crystal"))
+        server = DatagramIngestionServer(address)
+        server.register('metric.get_bandwidth', handler)
+        sender = DatagramSender(address)
+        sender.send('metric.put_bandwidth', [{'value': 1, 'server_type': 'proxy'}])
+        sender.send('metric.get_bandwidth', [{'value': 1, 'server_type': 'proxy', 'project': 'p1'},
+                                             {'value': 2, 'server_type': 'proxy', 'project': 'p1'},
+                                             {'value': 3, 'server_type': 'object', 'project': 'p1'}])
+        self.assertEqual(received.get(timeout=5), 3)
+        sender.close()
+
+        metric_list, _ = swift_metric._drain_metrics()
+        self.assertEqual([metric.value for metric in metric_list], [1, 2])
+        self.assertEqual(mock_send_data_to_logstash.call_count, 3)
+        self.assertEqual(server.stats(), {'datagrams': 2, 'records': 3, 'invalid': 0, 'unroutable': 1})
+
+    #
+    # Scheduler
+    #
+
+    def test_next_tick_is_aligned(self):
+        self.assertEqual(next_tick(100.2, 1), 101)
+        self.assertEqual(next_tick(101, 1), 102)
+        self.assertEqual(next_tick(103.7, 5), 105)
+
+    @mock.patch('metrics.scheduler.Thread')
+    @mock.patch('metrics.scheduler.time.time')
+    def test_tick_scheduler(self, mock_time, mock_thread):
+        mock_time.return_value = 100.5
+        scheduler = TickScheduler()
+        fast, slow = mock.Mock(), mock.Mock()
+        scheduler.register('get_bandwidth', fast, 1)
+        scheduler.register('put_bandwidth', slow, 5)
+        mock_thread.return_value.start.assert_called_once_with()
+        self.assertEqual(scheduler.registered(), {'get_bandwidth': 1, 'put_bandwidth': 5})
+
+        self.assertEqual(scheduler._due_tasks(100.9), [])
+        self.assertEqual(scheduler._due_tasks(101.01), [(101, 'get_bandwidth', fast)])
+        # Missed ticks are skipped, and tasks due at the same time share the tick
+        self.assertEqual(scheduler._due_tasks(105.2), [(102, 'get_bandwidth', fast), (105, 'put_bandwidth', slow)])
+        self.assertEqual(scheduler._due_tasks(106), [(106, 'get_bandwidth', fast)])
+
+        scheduler.unregister('get_bandwidth')
+        scheduler.unregister('unknown')
+        self.assertEqual(scheduler.registered(), {'put_bandwidth': 5})
+        self.assertEqual(scheduler._due_tasks(110), [(110, 'put_bandwidth', slow)])
+
+    #
+    # Exporters
+    #
+
+    def test_udp_logstash_exporter_batches(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        exporter = UDPLogstashExporter('127.0.0.1', server.getsockname()[1], 10, 3, 60)
+
+        body = '{"container": "crystal/data", "metric_name": "bandwidth", "@timestamp": "2017-09-09T18:00:18.331492+02:00", ' \
+               '"value": 16.4375, "project": "crystal", "host": "controller", "method": "GET", "server_type": "proxy"}'
+        for _ in range(3):
+            exporter.export(decode(body))
+
+        lines = server.recv(65535).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0]), json.loads(body))
+        self.assertEqual(exporter.stats()['dropped'], 0)
+
+        # The records queued when the exporter is stopped are sent
+        exporter.export(decode(body))
+        exporter.stop()
+        self.assertFalse(exporter.flusher.is_alive())
+        self.assertEqual(len(server.recv(65535).splitlines()), 1)
+        self.assertEqual(exporter.stats()['sent'], 4)
+        server.close()
+
+    @mock.patch('metrics.exporters.UDPLogstashExporter._send')
+    @mock.patch('metrics.exporters.time.time')
+    @mock.patch('metrics.exporters.Thread')
+    def test_logstash_exporter_flush_interval(self, mock_thread, mock_time, mock_send):
+        mock_time.side_effect = itertools.count(100, 0.04).next
+        exporter = UDPLogstashExporter('127.0.0.1', 5400, 100, 100, 0.1)
+        for _ in range(10):
+            exporter.export(decode('{"value": 1, "server_type": "proxy", "project": "p1"}'))
+        # The queue is never empty while the flusher runs, but a batch is never full
+        exporter._stopping = mock.Mock()
+        exporter._stopping.is_set.side_effect = exporter.queue.empty
+        exporter._flush_loop()
+
+        batches = [len(call[0][0]) for call in mock_send.call_args_list]
+        self.assertGreater(len(batches), 2)
+        self.assertEqual(sum(batches), 10)
+
+    @override_settings(LOGSTASH_PROTOCOL='udp', LOGSTASH_HOST='127.0.0.1', LOGSTASH_PORT=5400)
+    def test_release_logstash_exporter(self):
+        exporter = get_logstash_exporter()
+        self.assertIs(get_logstash_exporter(), exporter)
+        release_logstash_exporter(exporter)
+        self.assertTrue(exporter.flusher.is_alive())
+        release_logstash_exporter(exporter)
+        self.assertFalse(exporter.flusher.is_alive())
+        self.assertIsNot(get_logstash_exporter(), exporter)
+
+    @mock.patch('metrics.exporters.Thread')
+    def test_logstash_exporter_drops_when_full(self, mock_thread):
+        exporter = UDPLogstashExporter('127.0.0.1', 5400, 2, 10, 1)
+        for _ in range(5):
+            exporter.export(decode('{"value": 1, "server_type": "proxy"}'))
+        self.assertEqual(exporter.stats(), {'sent': 0, 'dropped': 3, 'queued': 2})
+        exporter.stop()
 
     #
     # Aux methods
@@ -0,0 +1,66 @@
+import heapq
+
+DEFAULT_CAPACITY = 1000  # counters per summary
+
+
+class SpaceSaving(object):
+    """
+    Weighted Space-Saving summary of the heaviest items (heavy hitters) of a
+    stream. At most *capacity* counters are kept, so memory is constant. The
+    count of a monitored item overestimates its true weight by at most its
+    error, and no unmonitored item weighs more than *floor*. Summaries are
+    mergeable.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.counters = dict()  # {item: [count, error]}
+        self.floor = 0.0
+
+    def update(self, weights):
+        """
+        Adds the weights of a batch of items (e.g. an aggregation interval).
+
+        :param weights: The {item: weight} of the batch.
+        :type weights: dict
+        """
+        counters = self.counters
+        floor = self.floor
+        for item, weight in weights.iteritems():
+            counter = counters.get(item)
+            if counter is None:
+                counters[item] = [floor + weight, floor]
+            else:
+                counter[0] += weight
+        if len(counters) > self.capacity:
+            self._truncate()
+
+    def _truncate(self):
+        items = sorted(self.counters.iteritems(), key=lambda item: item[1][0], reverse=True)
+        evicted = items[self.capacity:]
+        self.floor = max(self.floor, evicted[0][1][0])
+        self.counters = dict(items[:self.capacity])
+
+    def merge(self, other):
+        """
+        Returns a new summary with the items of both summaries.
+        """
+        merged = SpaceSaving(max(self.capacity, other.capacity))
+        for item in set(self.counters) | set(other.counters):
+            first = self.counters.get(item, (self.floor, self.floor))
+            second = other.counters.get(item, (other.floor, other.floor))
+            merged.counters[item] = [first[0] + second[0], first[1] + second[1]]
+        merged.floor = self.floor + other.floor
+        if len(merged.counters) > merged.capacity:
+            merged._truncate()
+        return merged
+
+    def top(self, k):
+        """
+        Returns the k heaviest items.
+
+        :return: A list of (item, count, error), heaviest first.
+        :rtype: list
+        """
+        items = heapq.nlargest(k, self.counters.iteritems(), key=lambda item: item[1][0])
+        return [(item, counter[0], counter[1]) for item, counter in items]
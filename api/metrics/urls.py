@@ -9,6 +9,10 @@ urlpatterns = [
     url(r'^$', views.metric_module_list),
     url(r'^data/?$', views.MetricModuleData.as_view()),
     url(r'^(?P<metric_module_id>\w+)/data/?$', views.MetricModuleData.as_view()),
+    url(r'^(?P<metric_id>\w+)/quantiles/?$', views.metric_quantiles),
+    url(r'^(?P<metric_id>\w+)/stats/?$', views.metric_stats),
+    url(r'^(?P<metric_id>\w+)/series/?$', views.metric_series),
+    url(r'^(?P<metric_id>\w+)/top/?$', views.metric_top),
     url(r'^(?P<metric_module_id>\w+)/?$', views.metric_module_detail),
 
 ]
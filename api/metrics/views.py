@@ -13,11 +13,13 @@ import json
 import logging
 import mimetypes
 import os
+import time
 
 from api.common import to_json_bools, JSONResponse, get_redis_connection, \
-    rsync_dir_with_nodes, create_local_host, metric_actors, make_sure_path_exists, save_file
+    rsync_dir_with_nodes, create_local_host, metric_actors, make_sure_path_exists, save_file, bump_dsl_generation
 
 from api.exceptions import FileSynchronizationException
+from metrics.series import choose_resolution, read_series, TIERS
 
 
 logger = logging.getLogger(__name__)
@@ -85,6 +87,8 @@ def start_metric(actor_id):
             metric_actors[actor_id] = host.spawn(actor_id, settings.METRIC_MODULE,
                                                  actor_id, "metric." + actor_id)
             metric_actors[actor_id].init_consum()
+            # The actor registered the metric (metric:<actor_id>)
+            bump_dsl_generation()
     except Exception as e:
         logger.error("Metric, Error starting workload metric actor: " + str(actor_id))
         raise e
@@ -96,6 +100,7 @@ def stop_metric(actor_id):
         try:
             metric_actors[actor_id].stop_actor()
             del metric_actors[actor_id]
+            bump_dsl_generation()
         except Exception as e:
             logger.error("Metric, Error stopping workload metric actor: " + str(actor_id))
             raise e
@@ -189,6 +194,128 @@ def metric_module_detail(request, metric_module_id):
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
+@csrf_exempt
+def metric_quantiles(request, metric_id):
+    """
+    Get the streaming statistics (count, rate, sum, p50, p95 and p99) of each
+    target of a running workload metric actor.
+
+    :param request: The http request.
+    :type request: HttpRequest
+    :param metric_id: The id of the workload metric actor, e.g. get_bandwidth
+    :type metric_id: str
+    :return: A JSON dictionary with the statistics of each target.
+    :rtype: JSONResponse
+    """
+    if request.method == 'GET':
+        if metric_id not in metric_actors:
+            return JSONResponse('Metric ' + str(metric_id) + ' is not running.', status=status.HTTP_404_NOT_FOUND)
+        try:
+            quantiles = metric_actors[metric_id].get_quantiles()
+        except Exception as e:
+            logger.error("Metric, Error getting the quantiles of the metric: " + str(metric_id) + ": " + str(e))
+            return JSONResponse('Error getting the quantiles of the metric', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return JSONResponse(quantiles, status=status.HTTP_200_OK)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@csrf_exempt
+def metric_stats(request, metric_id):
+    """
+    Get the load-shedding counters (received, dropped, sampled and blocked
+    metrics) of a running workload metric actor.
+
+    :param request: The http request.
+    :type request: HttpRequest
+    :param metric_id: The id of the workload metric actor, e.g. get_bandwidth
+    :type metric_id: str
+    :return: A JSON dictionary with the counters.
+    :rtype: JSONResponse
+    """
+    if request.method == 'GET':
+        if metric_id not in metric_actors:
+            return JSONResponse('Metric ' + str(metric_id) + ' is not running.', status=status.HTTP_404_NOT_FOUND)
+        try:
+            stats = metric_actors[metric_id].get_stats()
+        except Exception as e:
+            logger.error("Metric, Error getting the stats of the metric: " + str(metric_id) + ": " + str(e))
+            return JSONResponse('Error getting the stats of the metric', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return JSONResponse(stats, status=status.HTTP_200_OK)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@csrf_exempt
+def metric_series(request, metric_id):
+    """
+    Get the recent aggregates of a workload metric. Query parameters:
+    target (can be repeated, all the targets by default), minutes (10 by
+    default) and resolution (1, 10 or 60 seconds, the finest one that covers
+    the period by default).
+
+    :param request: The http request.
+    :type request: HttpRequest
+    :param metric_id: The id of the workload metric actor, e.g. get_bandwidth
+    :type metric_id: str
+    :return: A JSON dictionary with a list of [timestamp, value] per target.
+    :rtype: JSONResponse
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method == 'GET':
+        try:
+            minutes = float(request.GET.get('minutes', 10))
+            seconds = minutes * 60
+            resolution = int(request.GET.get('resolution', choose_resolution(seconds)))
+        except ValueError:
+            return JSONResponse('Invalid minutes or resolution', status=status.HTTP_400_BAD_REQUEST)
+        if resolution not in [tier[0] for tier in TIERS]:
+            return JSONResponse('Invalid resolution', status=status.HTTP_400_BAD_REQUEST)
+
+        targets = request.GET.getlist('target') or None
+        series = read_series(r, metric_id, resolution, time.time() - seconds, targets)
+        return JSONResponse(series, status=status.HTTP_200_OK)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@csrf_exempt
+def metric_top(request, metric_id):
+    """
+    Get the projects, containers and hosts with the highest values (heavy
+    hitters) of a running workload metric actor. Query parameter: k (20 by
+    default).
+
+    :param request: The http request.
+    :type request: HttpRequest
+    :param metric_id: The id of the workload metric actor, e.g. get_bandwidth
+    :type metric_id: str
+    :return: A JSON dictionary with the top-k list of each dimension.
+    :rtype: JSONResponse
+    """
+    if request.method == 'GET':
+        if metric_id not in metric_actors:
+            return JSONResponse('Metric ' + str(metric_id) + ' is not running.', status=status.HTTP_404_NOT_FOUND)
+        try:
+            k = int(request.GET.get('k', 20))
+        except ValueError:
+            return JSONResponse('Invalid k', status=status.HTTP_400_BAD_REQUEST)
+        if k <= 0:
+            return JSONResponse('Invalid k', status=status.HTTP_400_BAD_REQUEST)
+        try:
+            top = metric_actors[metric_id].get_top(k)
+        except Exception as e:
+            logger.error("Metric, Error getting the top targets of the metric: " + str(metric_id) + ": " + str(e))
+            return JSONResponse('Error getting the top targets of the metric', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return JSONResponse(top, status=status.HTTP_200_OK)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
 class MetricModuleData(APIView):
     """
     Upload or download a metric module data.
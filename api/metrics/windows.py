@@ -0,0 +1,139 @@
+import calendar
+import re
+import time
+
+# Parsed timestamps (without the fraction of second) are cached: the messages
+# of the same second share the same prefix
+MAX_CACHED_TIMESTAMPS = 10000
+_timestamps = dict()
+_FRACTION = re.compile(r'\.\d+')
+
+
+def parse_timestamp(value):
+    """
+    Returns the epoch seconds of an ISO 8601 timestamp, as published by the
+    metric middleware (e.g. 2017-09-09T18:00:18.331492+02:00), or None if it
+    is not valid. Numeric timestamps are returned as they are.
+    """
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    try:
+        base = value[:19]
+        rest = value[19:]
+        fraction = 0.0
+        match = _FRACTION.match(rest)
+        if match:
+            fraction = float(match.group())
+            rest = rest[match.end():]
+
+        key = base + rest
+        seconds = _timestamps.get(key)
+        if seconds is None:
+            seconds = calendar.timegm(time.strptime(base, '%Y-%m-%dT%H:%M:%S'))
+            if rest and rest != 'Z':
+                sign = 1 if rest[0] == '+' else -1
+                offset = rest[1:].replace(':', '')
+                seconds -= sign * (int(offset[:2]) * 3600 + int(offset[2:4]) * 60)
+            if len(_timestamps) >= MAX_CACHED_TIMESTAMPS:
+                _timestamps.clear()
+            _timestamps[key] = seconds
+        return seconds + fraction
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class EventTimeWindows(object):
+    """
+    Groups metric records in tumbling windows by their @timestamp (event
+    time) instead of their arrival time. The watermark is the latest event
+    time seen minus the allowed lateness: a window is closed when the
+    watermark passes its end, and records for closed windows are counted as
+    late and discarded. If no records arrive, the watermark follows the clock
+    so the open windows are eventually closed. Timestamps more than the
+    allowed lateness ahead of the clock (clock skew) are clamped to that
+    bound, so they do not open windows that stay in memory until the clock
+    catches up; they are counted as future records.
+    """
+
+    def __init__(self, length, allowed_lateness):
+        self.length = length
+        self.allowed_lateness = allowed_lateness
+        self._windows = dict()  # {window start: [records, weight]}
+        self.max_event_time = None
+        self.watermark = None
+
+        self.on_time = 0
+        self.late = 0
+        self.future = 0
+        self.without_timestamp = 0
+
+    def add_records(self, records, now, weight=1.0):
+        """
+        Assigns the records to their windows.
+
+        :param records: The metric records.
+        :type records: list of metrics.decoder.MetricRecord
+        :param now: The arrival (processing) time, used for the records
+                    without a valid timestamp.
+        :type now: float
+        :param weight: The number of received records each record represents.
+        :type weight: float
+        """
+        length = self.length
+        windows = self._windows
+        watermark = self.watermark
+        max_event_time = self.max_event_time
+        # Timestamps ahead of the clock are clamped to this bound
+        max_allowed = now + self.allowed_lateness
+        for record in records:
+            event_time = parse_timestamp(record.timestamp)
+            if event_time is None:
+                self.without_timestamp += 1
+                event_time = now
+            elif event_time > max_allowed:
+                self.future += 1
+                event_time = max_allowed
+            start = event_time - event_time % length
+            if watermark is not None and start + length <= watermark:
+                self.late += 1
+                continue
+            self.on_time += 1
+            window = windows.get(start)
+            if window is None:
+                window = windows[start] = [list(), 0.0]
+            window[0].append(record)
+            window[1] += weight
+            if max_event_time is None or event_time > max_event_time:
+                max_event_time = event_time
+        self.max_event_time = max_event_time
+
+    def advance(self, now):
+        """
+        Advances the watermark and returns the closed windows.
+
+        :return: The (window start, records, weight) of the closed windows, in
+                 time order. The weight of each record is the number of
+                 received records it represents.
+        :rtype: list
+        """
+        watermark = now - self.length - self.allowed_lateness
+        if self.max_event_time is not None:
+            watermark = max(watermark, self.max_event_time - self.allowed_lateness)
+        if self.watermark is not None:
+            watermark = max(watermark, self.watermark)
+        self.watermark = watermark
+
+        closed = list()
+        for start in sorted(self._windows):
+            if start + self.length > watermark:
+                break
+            records, weight = self._windows.pop(start)
+            closed.append((start, records, weight / len(records)))
+        return closed
+
+    def stats(self):
+        """
+        Returns the window counters.
+        """
+        return {'open_windows': len(self._windows), 'watermark': self.watermark, 'on_time': self.on_time,
+                'late': self.late, 'future': self.future, 'without_timestamp': self.without_timestamp}
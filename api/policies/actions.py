@@ -0,0 +1,138 @@
+"""
+Actions of the dynamic policies: the deployment of the filter of a policy
+(SET), its undeployment (DELETE) and the deletion of the static policy
+created by a transient policy.
+
+With RULE_ACTION_MODE = 'local', the actions call the deployment code of the
+filters API (filters.views.deploy_filter and unset_filter) in this process.
+With 'http', they go through the API of the controller, for rules running
+in a host without access to its database.
+"""
+from django.conf import settings
+from swiftclient import client as c
+from threading import Lock
+from api.common import get_redis_connection
+from api.exceptions import SwiftClientError, StorletNotFoundException
+from filters.views import deploy_filter as deploy_filter_data, unset_filter
+import json
+import logging
+import os
+import requests
+import time
+
+logger = logging.getLogger(__name__)
+
+ADMIN_TOKEN_TTL = 3000  # seconds, below the default lifetime of Keystone tokens
+
+# Admin token shared by the rules of this process: [token, expiration]
+_admin_token = [None, 0]
+_admin_token_lock = Lock()
+
+
+def get_admin_token():
+    """
+    Returns a token of the management account, which is needed to deploy
+    filters in the projects. It is requested once per ADMIN_TOKEN_TTL.
+    """
+    with _admin_token_lock:
+        if _admin_token[0] is None or _admin_token[1] < time.time():
+            try:
+                _, token = c.get_auth(settings.KEYSTONE_ADMIN_URL,
+                                      settings.MANAGEMENT_ACCOUNT + ":" + settings.MANAGEMENT_ADMIN_USERNAME,
+                                      settings.MANAGEMENT_ADMIN_PASSWORD, auth_version="3")
+            except:
+                logger.error("Rule, There was an error gettting a token from keystone")
+                raise Exception()
+            _admin_token[:] = [token, time.time() + ADMIN_TOKEN_TTL]
+        return _admin_token[0]
+
+
+def delete_static_policy(r, target, policy_id):
+    """
+    Deletes a static policy from the pipeline of its target.
+
+    :param target: The target, as in the pipeline keys (project or
+                   project:container).
+    :type target: str
+    """
+    r.hdel('pipeline:' + target, policy_id)
+
+    policies_ids = r.keys('policy:*')
+    pipelines_ids = r.keys('pipeline:*')
+    if len(policies_ids) == 0 and len(pipelines_ids) == 0:
+        r.set('policies:id', 0)
+
+
+def deploy_filter(controller_server, target_id, filter_name, data):
+    """
+    Deploys a filter to the target of a policy.
+
+    :param controller_server: The host of the controller API (http mode).
+    :type controller_server: str
+    :param target_id: project or project/container
+    :type target_id: str
+    :param filter_name: The DSL name of the filter.
+    :type filter_name: str
+    :param data: object_type, object_size, object_tag and params.
+    :type data: dict
+    :return: The id of the static policy created, or None if the filter
+             could not be deployed.
+    """
+    if settings.RULE_ACTION_MODE == 'http':
+        url = os.path.join('http://' + controller_server, 'filters', target_id, "deploy", str(filter_name))
+        response = requests.put(url, json.dumps(data), headers={"X-Auth-Token": get_admin_token()})
+        if 200 <= response.status_code < 300:
+            return response.content
+        return None
+
+    r = get_redis_connection()
+    filter_data = r.hgetall("filter:" + str(filter_name))
+    if not filter_data:
+        logger.error("Rule, Filter " + str(filter_name) + " does not exist")
+        return None
+    project_id, _, container = target_id.partition('/')
+    # Only the storlets are uploaded to Swift
+    token = get_admin_token() if filter_data['filter_type'] == 'storlet' else None
+    try:
+        return deploy_filter_data(r, filter_data, project_id, container or None, None, data, token)
+    except (SwiftClientError, StorletNotFoundException) as e:
+        logger.error("Rule, Error deploying filter " + str(filter_name) + " to " + target_id + ": " + str(e))
+        return None
+
+
+def undeploy_filter(controller_server, target_id, filter_name):
+    """
+    Undeploys a filter from the target of a policy.
+
+    :return: True if the filter was undeployed.
+    :rtype: boolean
+    """
+    if settings.RULE_ACTION_MODE == 'http':
+        url = os.path.join('http://' + controller_server, 'filters', target_id, "undeploy", str(filter_name))
+        response = requests.put(url, headers={"X-Auth-Token": get_admin_token()})
+        return 200 <= response.status_code < 300
+
+    r = get_redis_connection()
+    filter_data = r.hgetall("filter:" + str(filter_name))
+    if not filter_data:
+        logger.error("Rule, Filter " + str(filter_name) + " does not exist")
+        return False
+    token = get_admin_token() if filter_data['filter_type'] == 'storlet' else None
+    # unset_filter only returns the Swift status if the storlet can not be deleted
+    return unset_filter(r, target_id, filter_data, token) is None
+
+
+def undeploy_static_policy(controller_server, target_id, static_policy_id):
+    """
+    Deletes the static policy created by deploy_filter().
+
+    :return: True if the policy was deleted.
+    :rtype: boolean
+    """
+    if settings.RULE_ACTION_MODE == 'http':
+        url = os.path.join('http://' + controller_server, "policies/static", target_id + ":" + str(static_policy_id))
+        response = requests.delete(url, headers={"X-Auth-Token": get_admin_token()})
+        return 200 <= response.status_code < 300
+
+    delete_static_policy(get_redis_connection(), target_id.replace('/', ':'), str(static_policy_id))
+    return True
@@ -1,18 +1,12 @@
-from swiftclient import client as c
-import json
-import operator
 import logging
 import redis
-import requests
-import os
+from metrics import bus
+from policies import actions
+from policies.conditions import compile_condition
 from policies.dsl_parser import parse_condition
 
-from api.settings import MANAGEMENT_ACCOUNT, MANAGEMENT_ADMIN_USERNAME, \
-    MANAGEMENT_ADMIN_PASSWORD, KEYSTONE_ADMIN_URL, REDIS_HOST, REDIS_PORT, REDIS_DATABASE
+from api.settings import REDIS_HOST, REDIS_PORT, REDIS_DATABASE, RULE_METRIC_EPSILON, RULE_METRIC_BUS
 
-mappings = {'>': operator.gt, '>=': operator.ge,
-            '==': operator.eq, '<=': operator.le, '<': operator.lt,
-            '!=': operator.ne, "OR": operator.or_, "AND": operator.and_}
 logger = logging.getLogger(__name__)
 
 
@@ -41,11 +35,6 @@ class Rule(object):
         :type host: **any** PyActor Proxy type
         """
 
-        self.admin_project = MANAGEMENT_ACCOUNT
-        self.admin_user = MANAGEMENT_ADMIN_USERNAME
-        self.admin_pass = MANAGEMENT_ADMIN_PASSWORD
-        self.admin_keystone_url = KEYSTONE_ADMIN_URL
-
         self.redis_host = REDIS_HOST
         self.redis_port = REDIS_PORT
         self.redis_db = REDIS_DATABASE
@@ -66,22 +55,13 @@ class Rule(object):
         self.condition = policy_data['condition']
         self.observers_values = dict()
         self.observers_proxies = dict()
-        self.token = None
+        self.metric_slots = dict()
+        self.values = list()
+        self._missing_values = 0
+        self._evaluate = None
+        self.subscriptions = dict()
         self.applied = False
 
-    def _get_admin_token(self):
-        """
-        Method called to obtain the admin credentials, which we need to deploy
-        filters in accounts.
-        """
-        try:
-            _, self.token = c.get_auth(self.admin_keystone_url,
-                                       self.admin_project+":"+self.admin_user,
-                                       self.admin_pass, auth_version="3")
-        except:
-            logger.error("Rule, There was an error gettting a token from keystone")
-            raise Exception()
-
     def stop_actor(self):
         """
         Method called to end the rule. This method unsubscribes the rule from
@@ -89,6 +69,8 @@ class Rule(object):
         """
         for observer in self.observers_proxies.values():
             observer.detach(self.id, self.get_target())
+        for metric_name, key in self.subscriptions.items():
+            bus.unsubscribe(metric_name, key)
         self.host.stop_actor(self.id)
         logger.info("Rule, Actor '" + str(self.id) + "' stopped")
 
@@ -101,8 +83,11 @@ class Rule(object):
         """
         try:
             self.condition_list = parse_condition(self.condition)
+            self.metric_slots, self._evaluate = compile_condition(self.condition_list)
         except:
             raise ValueError("Workload Metric not started")
+        self.values = [None] * len(self.metric_slots)
+        self._missing_values = len(self.values)
         logger.info("Rule, Start '" + str(self.id) + "'")
         logger.info('Rule, Conditions: ' + str(self.condition))
 
@@ -136,10 +121,27 @@ class Rule(object):
             logger.info("Rule, Workload metric: " + metric_name)
             observer = self.host.lookup(metric_name)
             logger.info('Rule, Observer: ' + str(observer.get_id()) + " " + str(observer))
-            observer.attach(self.proxy)
+            if RULE_METRIC_BUS and bus.bus_alive(metric_name):
+                # The metric actor is in this host: read its shared-memory bus
+                observer.attach(self.proxy, bus=True)
+                self.subscriptions[metric_name] = bus.subscribe(metric_name, self._bus_update, [self.get_target()])
+            elif RULE_METRIC_EPSILON is None:
+                observer.attach(self.proxy)
+            else:
+                # Only changed values are notified (relative epsilon)
+                observer.attach(self.proxy, epsilon=RULE_METRIC_EPSILON, relative=True)
             self.observers_proxies[metric_name] = observer
             self.observers_values[metric_name] = None
 
+    def _bus_update(self, metric_name, tick, aggregate):
+        """
+        Called from the bus subscription thread with each aggregate of the
+        metric. The value is delivered through the actor queue, so it is
+        handled as any other update.
+        """
+        for value in aggregate.values():
+            self.proxy.update(metric_name, value)
+
     def update(self, metric_name, value):
         """
         The method update is called by the workloads metrics following the
@@ -155,36 +157,45 @@ class Rule(object):
         """
         logger.info("Rule, Success update: " + str(metric_name) + " = " + str(value))
 
-        self.observers_values[metric_name] = value
-
         # TODO Check the last time updated the value
         # Check the condition of the policy if all values are setted. If the
         # condition result is true, it calls the method do_action
-        if all(val is not None for val in self.observers_values.values()):
-            if self._check_conditions(self.condition_list):
+        if self._set_value(metric_name, value):
+            if self._check_conditions():
                 self._do_action()
         else:
-            logger.error("not all values setted" + str(self.observers_values.values()))
+            logger.debug("not all values setted" + str(self.observers_values.values()))
 
-    def _check_conditions(self, condition_list):
+    def _set_value(self, metric_name, value):
         """
-        The method **check_conditions()** runs the ternary tree of conditions
-        to check if the **self.observers_values** complies the conditions. If
-        the values comply the conditions return True, else return False.
+        Stores the value of a metric in its slot.
 
-        :param condition_list: A list of all the conditions
-        :type condition_list: **any** List type
+        :return: True if all the metrics of the condition have a value.
+        :rtype: boolean type.
+        """
+        self.observers_values[metric_name] = value
+        slot = self.metric_slots.get(metric_name)
+        if slot is not None:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                logger.error("Rule, Invalid value of " + str(metric_name) + ": " + str(value))
+                return False
+            if self.values[slot] is None:
+                self._missing_values -= 1
+            self.values[slot] = value
+        return self._missing_values == 0
+
+    def _check_conditions(self):
+        """
+        Evaluates the condition, compiled in start_rule(), with the last value
+        of each metric. If the values comply the conditions return True, else
+        return False.
 
         :return: If the values comply the conditions
         :rtype: boolean type.
         """
-        if not isinstance(condition_list[0], list):
-            result = mappings[condition_list[1]](float(self.observers_values[condition_list[0].lower()]), float(condition_list[2]))
-        else:
-            result = self.check_conditions(condition_list[0])
-            for i in range(1, len(condition_list) - 1, 2):
-                result = mappings[condition_list[i]](result, self.check_conditions(condition_list[i + 1]))
-        return result
+        return self._evaluate(self.values)
 
     def get_target(self):
         """
@@ -205,16 +216,8 @@ class Rule(object):
             return
         else:
             self.applied = True
-        if not self.token:
-            self._get_admin_token()
-
-        headers = {"X-Auth-Token": self.token}
-
         if self.action == "SET":
             # TODO Review if this tenant has already deployed this filter. Not deploy the same filter more than one time.
-
-            url = os.path.join('http://'+self.controller_server, 'filters', self.target_id, "deploy", str(self.filter))
-
             data = dict()
 
             data['object_type'] = self.object_type
@@ -222,9 +225,7 @@ class Rule(object):
             data['object_tag'] = self.object_tag
             data['params'] = self.params
 
-            response = requests.put(url, json.dumps(data), headers=headers)
-
-            if 200 <= response.status_code < 300:
+            if actions.deploy_filter(self.controller_server, self.target_id, self.filter, data) is not None:
                 logger.info('Policy ' + str(self.id) + ' applied')
                 self.redis.hset(self.id, 'status', 'Applied')
                 try:
@@ -237,16 +238,13 @@ class Rule(object):
 
         elif self.action == "DELETE":
 
-            url = os.path.join('http://'+self.controller_server, 'filters', self.target_id, "undeploy", str(self.filter))
-            response = requests.put(url, headers=headers)
-
-            if 200 <= response.status_code < 300:
-                logger.info(response.text + " " + str(response.status_code))
+            if actions.undeploy_filter(self.controller_server, self.target_id, self.filter):
+                logger.info('Policy ' + str(self.id) + ' applied')
                 try:
                     self.stop_actor()
                 except:
                     pass
-                return response.text
+                return
             else:
                 logger.error('ERROR RESPONSE')
 
@@ -0,0 +1,312 @@
+from django.conf import settings
+from pyactor.exceptions import NotFoundError
+from threading import Lock
+from metrics import bus
+from policies import actions
+from policies.conditions import compile_condition
+from policies.dsl_parser import parse_condition
+import logging
+import redis
+
+logger = logging.getLogger(__name__)
+
+ENGINE_ID = 'rule_engine'
+
+# Serializes the spawn of the engine by the views
+_engine_lock = Lock()
+
+
+class EnginePolicy(object):
+    """
+    State of a dynamic policy hosted by the rule engine: its compiled
+    condition, the last value of each metric of the condition (by slot) and
+    the state of its action.
+    """
+
+    def __init__(self, policy_data, controller_server):
+        self.id = 'policy:' + str(policy_data['id'])
+        self.policy_id = int(policy_data['id'])
+        self.action = policy_data['action']
+        self.filter = policy_data['filter']
+        self.params = policy_data['parameters']
+        self.target_id = policy_data['target_id']
+        self.target_name = policy_data['target_name']
+        self.object_size = policy_data['object_size']
+        self.object_tag = policy_data['object_tag']
+        self.object_type = policy_data['object_type']
+        self.transient = policy_data['transient'] in (True, 'True')
+        self.controller_server = controller_server
+        self.condition = policy_data['condition']
+
+        self.metric_slots, self.evaluate = compile_condition(parse_condition(self.condition))
+        self.values = [None] * len(self.metric_slots)
+        self.missing_values = len(self.values)
+
+        self.applied = False
+        self.execution_stat = False
+        self.static_policy_id = None
+
+    def set_value(self, metric_name, value):
+        """
+        Stores the value of a metric in its slot.
+
+        :return: True if all the metrics of the condition have a value.
+        :rtype: boolean
+        """
+        slot = self.metric_slots.get(metric_name)
+        if slot is not None:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                logger.error("Rule engine, Invalid value of " + str(metric_name) + ": " + str(value))
+                return False
+            if self.values[slot] is None:
+                self.missing_values -= 1
+            self.values[slot] = value
+        return self.missing_values == 0
+
+
+class PolicyHandle(object):
+    """
+    Stands for a policy of the rule engine in api.common.rule_actors, where
+    the views keep the Rule actors, so the policies are stopped the same way.
+    """
+
+    def __init__(self, engine, policy_id):
+        self.engine = engine
+        self.policy_id = policy_id
+
+    def stop_actor(self):
+        self.engine.remove_policy(self.policy_id)
+
+
+class RuleEngine(object):
+    """
+    RuleEngine: Hosts all the dynamic policies of the controller in a single
+    actor, instead of a Rule (or TransientRule) actor per policy, target and
+    action. The engine is attached once to each workload metric, with the
+    targets of its policies, so it receives one update_batch(metric_name,
+    {target: value}) per metric interval. An index of the policies by metric
+    and target is used to evaluate, in one pass, only the policies affected
+    by the values received. The policies behave as the Rule and
+    TransientRule actors.
+    """
+    _ask = ['add_policy']
+    _tell = ['update_batch', 'remove_policy', 'remove_metric', 'stop_actor']
+
+    def __init__(self):
+        self.redis = redis.Redis(connection_pool=settings.REDIS_CON_POOL)
+
+        self.policies = dict()  # {policy_id: EnginePolicy}
+        self.index = dict()  # {metric_name: {target: set(policy_id)}}
+        self.observers_proxies = dict()  # {metric_name: proxy}
+        self.subscriptions = dict()  # {metric_name: key of the bus subscription}
+
+    def add_policy(self, policy_data, controller_server):
+        """
+        Adds a dynamic policy to the engine and subscribes the engine to the
+        targets of the policy in the metrics of its condition.
+
+        :param policy_data: The policy, as stored in redis.
+        :type policy_data: dict
+        :param controller_server: The host of the controller API.
+        :type controller_server: str
+        :raises ValueError: If the condition is not valid or its metrics are
+                            not started.
+        """
+        try:
+            policy = EnginePolicy(policy_data, controller_server)
+            for metric_name in policy.metric_slots:
+                if metric_name not in self.observers_proxies:
+                    self.host.lookup(metric_name)
+        except Exception:
+            raise ValueError("Workload Metric not started")
+
+        self.remove_policy(policy.policy_id)
+        self.policies[policy.policy_id] = policy
+        for metric_name in policy.metric_slots:
+            targets = self.index.setdefault(metric_name, dict())
+            if policy.target_name not in targets:
+                targets[policy.target_name] = set()
+                self._attach(metric_name, policy.target_name)
+            targets[policy.target_name].add(policy.policy_id)
+        logger.info("Rule engine, Policy '" + policy.id + "' added: " + policy.condition)
+
+    def remove_policy(self, policy_id):
+        """
+        Removes a policy from the engine. The engine is detached from the
+        targets that no other policy needs.
+        """
+        policy = self.policies.pop(policy_id, None)
+        if policy is None:
+            return
+        for metric_name in policy.metric_slots:
+            targets = self.index.get(metric_name, dict())
+            policies = targets.get(policy.target_name)
+            if policies is None:
+                continue
+            policies.discard(policy_id)
+            if not policies:
+                del targets[policy.target_name]
+                self._detach(metric_name, policy.target_name)
+        logger.info("Rule engine, Policy '" + policy.id + "' removed")
+
+    def remove_metric(self, metric_name):
+        """
+        Called by a workload metric that is being stopped. The policies that
+        use the metric are removed and stored as Stopped; the policies of the
+        other metrics keep running.
+
+        :param metric_name: The name of the workload metric.
+        :type metric_name: str
+        """
+        # The metric actor is going away: it is not detached
+        self.observers_proxies.pop(metric_name, None)
+        policy_ids = set()
+        for policies in self.index.get(metric_name, dict()).values():
+            policy_ids.update(policies)
+        for policy_id in policy_ids:
+            policy = self.policies[policy_id]
+            self.remove_policy(policy_id)
+            self.redis.hset(policy.id, 'status', 'Stopped')
+        logger.info("Rule engine, Metric '" + metric_name + "' removed")
+
+    def _attach(self, metric_name, target):
+        observer = self.observers_proxies.get(metric_name)
+        if observer is None:
+            observer = self.host.lookup(metric_name)
+            self.observers_proxies[metric_name] = observer
+            if settings.RULE_METRIC_BUS and bus.bus_alive(metric_name):
+                # The metric actor is in this host: read its shared-memory bus
+                observer.attach(self.proxy, targets=[target], bus=True)
+                self.subscriptions[metric_name] = bus.subscribe(metric_name, self._bus_update)
+            elif settings.RULE_METRIC_EPSILON is None:
+                observer.attach(self.proxy, targets=[target])
+            else:
+                # Only changed values are notified (relative epsilon)
+                observer.attach(self.proxy, targets=[target], epsilon=settings.RULE_METRIC_EPSILON, relative=True)
+        else:
+            observer.attach(self.proxy, targets=[target])
+
+    def _detach(self, metric_name, target):
+        observer = self.observers_proxies.get(metric_name)
+        if observer is not None:
+            observer.detach(self.id, target)
+        if not self.index.get(metric_name):
+            self.index.pop(metric_name, None)
+            self.observers_proxies.pop(metric_name, None)
+            key = self.subscriptions.pop(metric_name, None)
+            if key:
+                bus.unsubscribe(metric_name, key)
+
+    def _bus_update(self, metric_name, tick, aggregate):
+        """
+        Called from the bus subscription thread with each aggregate of the
+        metric. The values of the targets of the policies are delivered
+        through the actor queue.
+        """
+        targets = self.index.get(metric_name, dict())
+        values = dict((target, value) for target, value in aggregate.iteritems() if target in targets)
+        if values:
+            self.proxy.update_batch(metric_name, values)
+
+    def update_batch(self, metric_name, values):
+        """
+        Called by the workload metrics with the values of an interval. Each
+        policy of the updated targets is evaluated once, and the actions of
+        the policies whose condition changed are executed.
+
+        :param metric_name: The name of the workload metric.
+        :type metric_name: str
+        :param values: {target: value}
+        :type values: dict
+        """
+        targets = self.index.get(metric_name)
+        if not targets:
+            return
+        triggered = list()
+        for target, value in values.iteritems():
+            for policy_id in targets.get(target, ()):
+                policy = self.policies[policy_id]
+                if not policy.set_value(metric_name, value):
+                    continue
+                result = policy.evaluate(policy.values)
+                if policy.transient:
+                    if result != policy.execution_stat:
+                        policy.execution_stat = result
+                        triggered.append((policy, result))
+                elif result and not policy.applied:
+                    policy.applied = True
+                    triggered.append((policy, result))
+
+        for policy, result in triggered:
+            try:
+                self._do_action(policy, result)
+            except Exception as e:
+                logger.error("Rule engine, Error executing the action of '" + policy.id + "': " + str(e))
+
+    def _do_action(self, policy, condition_result):
+        """
+        Executes the action of a policy: the action of the policy when its
+        condition is met, or the reverse action when the condition of a
+        transient policy is no longer met. A policy that is not transient is
+        removed once its action is applied.
+        """
+        if condition_result:
+            action = policy.action
+        else:
+            action = "DELETE" if policy.action == "SET" else "SET"
+
+        if action == "SET":
+            data = {'object_type': policy.object_type,
+                    'object_size': policy.object_size,
+                    'object_tag': policy.object_tag,
+                    'params': policy.params}
+            static_policy_id = actions.deploy_filter(policy.controller_server, policy.target_id, policy.filter, data)
+            if static_policy_id is None:
+                logger.error("Rule engine, Error setting policy '" + policy.id + "'")
+                return
+            if policy.transient:
+                logger.info("Rule engine, Static policy applied with ID: " + str(static_policy_id))
+                policy.static_policy_id = static_policy_id
+            else:
+                logger.info("Rule engine, Policy '" + policy.id + "' applied")
+                self.redis.hset(policy.id, 'status', 'Applied')
+                self.remove_policy(policy.policy_id)
+
+        elif policy.transient:
+            logger.info("Rule engine, Deleting static policy " + str(policy.static_policy_id))
+            if not actions.undeploy_static_policy(policy.controller_server, policy.target_id, policy.static_policy_id):
+                logger.error("Rule engine, Error deleting policy " + str(policy.static_policy_id))
+
+        elif actions.undeploy_filter(policy.controller_server, policy.target_id, policy.filter):
+            self.remove_policy(policy.policy_id)
+        else:
+            logger.error("Rule engine, Error deleting the filter of policy '" + policy.id + "'")
+
+    def stop_actor(self):
+        """
+        Detaches the engine from all the workload metrics and kills the actor.
+        """
+        for metric_name, observer in self.observers_proxies.items():
+            for target in self.index.get(metric_name, dict()).keys():
+                observer.detach(self.id, target)
+        for metric_name, key in self.subscriptions.items():
+            bus.unsubscribe(metric_name, key)
+        self.subscriptions = dict()
+        self.policies = dict()
+        self.index = dict()
+        self.host.stop_actor(self.id)
+        logger.info("Rule engine, Actor stopped")
+
+
+def get_rule_engine(host):
+    """
+    Returns the proxy of the rule engine of the controller, spawning it the
+    first time.
+    """
+    with _engine_lock:
+        try:
+            return host.lookup(ENGINE_ID)
+        except NotFoundError:
+            return host.spawn(ENGINE_ID, settings.RULE_ENGINE_MODULE)
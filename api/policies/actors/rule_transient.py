@@ -1,8 +1,6 @@
 from rule import Rule
-import requests
+from policies import actions
 import logging
-import json
-import os
 
 logger = logging.getLogger(__name__)
 
@@ -49,10 +47,8 @@ class TransientRule(Rule):
         """
         logger.info('Success update: ' + str(tenant_info))
 
-        self.observers_values[metric] = tenant_info
-
-        if all(val is not None for val in self.observers_values.values()):
-            condition_accomplished = self._check_conditions(self.condition_list)
+        if self._set_value(metric, tenant_info):
+            condition_accomplished = self._check_conditions()
             if condition_accomplished != self.execution_stat:
                 self.do_action(condition_accomplished)
                 self.execution_stat = condition_accomplished
@@ -69,16 +65,10 @@ class TransientRule(Rule):
         else:
             action = self.action
 
-        if not self.token:
-            self._get_admin_token()
-
-        headers = {"X-Auth-Token": self.token}
-
         if action == "SET":
             # TODO Review if this tenant has already deployed this filter. Don't deploy the same filter more than one time.
             logger.info("Setting static policy")
             data = dict()
-            url = os.path.join('http://'+self.controller_server, 'filters', self.target_id, "deploy", str(self.filter))
 
             data['object_type'] = self.object_type
             data['object_size'] = self.object_size
@@ -86,20 +76,18 @@ class TransientRule(Rule):
 
             data['params'] = self.params
 
-            response = requests.put(url, json.dumps(data), headers=headers)
+            static_policy_id = actions.deploy_filter(self.controller_server, self.target_id, self.filter, data)
 
-            if 200 <= response.status_code < 300:
-                logger.info("Static policy applied with ID: " + response.content)
-                self.static_policy_id = response.content
+            if static_policy_id is not None:
+                logger.info("Static policy applied with ID: " + str(static_policy_id))
+                self.static_policy_id = static_policy_id
             else:
                 logger.error('Error setting policy')
 
         elif action == "DELETE":
             logger.info("Deleting static policy " + str(self.static_policy_id))
-            url = os.path.join('http://'+self.controller_server, "policies/static", self.target_id+":"+str(self.static_policy_id))
-            response = requests.delete(url, headers=headers)
 
-            if 200 <= response.status_code < 300:
+            if actions.undeploy_static_policy(self.controller_server, self.target_id, self.static_policy_id):
                 logger.info("Policy " + str(self.static_policy_id) + " successfully deleted")
             else:
                 logger.error('Error Deleting policy')
@@ -0,0 +1,61 @@
+import math
+import operator
+
+COMPARISONS = {'<': operator.lt, '>': operator.gt, '==': operator.eq, '!=': operator.ne,
+               '<=': operator.le, '>=': operator.ge}
+LOGICAL = ('AND', 'OR')
+
+
+def _comparison(compare, slot, limit):
+    return lambda v: compare(v[slot], limit)
+
+
+def _and(left, right):
+    return lambda v: left(v) and right(v)
+
+
+def _or(left, right):
+    return lambda v: left(v) or right(v)
+
+
+def _expression(node, slots):
+    if not isinstance(node[0], list):
+        metric = node[0].lower()
+        if metric not in slots:
+            slots[metric] = len(slots)
+        if node[1] not in COMPARISONS:
+            raise ValueError("Invalid comparison in condition: " + str(node[1]))
+        limit = float(node[2])
+        if math.isinf(limit) or math.isnan(limit):
+            raise ValueError("Invalid limit in condition: " + str(node[2]))
+        return _comparison(COMPARISONS[node[1]], slots[metric], limit)
+
+    expression = _expression(node[0], slots)
+    for i in range(1, len(node) - 1, 2):
+        if node[i] not in LOGICAL:
+            raise ValueError("Invalid operator in condition: " + str(node[i]))
+        # Left to right, as the conditions are grouped by the parser
+        combine = _and if node[i] == 'AND' else _or
+        expression = combine(expression, _expression(node[i + 1], slots))
+    return expression
+
+
+def compile_condition(condition_list):
+    """
+    Compiles the condition of a dynamic policy, as returned by
+    dsl_parser.parse_condition(), into a single function made of nested
+    closures. Each metric of the condition is assigned a slot, so the
+    function takes the list of metric values (floats) by slot. The limits
+    are converted once, and AND/OR short-circuit.
+
+    [['m1', '>', '5'], 'AND', ['m2', '<', '3']] compiles to the equivalent of
+    lambda v: v[0] > 5.0 and v[1] < 3.0
+
+    :param condition_list: The parsed condition.
+    :type condition_list: list
+    :return: The {metric name: slot} of the metrics and the function.
+    :rtype: (dict, callable)
+    :raises ValueError: If the condition is not valid.
+    """
+    slots = dict()
+    return slots, _expression(condition_list, slots)
@@ -1,8 +1,20 @@
 from pyparsing import Word, Suppress, alphas, Literal, Group, Combine, opAssoc, alphanums
 from pyparsing import Regex, operatorPrecedence, oneOf, nums, Optional, delimitedList
+from pyparsing import ParseException, ParseBaseException
 from django.conf import settings
+from threading import Lock
+from api.common import DSL_GENERATION_KEY
+import cPickle
 import json
+import multiprocessing
+import os
 import redis
+import subprocess
+import sys
+
+# Grammars of this process: {(name, generation): grammar}
+_grammars = dict()
+_grammars_lock = Lock()
 
 # By default, PyParsing treats \n as whitespace and ignores it
 # In our grammar, \n is significant, so tell PyParsing not to ignore it
@@ -34,30 +46,55 @@ def parse_group_tenants(tokens):
     return json.loads(attached_projects)
 
 
-def parse_condition(input_string):
+def _key_names(r, pattern):
+    return ["".join(key.split(":")[1]) for key in r.keys(pattern)]
+
 
+def _get_grammar(name, build):
+    """
+    Returns the grammar built by build(r), cached per process until the
+    generation changes (api.common.bump_dsl_generation). Without generation
+    the grammar is built for each rule.
+    """
     r = get_redis_connection()
+    generation = r.get(DSL_GENERATION_KEY)
+    if generation is None:
+        return build(r)
+    key = (name, generation)
+    grammar = _grammars.get(key)
+    if grammar is None:
+        grammar = build(r)
+        # Done by the first parseString(), before it is shared by the threads
+        grammar.streamline()
+        with _grammars_lock:
+            for old_key in [k for k in _grammars if k[1] != generation]:
+                del _grammars[old_key]
+            _grammars[key] = grammar
+    return grammar
 
-    metrics_workload = r.keys("metric:*")
-    services = map(lambda x: "".join(x.split(":")[1]), metrics_workload)
+
+def _condition_list(services):
     services_options = oneOf(services)
     operand = oneOf("< > == != <= >=")
     number = Regex(r"[+-]?\d+(:?\.\d*)?(:?[eE][+-]?\d+)?")
 
     condition = Group(services_options + operand("operand") + number("limit_value"))
-    condition_list = operatorPrecedence(condition, [
+    return operatorPrecedence(condition, [
                                 ("AND", 2, opAssoc.LEFT, ),
                                 ("OR", 2, opAssoc.LEFT, ),
                                 ])
-    rule = condition_list('condition_list')
-    return rule.parseString(input_string).condition_list.asList()
 
 
-def parse(input_string):
-    # TODO Raise an exception if not metrics or not action registered
-    # TODO Raise an exception if group of tenants does not exist.
-    r = get_redis_connection()
+def _build_condition_grammar(r):
+    return _condition_list(_key_names(r, "metric:*"))('condition_list')
 
+
+def parse_condition(input_string):
+    rule = _get_grammar('condition', _build_condition_grammar)
+    return rule.parseString(input_string).condition_list.asList()
+
+
+def _build_rule_grammar(r):
     # Support words to construct the grammar.
     word = Word(alphas)
     when = Suppress(Literal("WHEN"))
@@ -65,16 +102,9 @@ def parse(input_string):
     # boolean_condition = oneOf("AND OR")
     # Condition part
     param = Word(alphanums+"_") + Suppress(Literal("=")) + Word(alphanums+"_")
-    metrics_workload = r.keys("metric:*")
-    services = map(lambda x: "".join(x.split(":")[1]), metrics_workload)
-    services_options = oneOf(services)
-    operand = oneOf("< > == != <= >=")
     number = Regex(r"[+-]?\d+(:?\.\d*)?(:?[eE][+-]?\d+)?")
-    condition = Group(services_options + operand("operand") + number("limit_value"))
-    condition_list = operatorPrecedence(condition, [
-                                ("AND", 2, opAssoc.LEFT, ),
-                                ("OR", 2, opAssoc.LEFT, ),
-                                ])
+    condition_list = _condition_list(_key_names(r, "metric:*"))
+
     # For tenant or group of tenants
     group_id = Word(nums)
     container = Group(Literal("CONTAINER")("type") + Suppress(":") + Combine(Word(alphanums) + Literal("/") + Word(alphanums+"_-")))
@@ -89,8 +119,7 @@ def parse(input_string):
     # Group(tenant_list ^ tenant_group_list ^ container_list ^ obj_list)
     # Action part
     action = oneOf("SET DELETE")
-    sfilters_list = r.keys("filter:*")
-    sfilter = map(lambda x: "".join(x.split(":")[1]), sfilters_list)
+    sfilter = _key_names(r, "filter:*")
     with_params = Suppress(Literal("WITH"))
     do = Suppress(Literal("DO"))
     params_list = delimitedList(param)
@@ -134,12 +163,19 @@ def parse(input_string):
     tenant_group.setParseAction(parse_group_tenants)
 
     # Final rule structure
-    rule_parse = literal_for + target("target") + \
-                 Optional(when + condition_list("condition_list")) + do + \
-                 action_list("action_list") + Optional(to + object_list("object_list"))
+    return literal_for + target("target") + \
+        Optional(when + condition_list("condition_list")) + do + \
+        action_list("action_list") + Optional(to + object_list("object_list"))
+
+
+def parse(input_string):
+    # TODO Raise an exception if not metrics or not action registered
+    # TODO Raise an exception if group of tenants does not exist.
+    rule_parse = _get_grammar('rule', _build_rule_grammar)
 
     # Parse the rule
     parsed_rule = rule_parse.parseString(input_string)
+    r = get_redis_connection()
 
     # Post-parsed validation
     has_condition_list = True
@@ -163,6 +199,83 @@ def parse(input_string):
     return has_condition_list, parsed_rule
 
 
+def parse_worker(input_stream, output_stream):
+    """
+    Main function of a rule parser process (see parse_rules()). It reads
+    {'redis': connection arguments, 'rules': [rule]} as JSON and writes the
+    pickled list of (True, (has_condition_list, parsed_rule)) of the rules,
+    up to the first invalid one, which is (False, exception).
+    """
+    data = json.load(input_stream)
+    settings.REDIS_CON_POOL = redis.ConnectionPool(**data['redis'])
+    results = list()
+    for input_string in data['rules']:
+        try:
+            results.append((True, parse(input_string)))
+        except ParseBaseException as e:
+            # The parser element of the exception can not be pickled
+            results.append((False, ParseException(e.pstr, e.loc, e.msg)))
+            break
+        except Exception as e:
+            results.append((False, Exception(str(e))))
+            break
+    cPickle.dump(results, output_stream, cPickle.HIGHEST_PROTOCOL)
+    output_stream.flush()
+
+
+def parse_rules(input_strings):
+    """
+    Parses a list of rules, as parse() does. Large lists (at least
+    POLICY_BULK_PARSE_MIN_RULES rules) are split among
+    POLICY_BULK_PARSE_PROCESSES parser processes (at most one per CPU). They
+    are new interpreters (python -m policies.dsl_parser), not forks of the
+    API server, which runs threads. The first invalid rule raises its
+    exception.
+
+    :param input_strings: The rules.
+    :type input_strings: list of str
+    :return: The (has_condition_list, parsed_rule) of each rule.
+    :rtype: list
+    """
+    processes = min(settings.POLICY_BULK_PARSE_PROCESSES, multiprocessing.cpu_count())
+    if processes < 2 or len(input_strings) < settings.POLICY_BULK_PARSE_MIN_RULES:
+        return [parse(input_string) for input_string in input_strings]
+
+    connection = settings.REDIS_CON_POOL.connection_kwargs
+    redis_arguments = dict((key, connection[key]) for key in ('host', 'port', 'db') if key in connection)
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'api.settings'))
+    chunk_size = -(-len(input_strings) // processes)
+    workers = list()
+    try:
+        # The rules are written to all the processes before reading any
+        # result, so they parse in parallel
+        for start in range(0, len(input_strings), chunk_size):
+            worker = subprocess.Popen([sys.executable, '-m', 'policies.dsl_parser'],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      cwd=settings.BASE_DIR, env=env, close_fds=True)
+            workers.append(worker)
+            json.dump({'redis': redis_arguments, 'rules': input_strings[start:start + chunk_size]}, worker.stdin)
+            worker.stdin.close()
+
+        parsed_rules = list()
+        for worker in workers:
+            try:
+                results = cPickle.load(worker.stdout)
+            except (EOFError, cPickle.UnpicklingError):
+                raise Exception("Rule parser process exited with " + str(worker.wait()))
+            for parsed, result in results:
+                if not parsed:
+                    raise result
+                parsed_rules.append(result)
+        return parsed_rules
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.kill()
+            worker.stdout.close()
+            worker.wait()
+
+
 # condition_list, rule_parsed = parse("FOR TENANT:T1 WHEN get_ops_tenant > 5 DO SET cache TRANSIENT")
 # print condition_list, rule_parsed
 
@@ -193,3 +306,10 @@ def parse(input_string):
 #         print 'This rule ***'+rule+'  *** could not be parsed'
 #     else:
 #         print stats.asList()
+
+
+if __name__ == '__main__':
+    # Run as a module, this file is __main__: the worker is run from the
+    # policies.dsl_parser module, so the results pickle with its names
+    from policies.dsl_parser import parse_worker as worker_main
+    worker_main(sys.stdin, sys.stdout)
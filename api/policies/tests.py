@@ -1,5 +1,6 @@
 import json
 import os
+import subprocess
 
 import mock
 import redis
@@ -8,7 +9,7 @@ from django.test import TestCase, override_settings
 from pyparsing import ParseException
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
-from policies.dsl_parser import parse, parse_condition
+from policies.dsl_parser import parse, parse_condition, parse_rules
 from filters.views import filter_list, filter_deploy, FilterData
 from policies.views import object_type_list, object_type_detail, static_policy_detail, dynamic_policy_detail, policy_list, \
     access_control, access_control_detail
@@ -138,6 +139,155 @@ class PoliciesTestCase(TestCase):
         self.assertEqual(policy_data['filter'], 'compression')
         self.assertEqual(policy_data['condition'], 'metric1 > 5')
 
+    @override_settings(POLICY_BULK_START_WORKERS=1)
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    def test_registry_dynamic_policy_bulk_create_ok(self, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+        self.r.lpush('projects_crystal_enabled', '2')
+        last_id = int(self.r.get('policies:id'))
+
+        data = "FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression\n\n" \
+               "FOR TENANT:0123456789abcdef, TENANT:2 WHEN metric2 < 3 DO SET compression TRANSIENT"
+        request = self.factory.post('/policies/dynamic?bulk=true', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_list(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(int(self.r.get('policies:id')), last_id + 3)
+        # One start worker: the mock records the spawns in order
+        spawned = [spawn_call[0][0] for spawn_call in mock_create_local_host.return_value.spawn.call_args_list]
+        self.assertEqual(spawned, ['policy:' + str(last_id + i) for i in range(1, 4)])
+        policies = [self.r.hgetall('policy:' + str(last_id + i)) for i in range(1, 4)]
+        self.assertEqual([policy['condition'] for policy in policies], ['metric1 > 5', 'metric2 < 3', 'metric2 < 3'])
+        self.assertEqual(sorted(policy['target_id'] for policy in policies[1:]), ['0123456789abcdef', '2'])
+        self.assertEqual(policies[2]['transient'], 'True')
+        self.assertTrue(policies[2]['policy_location'].endswith('policy:' + str(last_id + 3)))
+
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    def test_registry_dynamic_policy_bulk_invalid_rule(self, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+        last_id = self.r.get('policies:id')
+
+        # The second project is not Crystal enabled: nothing is deployed
+        data = "FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression\n" \
+               "FOR TENANT:2 WHEN metric1 > 5 DO SET compression"
+        request = self.factory.post('/policies/dynamic?bulk=true', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_list(request)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.r.get('policies:id'), last_id)
+        self.assertEqual(self.r.keys('policy:*'), [])
+        self.assertFalse(mock_create_local_host.return_value.spawn.called)
+
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    def test_registry_dynamic_policy_bulk_actor_error(self, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+        mock_create_local_host.return_value.spawn.return_value.start_rule.side_effect = Exception('metric1 not started')
+        last_id = int(self.r.get('policies:id'))
+
+        data = "FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression"
+        request = self.factory.post('/policies/dynamic?bulk=true', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_list(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn(str(last_id + 1), json.loads(response.content))
+        self.assertEqual(self.r.hget('policy:' + str(last_id + 1), 'status'), 'Stopped')
+
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    def test_registry_dynamic_policy_bulk_static_error(self, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+        self.r.hmset('filter:compression', {'id': '1', 'filter_name': 'compression', 'filter_type': 'native',
+                                            'path': '/tmp/compression', 'main': 'compression.Compression'})
+        # The storlet file does not exist, so it can not be uploaded to Swift
+        self.r.hmset('filter:encryption', {'id': '2', 'filter_name': 'encryption', 'filter_type': 'storlet',
+                                           'path': '/tmp/crystal/missing.jar', 'main': 'encryption.Encryption',
+                                           'language': 'Java', 'interface_version': '1.0'})
+        self.r.hset('pipeline:0123456789abcdef', '1', json.dumps({'filter_name': 'compression'}))
+        pipeline = self.r.hgetall('pipeline:0123456789abcdef')
+
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+        last_id = self.r.get('policies:id')
+
+        data = "FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression\n" \
+               "FOR TENANT:0123456789abcdef DO SET compression\n" \
+               "FOR TENANT:0123456789abcdef DO SET encryption"
+        request = self.factory.post('/policies/dynamic?bulk=true', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_list(request)
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        # Nothing of the upload is left: the dynamic policy, the static policy and the ids
+        self.assertEqual(self.r.keys('policy:*'), [])
+        self.assertEqual(self.r.hgetall('pipeline:0123456789abcdef'), pipeline)
+        self.assertEqual(self.r.get('policies:id'), last_id)
+        self.assertFalse(mock_create_local_host.return_value.spawn.called)
+
+    @override_settings(RULE_ENGINE_ENABLED=True)
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    def test_registry_dynamic_policy_rule_engine(self, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+        self.r.lpush('projects_crystal_enabled', '2')
+        last_id = int(self.r.get('policies:id'))
+
+        data = "FOR TENANT:0123456789abcdef, TENANT:2 WHEN metric1 > 5 DO SET compression"
+        request = self.factory.post('/policies/dynamic', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_list(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        host = mock_create_local_host.return_value
+        host.lookup.assert_called_with('rule_engine')
+        self.assertFalse(host.spawn.called)
+        engine = host.lookup.return_value
+        self.assertEqual(engine.add_policy.call_count, 2)
+        self.assertTrue(self.r.hget('policy:' + str(last_id + 1), 'policy_location').endswith('/RuleEngine/rule_engine'))
+
+        # Stopping the policy removes it from the engine
+        request = self.factory.put('/policies/dynamic/' + str(last_id + 1), {'status': 'Stopped', 'object_type': ''},
+                                   format='json')
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = dynamic_policy_detail(request, str(last_id + 1))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        engine.remove_policy.assert_called_with(last_id + 1)
+
+    @override_settings(POLICY_BULK_PARSE_PROCESSES=2, POLICY_BULK_PARSE_MIN_RULES=2)
+    @mock.patch('policies.dsl_parser.multiprocessing.cpu_count', return_value=2)
+    @mock.patch('policies.dsl_parser.subprocess.Popen', wraps=subprocess.Popen)
+    def test_parse_rules_in_processes(self, mock_popen, mock_cpu_count):
+        self.setup_dsl_parser_data()
+        rules = ['FOR TENANT:0123456789abcdef WHEN metric1 > ' + str(i) + ' DO SET compression' for i in range(4)]
+        rules.append('FOR TENANT:0123456789abcdef DO SET compression')
+        parsed_rules = parse_rules(rules)
+        # New interpreters, not forks of this process
+        self.assertEqual(mock_popen.call_count, 2)
+        self.assertEqual(mock_popen.call_args[0][0][1:], ['-m', 'policies.dsl_parser'])
+        self.assertEqual([has_condition_list for has_condition_list, _ in parsed_rules], [True] * 4 + [False])
+        self.assertEqual(parsed_rules[3][1].condition_list.asList(), ['metric1', '>', '3'])
+        self.assertEqual(parsed_rules[4][1].action_list[0].filter, 'compression')
+
+        with self.assertRaises(ParseException):
+            parse_rules(rules + ['FOR TENANT:0123456789abcdef DO SET unknown_filter'])
+
     #
     # static_policy_detail()
     #
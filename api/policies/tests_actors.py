@@ -8,7 +8,12 @@ from httmock import urlmatch, HTTMock
 
 from actors.rule import Rule
 from actors.rule_transient import TransientRule
-from .dsl_parser import parse
+from actors.rule_engine import RuleEngine
+from metrics.actors.swift_metric import SwiftMetric
+from .conditions import compile_condition
+from .dsl_parser import parse, parse_condition
+from api.common import bump_dsl_generation
+from pyparsing import ParseException
 
 
 @urlmatch(netloc=r'(.*\.)?example\.com')
@@ -37,6 +42,193 @@ class PoliciesActorsTestCase(TestCase):
     # rules/rule
     #
 
+    def test_compile_condition(self):
+        slots, evaluate = compile_condition(['Metric1', '>', '5'])
+        self.assertEqual(slots, {'metric1': 0})
+        self.assertTrue(evaluate([6.0]))
+        self.assertFalse(evaluate([5.0]))
+
+        condition = [[['metric1', '>', '5'], 'AND', ['metric2', '<', '3']], 'OR', ['metric1', '==', '1']]
+        slots, evaluate = compile_condition(condition)
+        self.assertEqual(slots, {'metric1': 0, 'metric2': 1})
+        self.assertTrue(evaluate([6.0, 2.0]))
+        self.assertFalse(evaluate([6.0, 4.0]))
+        self.assertTrue(evaluate([1.0, 4.0]))
+        # AND/OR short-circuit: the second slot is not read
+        self.assertFalse(compile_condition([['metric1', '>', '5'], 'AND', ['metric2', '<', '3']])[1]([1.0]))
+
+        with self.assertRaises(ValueError):
+            compile_condition(['metric1', '=<', '5'])
+        with self.assertRaises(ValueError):
+            compile_condition([['metric1', '>', '5'], 'XOR', ['metric2', '<', '3']])
+
+    @mock.patch('policies.actors.rule.parse_condition')
+    @mock.patch('policies.actors.rule.Rule._do_action')
+    def test_rule_compound_condition(self, mock_do_action, mock_parse_condition):
+        mock_parse_condition.return_value = [['metric1', '>', '5'], 'AND', ['metric2', '<', '3']]
+        policy_data = {'action': 'SET', 'filter': 'compression', 'parameters': {}, 'target_id': '0123456789abcdef',
+                       'target_name': 'tenant1', 'object_size': '', 'object_tag': '', 'object_type': '',
+                       'condition': 'metric1 > 5 AND metric2 < 3'}
+        rule = Rule(policy_data, 'example.com')
+        rule.host = mock.MagicMock()
+        rule.proxy = mock.MagicMock()
+        rule.id = 'policy:1'
+        rule.start_rule()
+        self.assertEqual(rule.host.lookup.return_value.attach.call_count, 2)
+
+        rule.update('metric1', 6)
+        self.assertFalse(mock_do_action.called)
+        rule.update('metric2', 4)
+        self.assertFalse(mock_do_action.called)
+        rule.update('metric2', '2')
+        self.assertTrue(mock_do_action.called)
+
+    def _engine_policy(self, policy_id, target_name, condition, action='SET', transient=False):
+        return {'id': policy_id, 'action': action, 'filter': 'compression', 'parameters': {},
+                'target_id': target_name + '_id', 'target_name': target_name, 'object_size': '', 'object_tag': '',
+                'object_type': '', 'condition': condition, 'transient': transient}
+
+    @mock.patch('policies.actors.rule_engine.parse_condition')
+    @mock.patch('policies.actors.rule_engine.RuleEngine._do_action')
+    def test_rule_engine(self, mock_do_action, mock_parse_condition):
+        mock_parse_condition.side_effect = lambda condition: {
+            'metric1 > 5': ['metric1', '>', '5'],
+            'metric1 > 5 AND metric2 < 3': [['metric1', '>', '5'], 'AND', ['metric2', '<', '3']]}[condition]
+        engine = RuleEngine()
+        engine.host = mock.MagicMock()
+        engine.proxy = mock.MagicMock()
+        engine.id = 'rule_engine'
+        metric = engine.host.lookup.return_value
+
+        engine.add_policy(self._engine_policy(1, 'tenant1', 'metric1 > 5'), 'example.com')
+        engine.add_policy(self._engine_policy(2, 'tenant2', 'metric1 > 5 AND metric2 < 3', transient=True),
+                          'example.com')
+        engine.add_policy(self._engine_policy(3, 'tenant2', 'metric1 > 5'), 'example.com')
+        # Attached once per metric and target
+        self.assertEqual(sorted(call[1]['targets'][0] for call in metric.attach.call_args_list),
+                         ['tenant1', 'tenant2', 'tenant2'])
+        self.assertEqual(engine.index['metric1'], {'tenant1': {1}, 'tenant2': {2, 3}})
+
+        engine.update_batch('metric1', {'tenant1': 3, 'tenant2': 6, 'tenant3': 10})
+        # Policy 2 waits for metric2
+        self.assertEqual([(call[0][0].policy_id, call[0][1]) for call in mock_do_action.call_args_list], [(3, True)])
+        mock_do_action.reset_mock()
+
+        engine.update_batch('metric2', {'tenant2': 2})
+        self.assertEqual([(call[0][0].policy_id, call[0][1]) for call in mock_do_action.call_args_list], [(2, True)])
+        mock_do_action.reset_mock()
+
+        # Applied policies are not triggered again; transient ones reverse their action
+        engine.update_batch('metric1', {'tenant2': 4})
+        self.assertEqual([(call[0][0].policy_id, call[0][1]) for call in mock_do_action.call_args_list], [(2, False)])
+
+        engine.remove_policy(1)
+        metric.detach.assert_called_with('rule_engine', 'tenant1')
+        self.assertEqual(engine.index['metric1'], {'tenant2': {2, 3}})
+
+    @mock.patch('metrics.actors.swift_metric.get_scheduler')
+    @mock.patch('policies.actors.rule_engine.parse_condition')
+    @mock.patch('policies.actors.rule_engine.RuleEngine._do_action')
+    def test_rule_engine_metric_stopped(self, mock_do_action, mock_parse_condition, mock_get_scheduler):
+        mock_parse_condition.side_effect = lambda condition: [condition.split()[0], '>', '5']
+        engine = RuleEngine()
+        engine.host = mock.MagicMock()
+        engine.proxy = mock.MagicMock()
+        engine.id = 'rule_engine'
+        engine.add_policy(self._engine_policy(1, 'tenant1', 'metric1 > 5'), 'example.com')
+        engine.add_policy(self._engine_policy(2, 'tenant1', 'metric2 > 5'), 'example.com')
+
+        swift_metric = SwiftMetric('metric1', 'metric.metric1')
+        swift_metric.host = mock.MagicMock()
+        swift_metric.id = 'metric1'
+        engine_proxy = mock.MagicMock()
+        engine_proxy.get_id.return_value = 'rule_engine'
+        engine_proxy.remove_metric.side_effect = engine.remove_metric
+        swift_metric.attach(engine_proxy, targets=['tenant1'])
+        swift_metric.stop_actor()
+
+        # The engine is not stopped: only the policies of the stopped metric are removed
+        self.assertFalse(engine_proxy.stop_actor.called)
+        engine_proxy.remove_metric.assert_called_once_with('metric1')
+        self.assertEqual(self.r.hget('policy:1', 'status'), 'Stopped')
+        self.assertFalse(self.r.exists('rule_engine'))
+        self.assertEqual(engine.policies.keys(), [2])
+        self.assertNotIn('metric1', engine.index)
+
+        engine.update_batch('metric2', {'tenant1': 6})
+        self.assertEqual([(call[0][0].policy_id, call[0][1]) for call in mock_do_action.call_args_list], [(2, True)])
+
+    def _engine(self):
+        engine = RuleEngine()
+        engine.host = mock.MagicMock()
+        engine.proxy = mock.MagicMock()
+        engine.id = 'rule_engine'
+        self.r.hmset('filter:compression', {'id': '1', 'filter_name': 'compression', 'filter_type': 'native',
+                                            'path': '/tmp/compression', 'main': 'compression.Compression'})
+        return engine
+
+    @mock.patch('policies.actors.rule_engine.parse_condition')
+    def test_rule_engine_action_applied(self, mock_parse_condition):
+        mock_parse_condition.return_value = ['metric1', '>', '5']
+        engine = self._engine()
+
+        engine.add_policy(self._engine_policy(1, 'tenant1', 'metric1 > 5'), 'example.com')
+        engine.update_batch('metric1', {'tenant1': 6})
+        # The filter is deployed in-process, without the controller API
+        pipeline = self.r.hgetall('pipeline:tenant1_id')
+        self.assertEqual(len(pipeline), 1)
+        self.assertEqual(json.loads(pipeline.values()[0])['filter_name'], 'compression')
+        self.assertEqual(self.r.hget('policy:1', 'status'), 'Applied')
+        self.assertEqual(engine.policies, {})
+        self.assertEqual(engine.index, {})
+
+    @mock.patch('policies.actors.rule_engine.parse_condition')
+    def test_rule_engine_transient_action(self, mock_parse_condition):
+        mock_parse_condition.return_value = ['metric1', '>', '5']
+        engine = self._engine()
+
+        engine.add_policy(self._engine_policy(1, 'tenant1', 'metric1 > 5', transient=True), 'example.com')
+        engine.update_batch('metric1', {'tenant1': 6})
+        static_policy_id = engine.policies[1].static_policy_id
+        self.assertTrue(self.r.hexists('pipeline:tenant1_id', static_policy_id))
+        engine.update_batch('metric1', {'tenant1': 4})
+        self.assertFalse(self.r.exists('pipeline:tenant1_id'))
+        self.assertIn(1, engine.policies)
+
+    @override_settings(RULE_ACTION_MODE='http')
+    @mock.patch('policies.actions.get_admin_token', return_value='fake_token')
+    @mock.patch('policies.actors.rule_engine.parse_condition')
+    def test_rule_engine_action_http(self, mock_parse_condition, mock_get_admin_token):
+        mock_parse_condition.return_value = ['metric1', '>', '5']
+        engine = self._engine()
+
+        engine.add_policy(self._engine_policy(1, 'tenant1', 'metric1 > 5'), 'example.com')
+        with HTTMock(example_mock_200):
+            engine.update_batch('metric1', {'tenant1': 6})
+        self.assertFalse(self.r.exists('pipeline:tenant1_id'))
+        self.assertEqual(self.r.hget('policy:1', 'status'), 'Applied')
+        self.assertEqual(engine.policies, {})
+
+    def test_dsl_grammar_generation(self):
+        self.setup_dsl_parser_data()
+        bump_dsl_generation(self.r)
+        self.assertEqual(parse_condition('metric1 > 5 AND metric2 < 3'),
+                         [['metric1', '>', '5'], 'AND', ['metric2', '<', '3']])
+        has_condition_list, _ = parse('FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression')
+        self.assertTrue(has_condition_list)
+
+        # The cached grammar does not see the new metric until the generation changes
+        self.r.hmset('metric:metric3', {'network_location': '?', 'type': 'integer'})
+        with self.assertRaises(ParseException):
+            parse_condition('metric3 > 5')
+        bump_dsl_generation(self.r)
+        self.assertEqual(parse_condition('metric3 > 5'), ['metric3', '>', '5'])
+
+        self.r.delete('filter:encryption')
+        bump_dsl_generation(self.r)
+        with self.assertRaises(ParseException):
+            parse('FOR TENANT:0123456789abcdef DO SET encryption')
+
     # def test_get_target_ok(self):
     #     self.setup_dsl_parser_data()
     #     _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
@@ -3,6 +3,7 @@ from django.views.decorators.csrf import csrf_exempt
 from redis.exceptions import RedisError, DataError
 from rest_framework import status
 from rest_framework.parsers import JSONParser
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 import logging
 import json
@@ -14,6 +15,8 @@ from api.common import JSONResponse, get_redis_connection, get_project_list, \
 from api.exceptions import SwiftClientError, StorletNotFoundException, \
     ProjectNotFound, ProjectNotCrystalEnabled
 from filters.views import set_filter, unset_filter
+from policies.actions import delete_static_policy
+from policies.actors.rule_engine import get_rule_engine, PolicyHandle, ENGINE_ID
 logger = logging.getLogger(__name__)
 
 
@@ -77,39 +80,47 @@ def policy_list(request):
     if request.method == 'POST':
         # New Policy
         rules_string = request.body.splitlines()
-        for rule_string in rules_string:
-            #
-            # Rules improved:
-            # TODO: Handle the new parameters of the rule
-            # Add containers and object in rules
-            # Add execution server in rules
-            # Add object type in rules
-            #
-            try:
-                condition_list, rule_parsed = dsl_parser.parse(rule_string)
-                if condition_list:
-                    # Dynamic Rule
-                    http_host = request.META['HTTP_HOST']
-                    deploy_dynamic_policy(r, rule_string, rule_parsed, http_host)
-                else:
-                    # Static Rule
-                    deploy_static_policy(request, r, rule_parsed)
-
-            except SwiftClientError:
-                return JSONResponse('Error accessing Swift.', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-            except StorletNotFoundException:
-                return JSONResponse('Storlet not found.', status=status.HTTP_404_NOT_FOUND)
-
-            except ProjectNotFound:
-                return JSONResponse('Invalid Project Name/ID. The Project does not exist.', status=status.HTTP_404_NOT_FOUND)
-            except ProjectNotCrystalEnabled:
-                return JSONResponse('The project is not Crystal Enabled. Verify it in the Projects panel.',
-                                    status=status.HTTP_404_NOT_FOUND)
-            except Exception as e:
-                logger.info('Unexpected exception: ' + e.message)
-                return JSONResponse('Please, review the rule, and start the related workload '
-                                    'metric before creating a new policy', status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            if request.GET.get('bulk', '').lower() in ('true', '1'):
+                stopped = deploy_policies_bulk(request, r, rules_string)
+                if stopped:
+                    return JSONResponse('Policies added, but the actors of the dynamic policies ' +
+                                        ', '.join(map(str, stopped)) + ' could not be started. Please, start the '
+                                        'related workload metrics and start them again.',
+                                        status=status.HTTP_201_CREATED)
+            else:
+                for rule_string in rules_string:
+                    #
+                    # Rules improved:
+                    # TODO: Handle the new parameters of the rule
+                    # Add containers and object in rules
+                    # Add execution server in rules
+                    # Add object type in rules
+                    #
+                    condition_list, rule_parsed = dsl_parser.parse(rule_string)
+                    if condition_list:
+                        # Dynamic Rule
+                        http_host = request.META['HTTP_HOST']
+                        deploy_dynamic_policy(r, rule_string, rule_parsed, http_host)
+                    else:
+                        # Static Rule
+                        deploy_static_policy(request, r, rule_parsed)
+
+        except SwiftClientError:
+            return JSONResponse('Error accessing Swift.', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        except StorletNotFoundException:
+            return JSONResponse('Storlet not found.', status=status.HTTP_404_NOT_FOUND)
+
+        except ProjectNotFound:
+            return JSONResponse('Invalid Project Name/ID. The Project does not exist.', status=status.HTTP_404_NOT_FOUND)
+        except ProjectNotCrystalEnabled:
+            return JSONResponse('The project is not Crystal Enabled. Verify it in the Projects panel.',
+                                status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.info('Unexpected exception: ' + e.message)
+            return JSONResponse('Please, review the rule, and start the related workload '
+                                'metric before creating a new policy', status=status.HTTP_401_UNAUTHORIZED)
 
         return JSONResponse('Policies added successfully!', status=status.HTTP_201_CREATED)
 
@@ -138,14 +149,7 @@ def policy_list(request):
             target_id = project_id
             target_name = project_name
 
-        if data['transient']:
-            location = settings.RULE_TRANSIENT_MODULE
-        else:
-            location = settings.RULE_MODULE
-        policy_location = os.path.join(settings.PYACTOR_URL, location, str(rule_id))
-
-        policy_data = {"id": policy_id,
-                       "target_id": target_id,
+        policy_data = {"target_id": target_id,
                        "target_name": target_name,
                        "filter": data['filter_id'],
                        "parameters": data['params'],
@@ -156,8 +160,8 @@ def policy_list(request):
                        "object_tag": data['object_tag'],
                        "object_name": ', '.join(r.lrange('object_type:' + data['object_type'], 0, -1)),
                        "transient": data['transient'],
-                       "policy_location": policy_location,
                        "status": 'Alive'}
+        set_dynamic_policy_id(policy_data, policy_id)
 
         start_dynamic_policy_actor(policy_data, http_host)
 
@@ -222,12 +226,7 @@ def static_policy_detail(request, policy_id):
             return JSONResponse("Error updating data", status=400)
 
     elif request.method == 'DELETE':
-        r.hdel('pipeline:' + target, policy)
-
-        policies_ids = r.keys('policy:*')
-        pipelines_ids = r.keys('pipeline:*')
-        if len(policies_ids) == 0 and len(pipelines_ids) == 0:
-            r.set('policies:id', 0)
+        delete_static_policy(r, target, policy)
         # token = get_token_connection(request)
         # unset_filter(r, target, filter_data, token)
 
@@ -235,12 +234,15 @@ def static_policy_detail(request, policy_id):
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
-def deploy_static_policy(request, r, parsed_rule):
-    token = get_token_connection(request)
+def get_static_policy_targets(parsed_rule, project_list, projects_crystal_enabled):
+    """
+    Returns the targets (project ID or project ID/container) of a static rule.
+
+    :raises ProjectNotFound: If a project of the rule does not exist.
+    :raises ProjectNotCrystalEnabled: If a project is not Crystal enabled.
+    """
     container = None
     rules_to_parse = dict()
-    projects_crystal_enabled = r.lrange('projects_crystal_enabled', 0, -1)
-    project_list = get_project_list()
 
     for target in parsed_rule.target:
         if target[0] == 'TENANT':
@@ -267,6 +269,18 @@ def deploy_static_policy(request, r, parsed_rule):
 
         rules_to_parse[target] = parsed_rule
 
+    return rules_to_parse
+
+
+def deploy_static_policy(request, r, parsed_rule, project_list=None, projects_crystal_enabled=None):
+    token = get_token_connection(request)
+    if projects_crystal_enabled is None:
+        projects_crystal_enabled = r.lrange('projects_crystal_enabled', 0, -1)
+    if project_list is None:
+        project_list = get_project_list()
+
+    rules_to_parse = get_static_policy_targets(parsed_rule, project_list, projects_crystal_enabled)
+
     for target in rules_to_parse.keys():
         for action_info in rules_to_parse[target].action_list:
             logger.info("Static policy, target rule: " + str(action_info))
@@ -276,43 +290,77 @@ def deploy_static_policy(request, r, parsed_rule):
             if not cfilter:
                 return JSONResponse("Filter does not exist", status=status.HTTP_404_NOT_FOUND)
 
-            if action_info.action == "SET":
-
-                # Get an identifier of this new policy
-                policy_id = r.incr("policies:id")
-
-                # Set the policy data
-                policy_data = {
-                    "policy_id": policy_id,
-                    "object_type": "",
-                    "object_size": "",
-                    "object_tag": "",
-                    "object_name": "",
-                    "execution_order": policy_id,
-                    "params": "",
-                    "callable": False
-                }
-
-                # Rewrite default values
-                if parsed_rule.object_list:
-                    if parsed_rule.object_list.object_type:
-                        policy_data["object_type"] = parsed_rule.object_list.object_type.object_value
-                        policy_data["object_name"] = ', '.join(r.lrange('object_type:' + policy_data['object_type'], 0, -1))
-                    if parsed_rule.object_list.object_size:
-                        policy_data["object_size"] = [parsed_rule.object_list.object_size.operand,
-                                                      parsed_rule.object_list.object_size.object_value]
-                if action_info.server_execution:
-                    policy_data["execution_server"] = action_info.server_execution
-                if action_info.params:
-                    policy_data["params"] = action_info.params
-                if action_info.callable:
-                    policy_data["callable"] = True
-
-                # Deploy (an exception is raised if something goes wrong)
-                set_filter(r, target, cfilter, policy_data, token)
-
-            elif action_info.action == "DELETE":
-                unset_filter(r, target, cfilter, token)
+            deploy_static_action(r, target, action_info, cfilter, rules_to_parse[target], token)
+
+
+def get_static_policy_actions(r, parsed_rule, project_list, projects_crystal_enabled):
+    """
+    Resolves the actions of a static rule without deploying them.
+
+    :return: The (target, action_info, filter data, parsed rule) of each
+             action of the rule.
+    :rtype: list
+    :raises ProjectNotFound: If a project of the rule does not exist.
+    :raises ProjectNotCrystalEnabled: If a project is not Crystal enabled.
+    :raises ValueError: If a filter of the rule does not exist.
+    """
+    static_actions = list()
+    rules_to_parse = get_static_policy_targets(parsed_rule, project_list, projects_crystal_enabled)
+    for target in rules_to_parse.keys():
+        for action_info in rules_to_parse[target].action_list:
+            cfilter = r.hgetall("filter:"+str(action_info.filter))
+            if not cfilter:
+                raise ValueError("Filter does not exist: " + str(action_info.filter))
+            static_actions.append((target, action_info, cfilter, rules_to_parse[target]))
+    return static_actions
+
+
+def deploy_static_action(r, target, action_info, cfilter, parsed_rule, token, policy_id=None):
+    """
+    Deploys an action of a static rule in a target.
+
+    :param policy_id: The id of the new policy, if it is already reserved.
+    :type policy_id: int
+    :raises SwiftClientError: If the storlet can not be uploaded to Swift.
+    """
+    if action_info.action == "SET":
+
+        # Get an identifier of this new policy
+        if policy_id is None:
+            policy_id = r.incr("policies:id")
+
+        # Set the policy data
+        policy_data = {
+            "policy_id": policy_id,
+            "object_type": "",
+            "object_size": "",
+            "object_tag": "",
+            "object_name": "",
+            "execution_order": policy_id,
+            "params": "",
+            "callable": False
+        }
+
+        # Rewrite default values
+        if parsed_rule.object_list:
+            if parsed_rule.object_list.object_type:
+                policy_data["object_type"] = parsed_rule.object_list.object_type.object_value
+                policy_data["object_name"] = ', '.join(r.lrange('object_type:' + policy_data['object_type'], 0, -1))
+            if parsed_rule.object_list.object_size:
+                policy_data["object_size"] = [parsed_rule.object_list.object_size.operand,
+                                              parsed_rule.object_list.object_size.object_value]
+        if action_info.server_execution:
+            policy_data["execution_server"] = action_info.server_execution
+        if action_info.params:
+            policy_data["params"] = action_info.params
+        if action_info.callable:
+            policy_data["callable"] = True
+
+        # Deploy (an exception is raised if something goes wrong)
+        set_filter(r, target, cfilter, policy_data, token)
+
+    elif action_info.action == "DELETE":
+        unset_filter(r, target, cfilter, token)
 
 
 #
@@ -370,13 +418,18 @@ def dynamic_policy_detail(request, policy_id):
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
 
-def deploy_dynamic_policy(r, rule_string, parsed_rule, http_host):
+def build_dynamic_policies(r, rule_string, parsed_rule, project_list, projects_crystal_enabled):
+    """
+    Returns the data of the dynamic policies of a rule, one per target and
+    action, without their id (see set_dynamic_policy_id).
+
+    :raises ProjectNotFound: If a project of the rule does not exist.
+    :raises ProjectNotCrystalEnabled: If a project is not Crystal enabled.
+    """
+    policies = list()
     rules_to_parse = dict()
     project = None
     container = None
-    # TODO: get only the Crystal enabled projects
-    projects_crystal_enabled = r.lrange('projects_crystal_enabled', 0, -1)
-    project_list = get_project_list()
 
     for target in parsed_rule.target:
         if target[0] == 'TENANT':
@@ -419,16 +472,7 @@ def deploy_dynamic_policy(r, rule_string, parsed_rule, http_host):
             else:
                 target_name, target_id = target.split(':')
 
-            policy_id = r.incr("policies:id")
-            rule_id = 'policy:' + str(policy_id)
-
-            if action_info.transient:
-                transient = True
-                location = settings.RULE_TRANSIENT_MODULE
-            else:
-                transient = False
-                location = settings.RULE_MODULE
-            policy_location = os.path.join(settings.PYACTOR_URL, location, str(rule_id))
+            transient = bool(action_info.transient)
 
             # FIXME Should we recreate a static rule for each target and action??
             condition_re = re.compile(r'.* (WHEN .*) DO .*', re.M | re.I)
@@ -448,8 +492,7 @@ def deploy_dynamic_policy(r, rule_string, parsed_rule, http_host):
                     object_size = [parsed_rule.object_list.object_size.operand,
                                    parsed_rule.object_list.object_size.object_value]
 
-            policy_data = {"id": policy_id,
-                           "target_id": target_id,
+            policy_data = {"target_id": target_id,
                            "target_name": target_name,
                            "filter": action_info.filter,
                            "parameters": action_info.params,
@@ -460,13 +503,131 @@ def deploy_dynamic_policy(r, rule_string, parsed_rule, http_host):
                            "object_size": object_size,
                            "object_tag": object_tag,
                            "transient": transient,
-                           "policy_location": policy_location,
                            "status": 'Alive'}
+            policies.append(policy_data)
 
-            start_dynamic_policy_actor(policy_data, http_host)
+    return policies
+
+
+def set_dynamic_policy_id(policy_data, policy_id):
+    policy_data['id'] = policy_id
+    if settings.RULE_ENGINE_ENABLED:
+        policy_data['policy_location'] = os.path.join(settings.PYACTOR_URL, settings.RULE_ENGINE_MODULE, ENGINE_ID)
+        return
+    if policy_data['transient']:
+        location = settings.RULE_TRANSIENT_MODULE
+    else:
+        location = settings.RULE_MODULE
+    policy_data['policy_location'] = os.path.join(settings.PYACTOR_URL, location, 'policy:' + str(policy_id))
+
+
+def deploy_dynamic_policy(r, rule_string, parsed_rule, http_host):
+    # TODO: get only the Crystal enabled projects
+    projects_crystal_enabled = r.lrange('projects_crystal_enabled', 0, -1)
+    project_list = get_project_list()
+
+    for policy_data in build_dynamic_policies(r, rule_string, parsed_rule, project_list, projects_crystal_enabled):
+        set_dynamic_policy_id(policy_data, r.incr("policies:id"))
+        start_dynamic_policy_actor(policy_data, http_host)
 
-            # Add policy into Redis
-            r.hmset('policy:' + str(policy_id), policy_data)
+        # Add policy into Redis
+        r.hmset('policy:' + str(policy_data['id']), policy_data)
+
+
+def deploy_policies_bulk(request, r, rules_string):
+    """
+    Deploys a set of DSL rules at once. All the rules are parsed (in a pool
+    of processes for large sets), and their targets and filters resolved,
+    before anything is stored. The dynamic policies are stored, with their
+    ids, in a single MULTI/EXEC transaction. The static policies are then
+    deployed one by one, as they are set in Swift: if one of them fails, the
+    dynamic policies and the pipelines of the static targets are rolled back.
+    Finally, the actors of the dynamic policies are started concurrently.
+
+    :return: The ids of the dynamic policies whose actor could not be started
+             (they are stored as Stopped).
+    :rtype: list
+    """
+    rules_string = [rule_string for rule_string in rules_string if rule_string.strip()]
+    parsed_rules = dsl_parser.parse_rules(rules_string)
+
+    projects_crystal_enabled = r.lrange('projects_crystal_enabled', 0, -1)
+    project_list = get_project_list()
+    dynamic_policies = list()
+    static_actions = list()
+    for rule_string, (condition_list, parsed_rule) in zip(rules_string, parsed_rules):
+        if condition_list:
+            dynamic_policies.extend(build_dynamic_policies(r, rule_string, parsed_rule, project_list,
+                                                           projects_crystal_enabled))
+        else:
+            static_actions.extend(get_static_policy_actions(r, parsed_rule, project_list, projects_crystal_enabled))
+
+    static_ids = sum(1 for _, action_info, _, _ in static_actions if action_info.action == "SET")
+
+    def store_policies(pipe):
+        # The ids of all the policies are reserved in the same transaction
+        last_id = int(pipe.get("policies:id") or 0)
+        pipe.multi()
+        for policy_id, policy_data in enumerate(dynamic_policies, last_id + 1):
+            set_dynamic_policy_id(policy_data, policy_id)
+            pipe.hmset('policy:' + str(policy_id), policy_data)
+        pipe.set("policies:id", last_id + len(dynamic_policies) + static_ids)
+        return last_id
+
+    # The static actions rewrite the pipelines of their targets
+    pipelines = dict()
+    for target, _, _, _ in static_actions:
+        key = 'pipeline:' + target.replace('/', ':')
+        pipelines[key] = r.hgetall(key)
+
+    initial_id = r.transaction(store_policies, "policies:id", value_from_callable=True)
+    last_id = initial_id + len(dynamic_policies) + static_ids
+
+    if static_actions:
+        token = get_token_connection(request)
+        policy_id = initial_id + len(dynamic_policies)
+        try:
+            for target, action_info, cfilter, parsed_rule in static_actions:
+                logger.info("Static policy, target rule: " + str(action_info))
+                if action_info.action == "SET":
+                    policy_id += 1
+                deploy_static_action(r, target, action_info, cfilter, parsed_rule, token, policy_id)
+        except Exception:
+            rollback_policies_bulk(r, dynamic_policies, pipelines, initial_id, last_id)
+            raise
+
+    stopped = list()
+    if dynamic_policies:
+        stopped = start_dynamic_policy_actors(dynamic_policies, request.META['HTTP_HOST'])
+        if stopped:
+            pipe = r.pipeline(transaction=True)
+            for policy_id in stopped:
+                pipe.hset('policy:' + str(policy_id), 'status', 'Stopped')
+            pipe.execute()
+
+    return stopped
+
+
+def rollback_policies_bulk(r, dynamic_policies, pipelines, initial_id, last_id):
+    """
+    Undoes a bulk deployment: deletes its dynamic policies and restores the
+    pipelines of its static targets. The policy ids are released if no other
+    policy was created in the meantime.
+    """
+    def rollback(pipe):
+        release_ids = int(pipe.get("policies:id") or 0) == last_id
+        pipe.multi()
+        for policy_data in dynamic_policies:
+            pipe.delete('policy:' + str(policy_data['id']))
+        for key, pipeline in pipelines.items():
+            pipe.delete(key)
+            if pipeline:
+                pipe.hmset(key, pipeline)
+        if release_ids:
+            pipe.set("policies:id", initial_id)
+
+    r.transaction(rollback, "policies:id")
+    logger.info("Bulk policies, Deployment rolled back")
 
 
 def start_dynamic_policy_actor(policy_data, http_host):
@@ -475,6 +636,14 @@ def start_dynamic_policy_actor(policy_data, http_host):
     transient = policy_data["transient"]
     policy_id = int(policy_data["id"])
     rule_id = 'policy:' + str(policy_id)
+    if settings.RULE_ENGINE_ENABLED:
+        engine = get_rule_engine(host)
+        try:
+            engine.add_policy(policy_data, http_host)
+        except Exception as e:
+            raise ValueError("An error occurred starting the policy actor: "+str(e))
+        rule_actors[policy_id] = PolicyHandle(engine, policy_id)
+        return
     if transient:
         rule_actors[policy_id] = host.spawn(rule_id, settings.RULE_TRANSIENT_MODULE, policy_data, http_host)
     else:
@@ -487,6 +656,31 @@ def start_dynamic_policy_actor(policy_data, http_host):
         raise ValueError("An error occurred starting the policy actor: "+str(e))
 
 
+def start_dynamic_policy_actors(policies_data, http_host):
+    """
+    Starts the actors of a set of dynamic policies, POLICY_BULK_START_WORKERS
+    at a time.
+
+    :return: The ids of the policies whose actor could not be started.
+    :rtype: list
+    """
+    def start(policy_data):
+        try:
+            start_dynamic_policy_actor(policy_data, http_host)
+        except Exception as e:
+            logger.error("Dynamic policy " + str(policy_data['id']) + ": " + str(e))
+            return policy_data['id']
+
+    # Create the host once, before the workers spawn the actors
+    create_local_host()
+    pool = ThreadPool(max(1, min(settings.POLICY_BULK_START_WORKERS, len(policies_data))))
+    try:
+        return [policy_id for policy_id in pool.map(start, policies_data) if policy_id is not None]
+    finally:
+        pool.close()
+        pool.join()
+
+
 #
 # Access Control
 #